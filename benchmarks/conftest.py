@@ -0,0 +1,100 @@
+"""Options and fixtures of the benchmark suite, which runs against synthetic OSM maps."""
+
+import os
+
+import pytest
+from osmox import build, config
+from synthetic import SyntheticMap
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+config_path = os.path.join(root, "configs", "config_UKfill.json")
+
+SCALES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+# fewer rounds at larger scales, where each round (and its setup) takes much longer
+ROUNDS = {"10k": 5, "1M": 1, "10M": 1}
+STAGES = ["parse", "assign_tags", "assign_activities", "fill", "features", "distances"]
+
+
+def pytest_addoption(parser):
+    """Add a `--scale` option, to choose the size of the synthetic map."""
+    parser.addoption(
+        "--scale",
+        choices=list(SCALES),
+        default="10k",
+        help="number of buildings in the synthetic OSM map to benchmark against",
+    )
+
+
+def pytest_benchmark_update_machine_info(config, machine_info):
+    """Record the scale with benchmark results."""
+    machine_info["osmox_scale"] = config.getoption("--scale")
+
+
+@pytest.fixture(scope="session")
+def scale(request):
+    """Scale of the synthetic map."""
+    return request.config.getoption("--scale")
+
+
+@pytest.fixture(scope="session")
+def rounds(scale):
+    """Number of rounds to run benchmarks for at the scale."""
+    return ROUNDS[scale]
+
+
+@pytest.fixture(scope="session")
+def osm_path(request, tmp_path_factory, scale):
+    """Synthetic OSM map, cached between benchmark runs if the pytest cache is enabled."""
+    if getattr(request.config, "cache", None) is not None:
+        directory = request.config.cache.mkdir("osmox-synthetic")
+    else:
+        directory = tmp_path_factory.mktemp("osmox-synthetic")
+    path = directory / f"synthetic_{scale}.osm.pbf"
+    if not path.exists():
+        SyntheticMap(buildings=SCALES[scale]).write(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def cnfg():
+    """Config to benchmark with."""
+    return config.load(config_path)
+
+
+def run_stage(handler, stage, osm_path, cnfg):
+    """Run a single stage of the `osmox run` pipeline on a handler."""
+    if stage == "parse":
+        handler.apply_file(osm_path, locations=True, idx="flex_mem")
+    elif stage == "assign_tags":
+        handler.assign_tags()
+    elif stage == "assign_activities":
+        handler.assign_activities()
+    elif stage == "fill":
+        for group in cnfg["fill_missing_activities"]:
+            handler.fill_missing_activities(**group)
+    elif stage == "features":
+        handler.add_features()
+    elif stage == "distances":
+        for target_activity in cnfg["distance_to_nearest"]:
+            handler.assign_nearest_distance(target_activity)
+
+
+@pytest.fixture(scope="session")
+def handler_before(osm_path, cnfg):
+    """Factory of handlers on which all stages before the given stage have been run."""
+
+    def _handler_before(stage):
+        handler = build.ObjectHandler(cnfg, crs="epsg:27700")
+        for previous in STAGES[: STAGES.index(stage)]:
+            run_stage(handler, previous, osm_path, cnfg)
+        return handler
+
+    return _handler_before
+
+
+@pytest.fixture(scope="session")
+def complete_handler(handler_before, osm_path, cnfg):
+    """Handler on which all stages have been run, ready to be written. Must not be modified."""
+    handler = handler_before("distances")
+    run_stage(handler, "distances", osm_path, cnfg)
+    return handler
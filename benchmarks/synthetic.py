@@ -0,0 +1,210 @@
+"""Synthetic OSM data for benchmarking OSMOX at controllable scales.
+
+Generated maps are a grid of square landuse blocks:
+
+- "developed" blocks (landuse=residential or landuse=commercial) are covered by a regular grid of buildings,
+- "gap" blocks (landuse=residential) have no buildings, and are the targets of activity infilling,
+- POIs (amenity, shop and bus stop nodes) are placed at the centres of randomly chosen buildings.
+
+Run as a script to write a map to file, e.g. `python benchmarks/synthetic.py --buildings 1000000 synthetic.osm.pbf`.
+"""
+
+import math
+import os
+from pathlib import Path
+
+import click
+import numpy as np
+import osmium
+
+ORIGIN = (-4.5, 54.2)
+METRES_PER_DEGREE = 111_320
+BUILDING_SIZE = 10
+BUILDING_SPACING = 20
+
+BUILDING_TAGS = {
+    "residential": ["house", "detached", "terrace", "apartments"],
+    "commercial": ["retail", "office", "commercial", "yes"],
+}
+POI_TAGS = [
+    {"amenity": "cafe"},
+    {"amenity": "pub"},
+    {"shop": "supermarket"},
+    {"shop": "bakery"},
+    {"highway": "bus_stop"},
+    {"public_transport": "platform"},
+]
+
+
+class SyntheticMap:
+    """Layout of a synthetic OSM map.
+
+    Args:
+        buildings (int, optional): Number of buildings. Defaults to 10_000.
+        pois (int, optional): Number of POI nodes. Defaults to a fifth of the number of buildings.
+        landuse (int, optional):
+            Number of developed landuse polygons, across which buildings are evenly spread.
+            Defaults to one per 100 buildings.
+        gaps (int, optional): Number of residential landuse polygons without buildings. Defaults to a tenth of `landuse`.
+        seed (int, optional): Random seed, for reproducible maps. Defaults to 0.
+    """
+
+    def __init__(self, buildings=10_000, pois=None, landuse=None, gaps=None, seed=0):
+        """Size the map, which is only generated when written."""
+        self.buildings = buildings
+        self.pois = buildings // 5 if pois is None else pois
+        self.landuse = (
+            max(1, math.ceil(buildings / 100)) if landuse is None else landuse
+        )
+        self.gaps = self.landuse // 10 if gaps is None else gaps
+        self.seed = seed
+
+        self.per_block = math.ceil(buildings / self.landuse)
+        self.block_side = max(1, math.ceil(math.sqrt(self.per_block)))
+        self.block_size = self.block_side * BUILDING_SPACING
+        self.grid_side = math.ceil(math.sqrt(self.landuse + self.gaps))
+
+    def __repr__(self):
+        """Represent the map by its parameters."""
+        return (
+            f"SyntheticMap(buildings={self.buildings}, pois={self.pois}, "
+            f"landuse={self.landuse}, gaps={self.gaps}, seed={self.seed})"
+        )
+
+    @staticmethod
+    def to_lonlat(x, y):
+        """Convert metre offsets from the map origin to approximate longitudes and latitudes."""
+        lat = ORIGIN[1] + np.asarray(y) / METRES_PER_DEGREE
+        lon = ORIGIN[0] + np.asarray(x) / (
+            METRES_PER_DEGREE * math.cos(math.radians(ORIGIN[1]))
+        )
+        return lon, lat
+
+    def block_origins(self):
+        """Metre offsets of the south-west corners of all blocks; developed blocks first, then gaps."""
+        n = self.landuse + self.gaps
+        i = np.arange(n)
+        # leave a street between blocks
+        step = self.block_size + BUILDING_SPACING
+        return (i % self.grid_side) * step, (i // self.grid_side) * step
+
+    def building_origins(self):
+        """Metre offsets of the south-west corners of all buildings."""
+        bx, by = self.block_origins()
+        bx, by = bx[: self.landuse], by[: self.landuse]
+        k = np.arange(self.per_block)
+        offset_x = (k % self.block_side) * BUILDING_SPACING + (
+            BUILDING_SPACING - BUILDING_SIZE
+        ) / 2
+        offset_y = (k // self.block_side) * BUILDING_SPACING + (
+            BUILDING_SPACING - BUILDING_SIZE
+        ) / 2
+        x = (bx[:, None] + offset_x[None, :]).ravel()[: self.buildings]
+        y = (by[:, None] + offset_y[None, :]).ravel()[: self.buildings]
+        return x, y
+
+    def write(self, path, chunk_size=100_000):
+        """Write the map to an OSM file, in any format supported by osmium (e.g. `.osm.pbf`, `.osm`).
+
+        Args:
+            path (str | Path): Output path. Any existing file at this path will be replaced.
+            chunk_size (int, optional): Number of outlines to compute coordinates for at a time. Defaults to 100_000.
+        """
+        path = Path(path)
+        if path.exists():
+            os.remove(path)
+        rng = np.random.default_rng(self.seed)
+        block_uses = rng.choice(
+            ["residential", "commercial"], size=self.landuse, p=[0.7, 0.3]
+        )
+        x, y = self.building_origins()
+        poi_buildings = (
+            rng.integers(0, len(x), size=self.pois) if len(x) else np.array([], int)
+        )
+        poi_tags = rng.integers(0, len(POI_TAGS), size=len(poi_buildings))
+
+        bx, by = self.block_origins()
+        # outline south-west corners and sizes: buildings, then landuse blocks
+        origins_x = np.concatenate([x, bx])
+        origins_y = np.concatenate([y, by])
+        sizes = np.concatenate(
+            [np.full(len(x), BUILDING_SIZE), np.full(len(bx), self.block_size)]
+        )
+        corners = np.array([(0, 0), (0, 1), (1, 1), (1, 0)])
+        # node IDs: POIs first, then four corners per outline
+        first_corner_id = len(poi_buildings) + 1
+
+        writer = osmium.SimpleWriter(str(path))
+        try:
+            poi_lon, poi_lat = self.to_lonlat(
+                x[poi_buildings] + BUILDING_SIZE / 2,
+                y[poi_buildings] + BUILDING_SIZE / 2,
+            )
+            for i, (lon, lat, tags) in enumerate(
+                zip(poi_lon, poi_lat, poi_tags, strict=True)
+            ):
+                writer.add_node(
+                    osmium.osm.mutable.Node(
+                        id=i + 1, location=(lon, lat), tags=POI_TAGS[tags]
+                    )
+                )
+
+            for start in range(0, len(sizes), chunk_size):
+                stop = start + chunk_size
+                lon, lat = self.to_lonlat(
+                    origins_x[start:stop, None]
+                    + corners[None, :, 0] * sizes[start:stop, None],
+                    origins_y[start:stop, None]
+                    + corners[None, :, 1] * sizes[start:stop, None],
+                )
+                node_id = first_corner_id + 4 * start
+                for location in zip(lon.ravel(), lat.ravel(), strict=True):
+                    writer.add_node(
+                        osmium.osm.mutable.Node(id=node_id, location=location)
+                    )
+                    node_id += 1
+
+            for i in range(len(sizes)):
+                if i < len(x):
+                    use = block_uses[i // self.per_block]
+                    tags = {"building": BUILDING_TAGS[use][i % len(BUILDING_TAGS[use])]}
+                else:
+                    block = i - len(x)
+                    tags = {
+                        "landuse": (
+                            block_uses[block] if block < self.landuse else "residential"
+                        )
+                    }
+                refs = list(range(first_corner_id + 4 * i, first_corner_id + 4 * i + 4))
+                writer.add_way(
+                    osmium.osm.mutable.Way(id=i + 1, nodes=[*refs, refs[0]], tags=tags)
+                )
+        finally:
+            writer.close()
+
+
+@click.command()
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--buildings", type=int, default=10_000, help="number of buildings")
+@click.option("--pois", type=int, default=None, help="number of POI nodes")
+@click.option(
+    "--landuse", type=int, default=None, help="number of developed landuse polygons"
+)
+@click.option(
+    "--gaps",
+    type=int,
+    default=None,
+    help="number of empty residential landuse polygons",
+)
+@click.option("--seed", type=int, default=0, help="random seed")
+def main(path, buildings, pois, landuse, gaps, seed):
+    """Write a synthetic OSM map to PATH."""
+    synthetic = SyntheticMap(
+        buildings=buildings, pois=pois, landuse=landuse, gaps=gaps, seed=seed
+    )
+    synthetic.write(path)
+    click.echo(f"Written {synthetic} to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Benchmarks of the stages of `osmox run`."""
+
+import pytest
+from conftest import STAGES, run_stage
+from osmox import build
+
+
+@pytest.mark.parametrize("stage", STAGES)
+def test_stage(benchmark, handler_before, osm_path, cnfg, rounds, stage):
+    """Run a stage on a handler which has run all stages before it."""
+    benchmark.group = "stages"
+
+    def setup():
+        return (handler_before(stage),), {}
+
+    def stage_func(handler):
+        run_stage(handler, stage, osm_path, cnfg)
+        return handler
+
+    handler = benchmark.pedantic(stage_func, setup=setup, rounds=rounds)
+    benchmark.extra_info["objects"] = len(handler.objects)
+    assert len(handler.objects) > 0
+
+
+@pytest.mark.parametrize("curve", ["hilbert", "zorder"])
+def test_sort(benchmark, handler_before, rounds, curve):
+    """Sort objects along a space-filling curve."""
+    benchmark.group = "stages"
+    benchmark.pedantic(
+        build.ObjectHandler.sort,
+        setup=lambda: ((handler_before("assign_tags"), curve), {}),
+        rounds=rounds,
+    )
@@ -0,0 +1,64 @@
+"""Benchmarks of spatial index and tag parsing helpers."""
+
+import numpy as np
+import pytest
+from osmox import helpers
+
+QUERIES = 10_000
+
+
+@pytest.fixture(scope="module")
+def query_boxes(complete_handler):
+    """Random 100m query boxes within the bounds of the objects."""
+    xmin, ymin, xmax, ymax = np.array(
+        [o.geom.bounds for o in complete_handler.objects.objects]
+    ).T
+    rng = np.random.default_rng(0)
+    x = rng.uniform(xmin.min(), xmax.max(), QUERIES)
+    y = rng.uniform(ymin.min(), ymax.max(), QUERIES)
+    return [(x0, y0, x0 + 100, y0 + 100) for x0, y0 in zip(x, y, strict=True)]
+
+
+def test_autotree_intersection(benchmark, complete_handler, query_boxes):
+    """Query the object index with many small boxes."""
+    benchmark.group = "autotree"
+    tree = complete_handler.objects
+
+    def query():
+        return sum(len(tree.intersection(box)) for box in query_boxes)
+
+    assert benchmark(query) > 0
+
+
+def test_autotree_bulk_load(benchmark, complete_handler):
+    """Bulk load all objects into an index."""
+    benchmark.group = "autotree"
+    objects = complete_handler.objects.objects
+    tree = benchmark(helpers.AutoTree, objects)
+    assert len(tree) == len(objects)
+
+
+def test_autotree_insert(benchmark, complete_handler):
+    """Insert all objects into an index one at a time."""
+    benchmark.group = "autotree"
+    objects = complete_handler.objects.objects
+
+    def insert():
+        tree = helpers.AutoTree()
+        for o in objects:
+            tree.auto_insert(o)
+        return tree
+
+    tree = benchmark.pedantic(insert, rounds=1)
+    assert len(tree) == len(objects)
+
+
+def test_height_to_m(benchmark, scale):
+    """Parse many heights in different units."""
+    benchmark.group = "helpers"
+    heights = ["12", "12.5", "12m", "12 m", "40ft", "10'", "10'6\""] * 10_000
+
+    def parse():
+        return [helpers.height_to_m(height) for height in heights]
+
+    assert len(benchmark(parse)) == len(heights)
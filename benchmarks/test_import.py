@@ -0,0 +1,35 @@
+"""Benchmarks of command line startup times."""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+CONFIG_PATH = (
+    Path(__file__).parents[1] / "tests" / "fixtures" / "test_config_infill.json"
+)
+# fresh interpreters, so that nothing is already imported
+COMMANDS = {
+    "python": ["-c", "pass"],
+    "import_cli": ["-c", "import osmox.cli"],
+    "import_build": ["-c", "import osmox.build"],
+    "help": ["-c", "from osmox.cli import cli; cli(['--help'])"],
+    "validate": [
+        "-c",
+        f"from osmox.cli import cli; cli(['validate', {str(CONFIG_PATH)!r}])",
+    ],
+}
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_startup(benchmark, command):
+    """Run a command in a fresh interpreter."""
+    benchmark.group = "startup"
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, *COMMANDS[command]],),
+        kwargs={"check": True, "capture_output": True},
+        rounds=5,
+        warmup_rounds=1,
+    )
@@ -0,0 +1,29 @@
+"""Benchmarks of output writers."""
+
+import pytest
+from osmox import writers
+
+
+@pytest.mark.parametrize(
+    "format", ["geoparquet", "geopackage", "geojson", "flatgeobuf"]
+)
+@pytest.mark.parametrize("single_use", [False, True])
+def test_write_outputs(
+    benchmark, complete_handler, tmp_path, rounds, format, single_use
+):
+    """Write outputs of all objects in a format."""
+    benchmark.group = "writers"
+    paths = benchmark.pedantic(
+        writers.write_outputs,
+        args=(complete_handler, str(tmp_path / "output")),
+        kwargs={"format": format, "single_use": single_use},
+        rounds=rounds,
+    )
+    assert len(paths) == 2
+
+
+def test_to_arrow(benchmark, complete_handler, rounds):
+    """Export all objects to an Arrow table."""
+    benchmark.group = "writers"
+    table = benchmark.pedantic(complete_handler.to_arrow, rounds=rounds)
+    assert len(table) == len(complete_handler.objects)
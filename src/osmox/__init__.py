@@ -1,6 +1 @@
-import pyproj
-
 __version__ = "0.2.0"
-
-
-pyproj.network.set_network_enabled(False)
@@ -1,22 +1,73 @@
+import json
 import logging
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import geopandas as gp
 import numpy as np
 import osmium
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyproj
+import shapely
 import shapely.wkb as wkblib
 from pyproj import CRS, Transformer
-from shapely.geometry import MultiPoint, Polygon
+from shapely.geometry import MultiPoint, box
 from shapely.ops import nearest_points, transform
 
 from osmox import helpers
+from osmox.config import compile_config
+
+pyproj.network.set_network_enabled(False)
 
 OSMTag = namedtuple("OSMtag", "key value")
 OSMObject = namedtuple("OSMobject", "idx, activity_tags, geom")
 
 
+class CentroidArray:
+    """Object centroids held as a compact array of coordinates, rather than as shapely geometries.
+
+    A shapely point takes about 200 bytes of memory, whereas its coordinates take 16 bytes as float64
+    or 8 bytes as float32.
+    """
+
+    def __init__(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        dtype: Literal["float64", "float32"] = "float64",
+    ):
+        """Store centroid coordinates.
+
+        Args:
+            x (np.ndarray): Centroid x coordinates.
+            y (np.ndarray): Centroid y coordinates.
+            dtype (Literal["float64", "float32"], optional): Coordinate data type. Defaults to "float64".
+        """
+        self.xy = np.column_stack([x, y]).astype(dtype)
+
+    def __len__(self):
+        """Number of centroids."""
+        return len(self.xy)
+
+    def point(self, row: int) -> shapely.Point:
+        """Centroid of one object, as a point."""
+        x, y = self.xy[row]
+        return shapely.Point(float(x), float(y))
+
+    def points(self, rows: list[int] | None = None) -> np.ndarray:
+        """Centroids of many objects (defaults to all), as an array of points."""
+        xy = self.xy if rows is None else self.xy[np.asarray(rows, dtype=np.int64)]
+        return shapely.points(xy.astype(np.float64))
+
+    def bounds(self) -> np.ndarray:
+        """Bounds of all centroids, as (minx, miny, maxx, maxy) rows."""
+        return np.hstack([self.xy, self.xy]).astype(np.float64)
+
+
 class Object:
 
     DEFAULT_LEVELS = {  # for if a level tag is required but not found
@@ -60,9 +111,28 @@ class Object:
         self.osm_tags = dict(osm_tags)
         self.activity_tags = activity_tags
         self.geom = geom
+        # area of the object's footprint, if its geometry has been replaced by its centroid
+        self.geom_area = None
         self.activities = None
         self.features: dict = {}
 
+    @property
+    def geom(self):
+        """Object geometry, or a point at its centroid if the geometry has been released."""
+        if self._geom is None and self.centroids is not None:
+            return self.centroids.point(self.centroid_row)
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        self._geom = geom
+        self.centroids, self.centroid_row = None, None
+
+    def store_centroid(self, centroids: CentroidArray, row: int):
+        """Release the object geometry, keeping only its centroid as a row of compact centroid storage."""
+        self._geom = None
+        self.centroids, self.centroid_row = centroids, row
+
     def add_features(self, features):
         available = {
             "area": self.area,
@@ -74,7 +144,7 @@ class Object:
             self.features[f] = available[f]()
 
     def area(self):
-        return int(self.geom.area)
+        return int(self.geom.area if self.geom_area is None else self.geom_area)
 
     def levels(self):
         if "building:levels" in self.osm_tags:
@@ -190,13 +260,33 @@ class ObjectHandler(osmium.SimpleHandler):
         from_crs="epsg:4326",
         lazy=False,
         level=logging.DEBUG,
+        workers=1,
+        progress_callback=None,
+        share_parse=False,
+        bbox=None,
+        geometry_storage="shapely",
+        geometry_precision=None,
     ):
 
         super().__init__()
         logging.basicConfig(level=level)
-        self.cnfg = config
+        self.cnfg = compile_config(config)
         self.crs = crs
         self.lazy = lazy
+        self.workers = workers
+        self.progress_callback = progress_callback
+        self.share_parse = share_parse
+        # how object centroids are stored once their polygons are released (see `release_geometries`)
+        if geometry_storage not in ["shapely", "float64", "float32"]:
+            raise ValueError(f"Unknown geometry storage: {geometry_storage}")
+        self.geometry_storage = geometry_storage
+        self.geometry_precision = geometry_precision
+        self.centroids = None
+        # OSM elements which don't intersect the bounding box (in `from_crs`) are ignored when parsing
+        self.from_crs = from_crs
+        self.bbox = box(*bbox) if bbox is not None else None
+        if self.bbox is not None:
+            shapely.prepare(self.bbox)
         self.filter = self.cnfg["filter"]
         self.object_features = self.cnfg["object_features"]
         self.default_tags = self.cnfg["default_tags"]
@@ -209,6 +299,13 @@ class ObjectHandler(osmium.SimpleHandler):
 
         self.log = {"existing": 0, "points": 0, "areas": 0, "defaults": 0}
 
+        self._coverage = self._activity_coverage([], [])
+        self._coverage_counts = (0, 0)
+        self._fill_counts = defaultdict(int)
+        # object positions keyed by activity, for queries (see `activity_index`)
+        self._activity_index = None
+        self._activity_index_key = None
+
     """
     On handler.apply_file() method; parse through all nodes and areas:
     (i) add them to self.objects if they are within the filter_config
@@ -217,42 +314,41 @@ class ObjectHandler(osmium.SimpleHandler):
 
     def selects(self, tags):
         if tags:
-            tags = dict(tags)
-            return helpers.dict_list_match(tags, self.filter)
+            return self.cnfg.selects(dict(tags))
 
     def get_filtered_tags(self, tags):
-        """Return configured activity tags for an OSM object as list of OSMtags.
-        """
+        """Return configured activity tags for an OSM object as list of OSMtags."""
         if tags:
-            tags = dict(tags)
-            found = []
-            for osm_key, osm_val in tags.items():
-                if osm_key in self.activity_config:
-                    if (
-                        osm_val in self.activity_config[osm_key]
-                        or self.activity_config[osm_key] == "*"
-                    ):
-                        found.append(OSMTag(key=osm_key, value=osm_val))
-            return found
+            return [
+                OSMTag(key=k, value=v) for k, v in self.cnfg.mapped_tags(dict(tags))
+            ]
+
+    def in_bbox(self, geom):
+        """Check if a geometry intersects the handler bounding box, if it has one."""
+        return self.bbox is None or self.bbox.intersects(geom)
 
     def add_object(self, idx, activity_tags, osm_tags, geom):
-        if geom:
+        if geom and self.in_bbox(geom):
             geom = transform(self.transformer.transform, geom)
-            self.objects.auto_insert(
-                Object(
-                    idx=idx, osm_tags=osm_tags, activity_tags=activity_tags, geom=geom
-                )
+            obj = Object(
+                idx=idx, osm_tags=osm_tags, activity_tags=activity_tags, geom=geom
             )
+            self.objects.auto_insert(obj)
+            if self.share_parse and activity_tags:
+                # so that handlers taking objects from this one (see apply_parsed) can use it as a point or area
+                (self.points if geom.geom_type == "Point" else self.areas).auto_insert(
+                    obj
+                )
 
     def add_point(self, idx, activity_tags, geom):
-        if geom:
+        if geom and self.in_bbox(geom):
             geom = transform(self.transformer.transform, geom)
             self.points.auto_insert(
                 OSMObject(idx=idx, activity_tags=activity_tags, geom=geom)
             )
 
     def add_area(self, idx, activity_tags, geom):
-        if geom:
+        if geom and self.in_bbox(geom):
             geom = transform(self.transformer.transform, geom)
             self.areas.auto_insert(
                 OSMObject(idx=idx, activity_tags=activity_tags, geom=geom)
@@ -301,6 +397,308 @@ class ObjectHandler(osmium.SimpleHandler):
         elif activity_tags:
             self.add_area(idx=a.id, activity_tags=activity_tags, geom=self.fab_area(a))
 
+    def apply_geoparquet(
+        self, path, id_column="id", tags_column="tags", batch_size=100_000
+    ):
+        """Read OSM objects from a GeoParquet file or dataset directory, as an alternative to `apply_file`.
+
+        Each row should be a single OSM element with an ID, a map of OSM tags and a point or (multi)polygon geometry,
+        e.g. as extracted from a PBF file beforehand, or such rows already in memory as an arrow table.
+        Rows are filtered by the configured `filter` and `activity_mapping` tags with vectorised predicates,
+        so only rows that can become objects, points or areas are converted to Python objects.
+        As with `apply_file`, selected rows are added to the handler objects;
+        other rows with activity tags are added to the handler points (point geometries) or areas (polygonal geometries).
+        Rows with any other geometry type are ignored, as are rows which don't intersect the handler's `bbox`, if set.
+
+        Args:
+            path (str | Path | pa.Table): Path to a GeoParquet file or a directory of GeoParquet files, or a table.
+            id_column (str, optional): Name of the OSM ID column. Defaults to "id".
+            tags_column (str, optional): Name of the OSM tags column, of arrow map<string, string> type. Defaults to "tags".
+            batch_size (int, optional): Maximum number of rows to read at a time. Defaults to 100_000.
+
+        Raises:
+            ValueError: If the tags column is not a map column, or the geometry column is not WKB encoded.
+        """
+        dataset = (
+            ds.dataset(path)
+            if isinstance(path, pa.Table)
+            else ds.dataset(path, format="parquet")
+        )
+        metadata = dataset.schema.metadata or {}
+        geo = json.loads(metadata[b"geo"]) if b"geo" in metadata else {}
+        geometry_column = geo.get("primary_column", "geometry")
+        column_metadata = geo.get("columns", {}).get(geometry_column, {})
+        if column_metadata.get("encoding", "WKB").upper() != "WKB":
+            raise ValueError(
+                f"Geometry column '{geometry_column}' must be WKB encoded, not {column_metadata['encoding']}"
+            )
+        if not pa.types.is_map(dataset.schema.field(tags_column).type):
+            raise ValueError(
+                f"Tags column '{tags_column}' must be a map column, not {dataset.schema.field(tags_column).type}"
+            )
+        # GeoParquet defaults to OGC:CRS84 (lon, lat) if the CRS is not given
+        transformer = self.transformer
+        bbox = self.bbox
+        if column_metadata.get("crs"):
+            file_crs = CRS.from_json_dict(column_metadata["crs"])
+            transformer = Transformer.from_crs(file_crs, CRS(self.crs), always_xy=True)
+            if bbox is not None:
+                # bounding box of the (densified) bounding box outline in the file CRS
+                to_file = Transformer.from_crs(
+                    CRS(self.from_crs), file_crs, always_xy=True
+                )
+                outline = shapely.segmentize(
+                    bbox, max(bbox.bounds[2] - bbox.bounds[0], 1e-9) / 100
+                )
+                bbox = box(
+                    *shapely.transform(
+                        outline,
+                        lambda x, y: helpers.transform_xy(to_file, x, y),
+                        interleaved=False,
+                    ).bounds
+                )
+
+        predicates = [
+            *self.cnfg.filter_values.items(),
+            *self.cnfg.activity_values.items(),
+        ]
+        objects, points, areas = [], [], []
+        for batch in dataset.to_batches(
+            columns=[id_column, tags_column, geometry_column], batch_size=batch_size
+        ):
+            batch = batch.filter(
+                self._tag_predicate(batch.column(tags_column), predicates)
+            )
+            if not len(batch):
+                continue
+            geoms = shapely.from_wkb(
+                batch.column(geometry_column).to_numpy(zero_copy_only=False)
+            )
+            if bbox is not None:
+                in_bbox = shapely.intersects(geoms, bbox)
+                batch, geoms = batch.filter(pa.array(in_bbox)), geoms[in_bbox]
+            geoms = shapely.transform(
+                geoms,
+                lambda x, y: helpers.transform_xy(transformer, x, y),
+                interleaved=False,
+            )
+            type_ids = shapely.get_type_id(geoms)
+            for idx, tags, geom, type_id in zip(
+                batch.column(id_column).to_pylist(),
+                batch.column(tags_column).to_pylist(),
+                geoms,
+                type_ids,
+                strict=True,
+            ):
+                if type_id == shapely.GeometryType.POINT:
+                    others = points
+                elif type_id in (
+                    shapely.GeometryType.POLYGON,
+                    shapely.GeometryType.MULTIPOLYGON,
+                ):
+                    others = areas
+                else:
+                    continue
+                activity_tags = self.get_filtered_tags(tags)
+                if self.selects(tags):
+                    obj = Object(
+                        idx=idx, osm_tags=tags, activity_tags=activity_tags, geom=geom
+                    )
+                    objects.append(obj)
+                    if self.share_parse and activity_tags:
+                        others.append(obj)
+                elif activity_tags:
+                    others.append(
+                        OSMObject(idx=idx, activity_tags=activity_tags, geom=geom)
+                    )
+        self.objects.extend(objects)
+        self.points.extend(points)
+        self.areas.extend(areas)
+
+    def apply_parsed(self, parsed: "ObjectHandler"):
+        """Take OSM objects from another handler that has already parsed an input, as an alternative to `apply_file`.
+
+        This lets many handlers with different configs share one parse of the same input.
+        The other handler must have been created with `share_parse=True` and a config which filters and maps a superset
+        of the tags of this handler's config (see `osmox.config.union_config`), and must not have assigned tags.
+        Objects, points and areas are then selected, in the same order, as if this handler had parsed the input itself.
+        Geometries are shared with the other handler, but new objects are created, so that handlers sharing a parse
+        can be processed independently.
+
+        Args:
+            parsed (ObjectHandler): Handler which has parsed an input, in the same CRS as this handler.
+
+        Raises:
+            ValueError: If the other handler was not created with `share_parse=True` or is in a different CRS.
+        """
+        if not parsed.share_parse:
+            raise ValueError(
+                "Cannot take objects from a handler created without share_parse=True"
+            )
+        if CRS(parsed.crs) != CRS(self.crs):
+            raise ValueError(
+                f"Cannot take objects parsed in crs {parsed.crs} for a handler in crs {self.crs}"
+            )
+        objects = [
+            Object(
+                idx=obj.idx,
+                osm_tags=obj.osm_tags,
+                activity_tags=self.get_filtered_tags(obj.osm_tags),
+                geom=obj.geom,
+            )
+            for obj in parsed.objects
+            if self.selects(obj.osm_tags)
+        ]
+        points, areas = [], []
+        for parsed_others, others in [(parsed.points, points), (parsed.areas, areas)]:
+            for other in parsed_others:
+                # objects the other handler selected are shared as points and areas in parse order
+                if isinstance(other, Object):
+                    if self.selects(other.osm_tags):
+                        continue
+                    activity_tags = self.get_filtered_tags(other.osm_tags)
+                else:
+                    activity_tags = self.get_filtered_tags(dict(other.activity_tags))
+                if activity_tags:
+                    others.append(
+                        OSMObject(
+                            idx=other.idx, activity_tags=activity_tags, geom=other.geom
+                        )
+                    )
+        self.objects.extend(objects)
+        self.points.extend(points)
+        self.areas.extend(areas)
+
+    @staticmethod
+    def _tag_predicate(tags: pa.Array, predicates: list[tuple]) -> pa.Array:
+        """Mask of rows with at least one tag matching the given (key, values or "*") predicates."""
+        mask = pa.array(np.zeros(len(tags), dtype=bool))
+        for key, spec in predicates:
+            values = pc.map_lookup(tags, key, "first")
+            if spec == "*":
+                match = pc.is_valid(values)
+            else:
+                match = pc.is_in(
+                    values, value_set=pa.array(list(spec), type=pa.string())
+                )
+            mask = pc.or_(mask, pc.fill_null(match, False))
+        return mask
+
+    def sort(self, curve: Literal["hilbert", "zorder"] = "hilbert"):
+        """Sort objects, points and areas along a space-filling curve through their centroids.
+
+        Sorting after parsing gives spatial locality to later stages: objects near to each other are processed,
+        queried and written together, e.g. giving tight bounding boxes to geoparquet row groups.
+        Objects added by later stages (e.g. `fill_missing_activities`) are appended in the order of their target areas.
+
+        Args:
+            curve (Literal["hilbert", "zorder"], optional): Space-filling curve to sort along. Defaults to "hilbert".
+        """
+        self.objects = self.objects.sorted(curve)
+        self.points = self.points.sorted(curve)
+        self.areas = self.areas.sorted(curve)
+        # cached coverage is indexed by area position
+        self._coverage = self._activity_coverage([], [])
+        self._coverage_counts = (0, 0)
+
+    def retained_until(self) -> dict[str, str]:
+        """Get the last stage (as in `osmox.runner.run_stages`) that uses each structure of parsed data, given the config.
+
+        Points are only used to assign tags.
+        Areas are also used to fill missing activities, if configured, as are object polygons.
+        Later stages only use object centroids and footprint areas.
+
+        Returns:
+            dict[str, str]: Stage names keyed by structure: "points", "areas" and "geometries" (object polygons).
+        """
+        last = "fill" if self.cnfg.get("fill_missing_activities") else "assign_tags"
+        return {"points": "assign_tags", "areas": last, "geometries": last}
+
+    def release_unused(self, stage: str) -> list[str]:
+        """Free the parsed data which no stage after the given one uses (see `retained_until`).
+
+        Args:
+            stage (str): Name of the stage which has just finished.
+
+        Returns:
+            list[str]: Names of the released structures.
+        """
+        released = [
+            name for name, last in self.retained_until().items() if last == stage
+        ]
+        if "points" in released:
+            self.points = helpers.AutoTree()
+        if "areas" in released:
+            self.areas = helpers.AutoTree()
+            self._coverage = self._activity_coverage([], [])
+            self._coverage_counts = (0, 0)
+        if "geometries" in released:
+            self.release_geometries()
+        return released
+
+    def release_geometries(self):
+        """Replace object geometries by their centroids, keeping their footprint areas for object features.
+
+        Centroids are snapped to a grid of size `geometry_precision` (in handler CRS units), if set.
+        They are kept as shapely points, or in compact float64 or float32 coordinate arrays (`self.centroids`),
+        depending on `geometry_storage`.
+        Objects are re-indexed by their centroids.
+        """
+        objects = self.objects.objects
+        geoms = np.array([o.geom for o in objects], dtype=object)
+        for obj, area in zip(objects, shapely.area(geoms), strict=True):
+            if obj.geom_area is None:
+                obj.geom_area = float(area)
+        centroids = shapely.centroid(geoms)
+        del geoms
+        if self.geometry_precision:
+            centroids = shapely.set_precision(centroids, self.geometry_precision)
+
+        if self.geometry_storage == "shapely":
+            for obj, centroid in zip(objects, centroids, strict=True):
+                obj.geom = centroid
+            self.objects = helpers.AutoTree(objects)
+        else:
+            self.centroids = CentroidArray(
+                shapely.get_x(centroids),
+                shapely.get_y(centroids),
+                dtype=self.geometry_storage,
+            )
+            del centroids
+            for row, obj in enumerate(objects):
+                obj.store_centroid(self.centroids, row)
+            self.objects = helpers.AutoTree(objects, bounds=self.centroids.bounds())
+
+    def centroid_points(self, objects=None) -> np.ndarray:
+        """Get object centroids as an array of points.
+
+        Centroids of objects in compact centroid storage (see `release_geometries`) are taken from it in bulk.
+
+        Args:
+            objects (list[Object], optional): Objects to get centroids of. Defaults to None, i.e. all handler objects.
+
+        Returns:
+            np.ndarray: Centroid points.
+        """
+        if objects is None:
+            objects = self.objects.objects
+        if self.centroids is not None and all(
+            o.centroids is self.centroids for o in objects
+        ):
+            return self.centroids.points([o.centroid_row for o in objects])
+        return shapely.centroid(np.array([o.geom for o in objects], dtype=object))
+
+    def _progress(self, iterable, stage):
+        """Report progress through a stage's iterable as a progress bar and to `progress_callback`, if set."""
+        return helpers.progressBar(
+            iterable,
+            prefix="Progress:",
+            suffix="Complete",
+            length=50,
+            stage=stage,
+            callback=self.progress_callback,
+        )
+
     def assign_tags(self):
         """Assign unknown tags to buildings spatially.
         """
@@ -312,9 +710,7 @@ class ObjectHandler(osmium.SimpleHandler):
     def assign_tags_full(self):
         """Assign unknown tags to buildings spatially.
         """
-        for obj in helpers.progressBar(
-            self.objects, prefix="Progress:", suffix="Complete", length=50
-        ):
+        for obj in self._progress(self.objects, "assign_tags"):
 
             if obj.activity_tags:
                 # if an onject already has activity tags, continue
@@ -338,9 +734,7 @@ class ObjectHandler(osmium.SimpleHandler):
 
     def assign_tags_lazy(self):
         """Assign tags if filtered object does not already have useful tags."""
-        for obj in helpers.progressBar(
-            self.objects, prefix="Progress:", suffix="Complete", length=50
-        ):
+        for obj in self._progress(self.objects, "assign_tags"):
 
             if obj.activity_tags:
                 # if an onject already has activity tags, continue
@@ -364,10 +758,9 @@ class ObjectHandler(osmium.SimpleHandler):
                     obj.apply_default_tag(a)
 
     def assign_activities(self):
-        for obj in helpers.progressBar(
-            self.objects, prefix="Progress:", suffix="Complete", length=50
-        ):
+        for obj in self._progress(self.objects, "assign_activities"):
             obj.assign_activities(self.activity_config)
+        self._activity_index = None
 
     def fill_missing_activities(
         self,
@@ -386,6 +779,11 @@ class ObjectHandler(osmium.SimpleHandler):
 
         An example of such missing objects would be missing home facilities in a residential area.
         Empty areas are filled with new objects of given size based on the user-defined fill method.
+        Whether an area is empty is decided for all areas before any are filled,
+        so new objects only count towards overlapping areas in later calls.
+        New objects are given IDs derived from the ID of the area they fill (`fill_<area ID>_<n>`),
+        so IDs do not depend on the order in which areas are processed.
+        If the handler has more than one worker, areas are filled in parallel.
 
         Args:
             area_tags (tuple, optional):
@@ -417,139 +815,460 @@ class ObjectHandler(osmium.SimpleHandler):
         Returns:
             tuple[int, int]: A tuple of two ints representing number of empty zones, number of new objects
         """
-        empty_zones = 0  # counter for fill zones
-        i = 0  # counter for object id
         new_osm_tags = [OSMTag(key=k, value=v) for k, v in area_tags]
         new_tags = [OSMTag(key=k, value=v) for k, v in new_tags]
         if not isinstance(required_acts, list):
             required_acts = [required_acts]
 
+        candidates = [
+            n
+            for n, target_area in enumerate(self.areas)
+            if helpers.tag_match(a=area_tags, b=target_area.activity_tags)
+        ]
+
         if fill_method == "point_source":
             if point_source is None:
                 raise ValueError(
                     "Missing activity fill method expects a path to a point source geospatial data file, received None"
                 )
-            gdf_point_source = helpers.read_geofile(point_source).to_crs(self.crs)
-
-        for target_area in helpers.progressBar(
-            self.areas, prefix="Progress:", suffix="Complete", length=50
-        ):
-            geom = target_area.geom
-            if not helpers.tag_match(a=area_tags, b=target_area.activity_tags):
-                continue
-
-            area_of_acts_in_target = self._required_activities_in_target(
-                required_acts, geom, size
+            candidate_points = self._point_source_in_areas(
+                point_source, [self.areas.objects[n] for n in candidates]
             )
-            if area_of_acts_in_target / geom.area > max_existing_acts_fraction:
-                continue
 
-            empty_zones += 1  # increment another empty zone
+        coverage = self._required_activities_coverage(required_acts, size).to_dict()
 
-            # sample a grid
+        fill_jobs = []
+        for n, area_idx in enumerate(candidates):
+            target_area = self.areas.objects[area_idx]
+            area_of_acts_in_target = coverage.get(area_idx, 0)
+            if (
+                area_of_acts_in_target / target_area.geom.area
+                > max_existing_acts_fraction
+            ):
+                continue
             if fill_method == "spacing":
-                points = helpers.area_grid(area=geom, spacing=spacing)
+                points = None
             elif fill_method == "point_source":
-                available_points = gdf_point_source[
-                    gdf_point_source.intersects(geom)
-                ].geometry
-                points = [i for i in zip(available_points.x, available_points.y, strict=False)]
-            for point in points:  # add objects built from grid
-                self.objects.auto_insert(
-                    helpers.fill_object(
-                        i, point, size, new_osm_tags, new_tags, required_acts
-                    )
-                )
-                i += 1
+                points = candidate_points.get(n, (np.empty(0), np.empty(0)))
+            fill_jobs.append((target_area, points, self._fill_counts[target_area.idx]))
+
+        def _fill(job):
+            target_area, points, start = job
+            if points is None:  # sample a grid
+                points = helpers.area_grid_xy(area=target_area.geom, spacing=spacing)
+            xs, ys = points
+            return helpers.fill_objects(
+                target_area.idx,
+                xs,
+                ys,
+                size,
+                new_osm_tags,
+                new_tags,
+                required_acts,
+                start,
+            )
+
+        new_objects = []
+        for (target_area, _, _), objects in zip(
+            self._progress(fill_jobs, "fill"),
+            self._map(_fill, fill_jobs),
+            strict=True,
+        ):
+            self._fill_counts[target_area.idx] += len(objects)
+            new_objects.extend(objects)
+        self.objects.extend(new_objects)
 
-        return empty_zones, i
+        return len(fill_jobs), len(new_objects)
 
-    def _required_activities_in_target(
-        self, required_activities: list[str], target: Polygon, size: tuple[float, float]
-    ) -> float:
-        """Get total area occupied by existing required activities in target area.
+    def _map(self, func, items):
+        """Apply a function to each item, using a thread pool if the handler has more than one worker.
+
+        Results are yielded in the same order as the items.
+        """
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(func, item) for item in items]
+                for future in futures:
+                    yield future.result()
+        else:
+            for item in items:
+                yield func(item)
 
-        If necessary, create activity polygons from points using infill polygon size.
+    def _point_source_in_areas(
+        self, point_source: str, areas: list[OSMObject]
+    ) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+        """Find the point source data points that fall within each of the given areas.
+
+        Only points within the extent of the areas are loaded from the point source data file.
+        Points are then matched to areas with a single spatial join.
 
         Args:
-            required_activities (list[str]): Activities whose geometries will be kept.
-            target (Polygon): Target area in which to find activities.
-            size (tuple[float, float]): Assumed size of geometries if only available as points.
+            point_source (str): Path to geospatial data file (that can be loaded by GeoPandas) containing point source data.
+            areas (list[OSMObject]): Areas in which to find points.
 
         Returns:
-            float: Total area occupied by existing required activities in target area.
+            dict[int, tuple[np.ndarray, np.ndarray]]:
+                x and y coordinates of the points in each area, keyed by the position of the area in `areas`.
+                Areas containing no points are not included.
         """
-        found_activities = self._activities_from_area_intersection(target, size)
-        relevant_activity_area = sum(
-            v for k, v in found_activities.items() if k in required_activities
+        if not areas:
+            return {}
+        gdf_areas = gp.GeoDataFrame(geometry=[a.geom for a in areas], crs=self.crs)
+        extent = gp.GeoSeries([box(*gdf_areas.total_bounds)], crs=self.crs)
+        gdf_point_source = helpers.read_geofile(point_source, mask=extent).to_crs(
+            self.crs
+        )
+        gdf_point_source = gdf_point_source.reset_index(drop=True)
+
+        joined = gp.sjoin(
+            gdf_point_source, gdf_areas, how="inner", predicate="intersects"
         )
-        return relevant_activity_area
+        joined = (
+            joined.rename_axis("point")
+            .reset_index()
+            .sort_values(["index_right", "point"])
+        )
+        xs = joined.geometry.x.to_numpy()
+        ys = joined.geometry.y.to_numpy()
+        area_positions, starts = np.unique(
+            joined["index_right"].to_numpy(), return_index=True
+        )
+        ends = np.append(starts[1:], len(joined))
+        return {
+            int(n): (xs[start:end], ys[start:end])
+            for n, start, end in zip(area_positions, starts, ends, strict=True)
+        }
 
-    def _activities_from_area_intersection(
-        self, target: Polygon, default_size: tuple[float, float]
-    ) -> dict[str, float]:
-        """Calculate footprint of all facilities matching an activity in a target area.
+    def _required_activities_coverage(
+        self, required_activities: list[str], default_size: tuple[float, float]
+    ) -> pd.Series:
+        """Get total area occupied by existing required activities in each of the handler areas.
+
+        Coverage of all areas by all activities is computed once and shared between calls.
+        It is only updated for objects that have been added to the handler since the previous call.
 
         Args:
-            target (Polygon): Target area in which to find facilities.
+            required_activities (list[str]): Activities whose footprints will be kept.
             default_size (tuple[float, float]): x, y dimensions of a default facility polygon, to infill any point activities.
 
         Returns:
-            dict[str, float]: Total area footprint of each activity in target area.
+            pd.Series: Total area occupied by existing required activities, indexed by area position in `self.areas`.
+                Areas without any required activities are not included.
         """
-        objects = self.objects.intersection(target.bounds)
-        objects = [o for o in objects if target.contains(o.geom)]
-        activity_polys = defaultdict(float)
-        default_area = np.prod(default_size)
-        for object in objects:
-            obj_area = object.geom.area
-            if obj_area == 0:
-                obj_area = default_area
-            for act in object.activities:
-                activity_polys[act] += obj_area
-        return activity_polys
+        n_areas, n_objects = self._coverage_counts
+        if n_areas != len(self.areas):
+            self._coverage = self._activity_coverage(
+                self.areas.objects, self.objects.objects
+            )
+        elif n_objects < len(self.objects):
+            new_coverage = self._activity_coverage(
+                self.areas.objects, self.objects.objects[n_objects:]
+            )
+            self._coverage = (
+                pd.concat([self._coverage, new_coverage])
+                .groupby(["target", "activity"], as_index=False)
+                .sum()
+            )
+        self._coverage_counts = (len(self.areas), len(self.objects))
 
-    def add_features(self):
-        """["units", "floors", "area", "floor_area"]
+        coverage = self._coverage[self._coverage["activity"].isin(required_activities)]
+        footprint = coverage["area"] + coverage["points"] * np.prod(default_size)
+        return footprint.groupby(coverage["target"]).sum()
+
+    @staticmethod
+    def _activity_coverage(targets: list, objects: list) -> pd.DataFrame:
+        """Find the objects contained by each target area and sum their footprint per activity.
+
+        Objects are matched to targets with a single spatial join.
+        Point objects have no footprint of their own, so they are counted separately.
+
+        Args:
+            targets (list): Target areas, either as geometries or objects with a `geom` attribute.
+            objects (list[Object]): Objects to find in the target areas.
+
+        Returns:
+            pd.DataFrame:
+                Table with one row per target and activity, giving the target position in `targets` ("target"),
+                the activity ("activity"), the total area of contained polygon objects ("area")
+                and the number of contained point objects ("points").
         """
-        for obj in helpers.progressBar(
-            self.objects, prefix="Progress:", suffix="Complete", length=50
-        ):
+        columns = ["target", "activity", "area", "points"]
+        if not len(targets) or not len(objects):
+            return pd.DataFrame(columns=columns).astype({"area": float, "points": int})
+        gdf_targets = gp.GeoDataFrame(geometry=[getattr(t, "geom", t) for t in targets])
+        object_geoms = gp.GeoSeries([o.geom for o in objects])
+        gdf_objects = gp.GeoDataFrame(
+            {
+                "activity": [o.activities or [] for o in objects],
+                "area": object_geoms.area,
+                "points": (object_geoms.area == 0).astype(int),
+            },
+            geometry=object_geoms,
+        )
+        joined = gp.sjoin(gdf_targets, gdf_objects, how="inner", predicate="contains")
+        joined = joined.rename_axis("target").reset_index()
+        joined = joined.explode("activity").dropna(subset=["activity"])
+        joined.loc[joined["points"] == 1, "area"] = 0.0
+        return joined.groupby(["target", "activity"], as_index=False)[
+            ["area", "points"]
+        ].sum()
+
+    def add_features(self):
+        """["units", "floors", "area", "floor_area"]"""
+        for obj in self._progress(self.objects, "features"):
             obj.add_features(self.object_features)
 
     def assign_nearest_distance(self, target_act):
-        """For each facility, calculate euclidean distance to targets of given activity type.
-        """
+        """For each facility, calculate euclidean distance to targets of given activity type."""
         targets = self.extract_targets(target_act)
-        for obj in helpers.progressBar(
-            self.objects, prefix="Progress:", suffix="Complete", length=50
-        ):
+        for obj in self._progress(self.objects, "distances"):
             obj.get_closest_distance(targets, target_act)
 
     def extract_targets(self, target_act):
-        """Find targets
+        """Find targets"""
+        targets = [obj for obj in self.objects if target_act in obj.activities]
+        return MultiPoint(list(self.centroid_points(targets)))
+
+    def activity_index(self) -> dict[str, np.ndarray]:
+        """Get an inverted index of object activities, giving the positions in `self.objects` of objects with each activity.
+
+        The index is built on first use and rebuilt if activities are assigned or objects are added or re-indexed.
+
+        Returns:
+            dict[str, np.ndarray]: Sorted object positions, keyed by activity.
         """
-        targets = []
-        for obj in self.objects:
-            if target_act in obj.activities:
-                targets.append(obj.geom.centroid)
-        return MultiPoint(targets)
+        key = (id(self.objects), len(self.objects))
+        if self._activity_index is None or self._activity_index_key != key:
+            positions = defaultdict(list)
+            for n, obj in enumerate(self.objects.objects):
+                for act in obj.activities or []:
+                    positions[act].append(n)
+            self._activity_index = {
+                act: np.array(rows, dtype=np.int64) for act, rows in positions.items()
+            }
+            self._activity_index_key = key
+        return self._activity_index
 
-    def geodataframe(self, single_use=False):
+    def query(
+        self,
+        bbox: tuple[float, float, float, float] | None = None,
+        point: tuple[float, float] | None = None,
+        within: float | None = None,
+        activities: str | list[str] | None = None,
+        nearest: int | None = None,
+        as_arrow: bool = False,
+    ) -> list[Object] | pa.Table:
+        """Find objects by location and activity, using the object index and an activity index (see `activity_index`).
+
+        Objects are located by their centroids, in the handler CRS.
+        Only objects matching all of the given conditions are returned.
+        Without `nearest`, objects are returned in the order of `self.objects`.
+
+        Example:
+            >>> handler.query(point=(529500, 181500), within=1000, activities=["shop"], nearest=5)
 
-        if single_use:
-            df = pd.DataFrame(
+        Args:
+            bbox (tuple[float, float, float, float] | None, optional):
+                Only find objects within these (minx, miny, maxx, maxy) bounds. Defaults to None.
+            point (tuple[float, float] | None, optional):
+                (x, y) coordinates of a point, to find objects within a distance of, or nearest to. Defaults to None.
+            within (float | None, optional): Only find objects within this distance of `point`. Defaults to None.
+            activities (str | list[str] | None, optional): Only find objects with any of these activities.
+                Defaults to None.
+            nearest (int | None, optional): Only find this many objects, nearest to `point` first. Defaults to None.
+            as_arrow (bool, optional):
+                If True, return found objects as an arrow table, as for `to_arrow`. Defaults to False.
 
-                    summary
-                    for o in self.objects
-                    for summary in o.single_activity_summaries()
+        Raises:
+            ValueError: If `within` or `nearest` is given without a `point`.
 
+        Returns:
+            list[Object] | pa.Table: Found objects.
+        """
+        if point is None and (within is not None or nearest is not None):
+            raise ValueError(
+                "Querying objects within a distance or nearest requires a point"
+            )
+        bounds = [bbox] if bbox is not None else []
+        if within is not None:
+            x, y = point
+            bounds.append((x - within, y - within, x + within, y + within))
+
+        positions = None
+        if activities is not None:
+            index = self.activity_index()
+            if isinstance(activities, str):
+                activities = [activities]
+            positions = np.unique(
+                np.concatenate(
+                    [index.get(act, np.empty(0, dtype=np.int64)) for act in activities]
+                )
+            )
+        if bounds:
+            # only objects whose indexed bounds (e.g. of polygons) intersect all query bounds can have centroids in them
+            minx, miny = np.max([b[:2] for b in bounds], axis=0)
+            maxx, maxy = np.min([b[2:] for b in bounds], axis=0)
+            candidates = (
+                np.sort(self.objects.intersection_ids((minx, miny, maxx, maxy)))
+                if minx <= maxx and miny <= maxy
+                else np.empty(0, dtype=np.int64)
             )
-            return gp.GeoDataFrame(df, geometry="geometry", crs=self.crs)
+            positions = (
+                candidates
+                if positions is None
+                else np.intersect1d(positions, candidates)
+            )
+        elif nearest is not None and positions is None:
+            positions = self._nearest_candidates(point, nearest)
+        elif positions is None:
+            positions = np.arange(len(self.objects))
+
+        objects = [self.objects.objects[n] for n in positions]
+        centroids = self.centroid_points(objects)
+        xs, ys = shapely.get_x(centroids), shapely.get_y(centroids)
+        keep = np.ones(len(objects), dtype=bool)
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            keep &= (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+        if point is not None:
+            distances = np.hypot(xs - point[0], ys - point[1])
+            if within is not None:
+                keep &= distances <= within
+        rows = np.flatnonzero(keep)
+        if nearest is not None:
+            rows = rows[np.argsort(distances[rows], kind="stable")[:nearest]]
+        objects = [objects[n] for n in rows]
+
+        if not as_arrow:
+            return objects
+        from osmox import writers
+
+        schema = writers.output_schema(
+            writers.feature_schema(self, max(len(objects), 1), objects=objects),
+            self.crs,
+        )
+        return pa.Table.from_batches(
+            [writers.record_batch(self.columns(objects), schema)]
+        )
 
-        df = pd.DataFrame(o.summary() for o in self.objects)
+    def _nearest_candidates(self, point: tuple[float, float], k: int) -> np.ndarray:
+        """Positions of objects which may be among the `k` with centroids nearest to a point.
+
+        The object index gives the objects with the nearest bounds, which are not always those with the nearest
+        centroids (e.g. for large polygons).
+        But objects with centroids nearer than the k-th of those must have bounds within that distance of the point.
+        """
+        if k < 1:
+            return np.empty(0, dtype=np.int64)
+        x, y = point
+        nearest = self.objects.nearest_ids((x, y, x, y), k)
+        if not len(nearest):
+            return nearest
+        centroids = self.centroid_points([self.objects.objects[n] for n in nearest])
+        radius = np.sort(shapely.distance(centroids, shapely.Point(x, y)))[:k][-1]
+        return np.sort(
+            self.objects.intersection_ids(
+                (x - radius, y - radius, x + radius, y + radius)
+            )
+        )
+
+    def columns(self, objects=None) -> dict:
+        """Get object IDs, activities, centroids and features as columns.
+
+        Args:
+            objects (list[Object], optional): Objects to get columns for. Defaults to None, i.e. all handler objects.
+
+        Returns:
+            dict: Columns keyed by name: "id" (str), "activities" (list of str), "geometry" (centroids) and one column per feature.
+        """
+        if objects is None:
+            objects = self.objects.objects
+        feature_names = dict.fromkeys(name for o in objects for name in o.features)
+        return {
+            "id": np.array([str(o.idx) for o in objects], dtype=object),
+            "activities": [o.activities for o in objects],
+            "geometry": self.centroid_points(objects),
+            **{name: [o.features.get(name) for o in objects] for name in feature_names},
+        }
+
+    def geodataframe(self, single_use=False):
+        columns = self.columns()
+        activities = pd.Series(columns.pop("activities"), dtype=object)
+        if single_use:
+            df = pd.DataFrame(
+                {"id": columns.pop("id"), "activity": activities, **columns}
+            )
+            df = (
+                df.explode("activity")
+                .dropna(subset=["activity"])
+                .reset_index(drop=True)
+            )
+        else:
+            df = pd.DataFrame(
+                {
+                    "id": columns.pop("id"),
+                    "activities": activities.str.join(","),
+                    **columns,
+                }
+            )
         return gp.GeoDataFrame(df, geometry="geometry", crs=self.crs)
 
+    def to_arrow(
+        self,
+        single_use: bool = False,
+        crs: str | None = None,
+        geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+    ) -> pa.Table:
+        """Get objects as an arrow table, without converting them to a (Geo)DataFrame.
+
+        The geometry column is tagged with its GeoArrow extension type and CRS,
+        so that GeoArrow-aware consumers (e.g. DuckDB spatial, GeoPandas >= 1.0 `from_arrow`) recognise it.
+
+        Args:
+            single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+            crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+            geometry_encoding (Literal["WKB", "geoarrow"], optional):
+                Geometry column encoding: well-known binary, or GeoArrow native points (a struct of x and y coordinates).
+                Defaults to "WKB".
+
+        Returns:
+            pa.Table: Object table, with one column per object feature.
+        """
+        return self.to_arrow_batches(
+            single_use=single_use, crs=crs, geometry_encoding=geometry_encoding
+        ).read_all()
+
+    def to_arrow_batches(
+        self,
+        single_use: bool = False,
+        crs: str | None = None,
+        geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+        batch_size: int = 100_000,
+    ) -> pa.RecordBatchReader:
+        """Get objects as a stream of arrow record batches, for consumers that process data incrementally.
+
+        Each batch is only built as it is read, so at most one batch of attribute data is held in memory at a time.
+        See `to_arrow` for details.
+
+        Args:
+            single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+            crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+            geometry_encoding (Literal["WKB", "geoarrow"], optional): Geometry column encoding. Defaults to "WKB".
+            batch_size (int, optional): Maximum number of objects per record batch. Defaults to 100_000.
+
+        Returns:
+            pa.RecordBatchReader: Record batch stream, which can be iterated over or read all at once.
+        """
+        from osmox import writers
+
+        return writers.record_batch_reader(
+            self,
+            crs=crs,
+            single_use=single_use,
+            batch_size=batch_size,
+            geometry_encoding=geometry_encoding,
+        )
+
     # def extract(self):
     #     df = pd.DataFrame.from_records(
     #         ((b.idx, b.geom.centroid) for b in self.objects),
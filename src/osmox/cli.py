@@ -2,10 +2,9 @@ import logging
 import os
 
 import click
-import pyproj
 
-from osmox import build, config
-from osmox.helpers import PathPath
+from osmox import config
+from osmox.click_types import PathPath
 
 default_config_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "../configs/config.json")
@@ -30,47 +29,209 @@ def cli():
 def validate(config_path):
     """Validate a config.
     """
-    cnfg = config.load(config_path)
+    cnfg = config.load_compiled(config_path)
     config.validate_activity_config(cnfg)
     logger.warning("Done.")
 
 
+# options of a single OSMOX job, shared by commands which run jobs
+JOB_OPTIONS = [
+    click.option(
+        "-f",
+        "--format",
+        type=click.Choice(["geojson", "geopackage", "flatgeobuf", "geoparquet"]),
+        default="geopackage",
+        help="Output file format (default: geopackage)",
+    ),
+    click.option(
+        "-crs",
+        "--crs",
+        type=str,
+        multiple=True,
+        default=["epsg:27700"],
+        help="crs string eg (default): 'epsg:27700' (UK grid). "
+        "Objects are processed in the first given crs. "
+        "Give this option more than once to write outputs in additional crs (an output in 'epsg:4326' is always written).",
+    ),
+    click.option(
+        "-s",
+        "--single_use",
+        is_flag=True,
+        help="split multi-activity facilities into multiple single-activity facilities",
+    ),
+    click.option(
+        "-l",
+        "--lazy",
+        is_flag=True,
+        help="if filtered object already has a label, do not search for more (supresses multi-use)",
+    ),
+    click.option(
+        "-w",
+        "--workers",
+        type=click.IntRange(min=1),
+        default=1,
+        help="number of threads to use for activity infilling (default: 1)",
+    ),
+    click.option(
+        "--geometry-storage",
+        type=click.Choice(["shapely", "float64", "float32"]),
+        default="shapely",
+        help="how to store object centroids once polygons are no longer needed: as shapely points, "
+        "or in compact arrays of float64 or float32 coordinates, which take far less memory (default: shapely)",
+    ),
+    click.option(
+        "--geometry-precision",
+        type=click.FloatRange(min=0, min_open=True),
+        default=None,
+        help="snap object centroids to a grid of this size, in units of the first crs, "
+        "once polygons are no longer needed (default: no snapping)",
+    ),
+    click.option(
+        "--id-column",
+        default="id",
+        help="name of the OSM ID column, if reading from geoparquet (default: id)",
+    ),
+    click.option(
+        "--tags-column",
+        default="tags",
+        help="name of the OSM tags (map) column, if reading from geoparquet (default: tags)",
+    ),
+    click.option(
+        "--sort",
+        type=click.Choice(["hilbert", "zorder"]),
+        default=None,
+        help="sort objects along a space-filling curve after reading the input, "
+        "so that nearby objects are processed and written together",
+    ),
+    click.option(
+        "--batch-size",
+        "--row-group-size",
+        "batch_size",
+        type=click.IntRange(min=1),
+        default=100_000,
+        help="maximum number of objects read or written at a time, i.e. per row group if writing to geoparquet (default: 100000)",
+    ),
+    click.option(
+        "--compression",
+        type=click.Choice(["zstd", "snappy", "gzip", "none"]),
+        default="snappy",
+        help="compression codec, if writing to geoparquet (default: snappy)",
+    ),
+    click.option(
+        "--bbox-covering",
+        is_flag=True,
+        help="add a bounding box column to geoparquet output, so readers can filter row groups spatially",
+    ),
+    click.option(
+        "--spatial-index/--no-spatial-index",
+        default=True,
+        help="build a spatial index, if writing to geopackage or flatgeobuf (default: build index)",
+    ),
+    click.option(
+        "--engine",
+        type=click.Choice(["auto", "pyogrio", "fiona"]),
+        default="auto",
+        help="engine to write geojson, geopackage and flatgeobuf outputs with. "
+        "'auto' streams with pyogrio if it is installed, and otherwise writes with GeoPandas' default engine (default: auto)",
+    ),
+    click.option(
+        "--partition-by",
+        type=click.Choice(["activity", "quadkey"]),
+        multiple=True,
+        help="write geoparquet output as a hive-partitioned dataset directory, partitioned by object activity "
+        "and/or web mercator tile quadkey. Give this option more than once to partition by more than one key",
+    ),
+    click.option(
+        "--quadkey-zoom",
+        type=click.IntRange(min=1, max=23),
+        default=10,
+        help="tile zoom level of quadkey partitions (default: 10)",
+    ),
+    click.option(
+        "--facility-index",
+        is_flag=True,
+        help="also write a facility index ('<OUTPUT_NAME>_<crs>.index' directory) next to each output, "
+        "for fast bounding box and nearest facility queries with 'osmox.facilities.FacilityIndex'",
+    ),
+]
+
+
+def job_options(func):
+    """Add the options of a single OSMOX job (see `runner.JOB_DEFAULTS`) to a command."""
+    for option in reversed(JOB_OPTIONS):
+        func = option(func)
+    return func
+
+
 @cli.command()
 @click.argument("config_path", type=PathPath(exists=True), nargs=1, required=True)
 @click.argument("input_path", type=PathPath(exists=True), nargs=1, required=True)
 @click.argument("output_name", nargs=1, required=True)
+@job_options
 @click.option(
-    "-f",
-    "--format",
-    type=click.Choice(["geojson", "geopackage", "geoparquet"]),
-    default="geopackage",
-    help="Output file format (default: geopackage)",
+    "--memory-limit",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="keep memory use to about this many MB, by spilling the input to disk next to the outputs "
+    "and processing it in spatial chunks if it does not fit (default: no limit)",
 )
 @click.option(
-    "-crs",
-    "--crs",
-    type=str,
-    default="epsg:27700",
-    help="crs string eg (default): 'epsg:27700' (UK grid)",
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="write a JSON report of the wall time, CPU time, memory use and throughput of each stage to this path",
 )
 @click.option(
-    "-s",
-    "--single_use",
-    is_flag=True,
-    help="split multi-activity facilities into multiple single-activity facilities",
+    "--profile-memory/--no-profile-memory",
+    default=False,
+    help="trace Python memory allocations when profiling, which slows the run down (default: do not trace)",
 )
 @click.option(
-    "-l",
-    "--lazy",
-    is_flag=True,
-    help="if filtered object already has a label, do not search for more (supresses multi-use)",
+    "--cprofile-dir",
+    type=click.Path(file_okay=False, writable=True),
+    default=None,
+    help="dump cProfile statistics of each stage to '<stage>.prof' files in this directory",
 )
-def run(config_path, input_path, output_name, format, crs, single_use, lazy):
+def run(
+    config_path,
+    input_path,
+    output_name,
+    format,
+    crs,
+    single_use,
+    lazy,
+    workers,
+    geometry_storage,
+    geometry_precision,
+    id_column,
+    tags_column,
+    sort,
+    batch_size,
+    compression,
+    bbox_covering,
+    spatial_index,
+    engine,
+    partition_by,
+    quadkey_zoom,
+    facility_index,
+    memory_limit,
+    profile,
+    profile_memory,
+    cprofile_dir,
+):
+    # imported here so that other commands don't pay for importing geopandas, osmium, etc.
+    from osmox import build, profiling, runner
+
+    if partition_by and format != "geoparquet":
+        raise click.BadParameter(
+            "partitioned output requires '-f geoparquet'", param_hint="'--partition-by'"
+        )
+
     logger.info(f" Loading config from {config_path}")
-    cnfg = config.load(config_path)
+    cnfg = config.load_compiled(config_path)
     config.validate_activity_config(cnfg)
 
-    logger.info(f"Creating handler with crs: {crs}.")
+    logger.info(f"Creating handler with crs: {crs[0]}.")
     if single_use:
         logger.info("Handler is single-use, activities will get unique locations.")
     if lazy:
@@ -78,62 +239,267 @@ def run(config_path, input_path, output_name, format, crs, single_use, lazy):
             "Handler will be using lazy assignment, this may suppress some multi-use."
         )
 
-    handler = build.ObjectHandler(config=cnfg, crs=crs, lazy=lazy)
-    logger.info(
-        f" Filtering all objects found in {input_path}. This may take a long while."
+    profiler = profiling.Profiler(
+        enabled=bool(profile or cprofile_dir),
+        trace_memory=profile_memory,
+        cprofile_dir=cprofile_dir,
     )
-    handler.apply_file(str(input_path), locations=True, idx="flex_mem")
-    logger.info(f" Found {len(handler.objects)} buildings.")
-    logger.info(f" Found {len(handler.points)} nodes with valid tags.")
-    logger.info(f" Found {len(handler.areas)} areas with valid tags.")
-
-    logger.info(" Assigning object tags.")
-    handler.assign_tags()
-    logger.info(f" Finished assigning tags: f{handler.log}.")
-
-    logger.info(" Assigning object activities.")
-    handler.assign_activities()
-
-    if cnfg.get("fill_missing_activities"):
-        for group in cnfg["fill_missing_activities"]:
-            logger.info(f" Filling missing activities: {group}.")
-            zones, objects = handler.fill_missing_activities(**group)
-            logger.info(f" Filled {zones} zones with {objects} objects.")
-
-    if cnfg.get("object_features"):
-        logger.info(f" Assigning object features: {cnfg['object_features']}.")
-        handler.add_features()
-
-    if "distance_to_nearest" in cnfg:
-        for target_activity in cnfg["distance_to_nearest"]:
-            logger.info(f" Assigning distances to nearest {target_activity}.")
-            handler.assign_nearest_distance(target_activity)
-
-    gdf = handler.geodataframe(single_use=single_use)
-
-    if format == "geojson":
-        extension = "geojson"
-        writer_method = "to_file"
-        kwargs = {"driver": "GeoJSON"}
-    elif format == "geopackage":
-        extension = "gpkg"
-        writer_method = "to_file"
-        kwargs = {"driver": "GPKG"}
-    elif format == "geoparquet":
-        extension = "parquet"
-        writer_method = "to_parquet"
-        kwargs = {}
-
-    logger.info(f" Writing objects to {format} format.")
-    output_filename = f"{output_name}_{crs.replace(':', '_')}.{extension}"
-
-    getattr(gdf, writer_method)(output_filename, **kwargs)
-
-    if pyproj.CRS(crs) != pyproj.CRS("epsg:4326"):
-        logger.info(" Reprojecting additional output to EPSG:4326 (lat lon)")
-        gdf_4326 = gdf.to_crs("epsg:4326")
-        getattr(gdf_4326, writer_method)(
-            f"{output_name}_epsg_4326.{extension}", **kwargs
+    profiler.metadata["input_path"] = str(input_path)
+    profiler.metadata["config_path"] = str(config_path)
+    profiler.metadata["workers"] = workers
+
+    if memory_limit is not None:
+        from osmox import spill
+
+        logger.info(f" Running within a memory limit of {memory_limit}MB.")
+        try:
+            spill.run_out_of_core(
+                config_path,
+                input_path,
+                output_name,
+                memory_limit,
+                profiler=profiler,
+                format=format,
+                crs=crs,
+                single_use=single_use,
+                lazy=lazy,
+                workers=workers,
+                geometry_storage=geometry_storage,
+                geometry_precision=geometry_precision,
+                id_column=id_column,
+                tags_column=tags_column,
+                sort=sort,
+                batch_size=batch_size,
+                compression=compression,
+                bbox_covering=bbox_covering,
+                spatial_index=spatial_index,
+                engine=engine,
+                partition_by=partition_by,
+                quadkey_zoom=quadkey_zoom,
+                facility_index=facility_index,
+            )
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint="'--memory-limit'") from err
+    else:
+        handler = build.ObjectHandler(
+            config=cnfg,
+            crs=crs[0],
+            lazy=lazy,
+            workers=workers,
+            geometry_storage=geometry_storage,
+            geometry_precision=geometry_precision,
         )
+        runner.parse_input(
+            handler,
+            input_path,
+            id_column=id_column,
+            tags_column=tags_column,
+            batch_size=batch_size,
+            profiler=profiler,
+        )
+        runner.process(
+            handler,
+            output_name,
+            format=format,
+            crs=crs,
+            single_use=single_use,
+            sort=sort,
+            batch_size=batch_size,
+            compression=compression,
+            bbox_covering=bbox_covering,
+            spatial_index=spatial_index,
+            engine=engine,
+            partition_by=partition_by,
+            quadkey_zoom=quadkey_zoom,
+            facility_index=facility_index,
+            profiler=profiler,
+        )
+
+    if profile:
+        profiler.write(profile)
+
+    logger.info("Done.")
+
+
+@cli.command()
+@click.argument(
+    "manifest_path", type=PathPath(exists=True, dir_okay=False), nargs=1, required=True
+)
+@click.option(
+    "-p",
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="number of processes to run jobs in (default: 1)",
+)
+def batch(manifest_path, processes):
+    """Run many OSMOX jobs listed in a JSON manifest.
 
+    Jobs which share an input only parse it once.
+    """
+    from osmox import runner
+
+    try:
+        jobs = runner.load_manifest(manifest_path)
+    except (KeyError, ValueError) as err:
+        raise click.BadParameter(str(err), param_hint="'MANIFEST_PATH'") from err
+    logger.info(f" Running {len(jobs)} jobs in {processes} processes.")
+    runner.run_batch(jobs, processes=processes)
     logger.info("Done.")
+
+
+@cli.group()
+def tiles():
+    """Run OSMOX on a grid of tiles, which can be run as independent jobs, then merge the outputs."""
+    pass
+
+
+@tiles.command("plan")
+@click.argument("config_path", type=PathPath(exists=True), nargs=1, required=True)
+@click.argument("input_path", type=PathPath(exists=True), nargs=1, required=True)
+@click.argument("output_name", nargs=1, required=True)
+@click.option(
+    "--tile-size",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    help="tile width and height, in degrees (default: 1)",
+)
+@click.option(
+    "--halo",
+    type=click.FloatRange(min=0),
+    default=5000.0,
+    help="minimum width of the overlap around each tile, in metres. "
+    "Should be wider than the largest OSM objects and areas (default: 5000)",
+)
+@click.option(
+    "--bounds",
+    type=(float, float, float, float),
+    default=None,
+    help="longitude and latitude bounds to tile, as 'MIN_LON MIN_LAT MAX_LON MAX_LAT' (default: input bounds)",
+)
+@job_options
+def tiles_plan(
+    config_path, input_path, output_name, tile_size, halo, bounds, **options
+):
+    """Plan a tiled run, writing the plan to '<OUTPUT_NAME>_tiles/plan.json'."""
+    from osmox import tiling
+
+    if options["partition_by"] and options["format"] != "geoparquet":
+        raise click.BadParameter(
+            "partitioned output requires '-f geoparquet'", param_hint="'--partition-by'"
+        )
+    config.validate_activity_config(config.load_compiled(config_path))
+    plan = tiling.plan_tiles(
+        config_path,
+        input_path,
+        output_name,
+        tile_size=tile_size,
+        halo=halo,
+        bounds=bounds,
+        **options,
+    )
+    path = tiling.write_plan(plan)
+    logger.warning(f" Written plan of {len(plan['tiles'])} tiles to {path}.")
+
+
+@tiles.command("run")
+@click.argument(
+    "plan_path", type=PathPath(exists=True, dir_okay=False), nargs=1, required=True
+)
+@click.option(
+    "-t",
+    "--tile",
+    "names",
+    multiple=True,
+    help="name of a tile to run. Give this option more than once to run more than one tile (default: all tiles)",
+)
+@click.option(
+    "-p",
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="number of processes to run tiles in (default: 1)",
+)
+def tiles_run(plan_path, names, processes):
+    """Run tiles of a tiled run plan."""
+    from osmox import tiling
+
+    plan = tiling.load_plan(plan_path)
+    unknown = set(names).difference(tiling.tiles(plan))
+    if unknown:
+        raise click.BadParameter(
+            f"unknown tiles: {sorted(unknown)}", param_hint="'--tile'"
+        )
+    tiling.run_tiles(plan, names=names or None, processes=processes)
+    logger.info("Done.")
+
+
+@tiles.command("merge")
+@click.argument(
+    "plan_path", type=PathPath(exists=True, dir_okay=False), nargs=1, required=True
+)
+def tiles_merge(plan_path):
+    """Merge the outputs of all tiles of a tiled run plan."""
+    from osmox import tiling
+
+    plan = tiling.load_plan(plan_path)
+    try:
+        tiling.merge_tiles(plan)
+    except FileNotFoundError as err:
+        raise click.ClickException(str(err)) from err
+    logger.info("Done.")
+
+
+@cli.command()
+@click.argument("path", type=PathPath(exists=True), nargs=1, required=True)
+@click.option(
+    "--host",
+    default="127.0.0.1",
+    help="host to listen on (default: 127.0.0.1, i.e. only local clients)",
+)
+@click.option(
+    "--port",
+    type=click.IntRange(min=0),
+    default=8000,
+    help="port to listen on (default: 8000)",
+)
+@click.option(
+    "--unix-socket",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="listen on a Unix socket at this path, instead of on a host and port",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1024,
+    help="maximum number of queries to run at a time (default: 1024)",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=100_000,
+    help="maximum number of query results to cache (default: 100000)",
+)
+def serve(path, host, port, unix_socket, batch_size, cache_size):
+    """Serve bounding box, radius, nearest and sampling queries of facilities over a local HTTP API.
+
+    PATH is a facility index directory written with '--facility-index', or an output file.
+    """
+    from osmox import serve
+
+    logger.info(f" Loading facilities from {path}")
+    facilities = serve.open_facilities(path)
+    try:
+        serve.serve(
+            facilities,
+            host=host,
+            port=port,
+            unix_socket=unix_socket,
+            batch_size=batch_size,
+            cache_size=cache_size,
+        )
+    except KeyboardInterrupt:
+        logger.info("Stopped.")
+    finally:
+        facilities.close()
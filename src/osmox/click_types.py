@@ -0,0 +1,13 @@
+"""Click parameter types, kept apart from the heavier modules so that the CLI can start up without them."""
+
+from pathlib import Path
+
+import click
+
+
+class PathPath(click.Path):
+    """A Click path argument that returns a pathlib Path, not a string."""
+
+    def convert(self, value, param, ctx):
+        """Convert the value to a path."""
+        return Path(super().convert(value, param, ctx))
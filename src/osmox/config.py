@@ -1,13 +1,40 @@
-import importlib
+import functools
+import hashlib
+import importlib.resources
 import json
 import logging
-
-import jsonschema
+from collections.abc import Mapping
 
 logger = logging.getLogger(__name__)
 SCHEMA_FILE = importlib.resources.files("osmox") / "schema.json"
-with importlib.resources.as_file(SCHEMA_FILE) as f:
-    SCHEMA = json.load(f.open())
+
+
+@functools.cache
+def load_schema() -> dict:
+    """Load the OSMOX config JSON schema, which is only read from file the first time it is needed."""
+    with importlib.resources.as_file(SCHEMA_FILE) as f:
+        return json.loads(f.read_text())
+
+
+def __getattr__(name):
+    # `SCHEMA` is loaded lazily, so importing this module does not read the schema file.
+    if name == "SCHEMA":
+        return load_schema()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@functools.cache
+def load_validator():
+    """Build the OSMOX config JSON schema validator, checking the schema itself the first time it is needed."""
+    import jsonschema
+
+    schema = load_schema()
+    validator = jsonschema.validators.validator_for(schema)
+    # check the schema against a strict copy of its metaschema, leaving the validator class' metaschema untouched
+    validator({**validator.META_SCHEMA, "unevaluatedProperties": False}).validate(
+        schema
+    )
+    return validator(schema)
 
 
 def load(config_path):
@@ -17,10 +44,104 @@ def load(config_path):
 
 
 def validate(config):
-    validator = jsonschema.validators.validator_for(SCHEMA)
-    validator.META_SCHEMA["unevaluatedProperties"] = False
-    validator.check_schema(SCHEMA)
-    jsonschema.validate(config, SCHEMA)
+    import jsonschema
+
+    error = jsonschema.exceptions.best_match(load_validator().iter_errors(dict(config)))
+    if error is not None:
+        raise error
+
+
+class CompiledConfig(Mapping):
+    """Read-only OSMOX config, with the tag keys, tags, activities and tag lookups it configures precomputed.
+
+    Compiled configs are cached by content, so use `compile_config` or `load_compiled` to get one,
+    rather than creating them directly.
+    A compiled config can be used in place of the config dictionary it was compiled from.
+    """
+
+    def __init__(self, config: dict, digest: str):
+        """Precompute tag and activity lookups of a config.
+
+        Args:
+            config (dict): Config, which must not be modified after compiling.
+            digest (str): SHA-256 hash of the config content.
+        """
+        self._config = config
+        self.digest = digest
+        self.valid = False
+        self.filter_keys, self.filter_tags = get_tags(config)
+        self.activities = get_acts(config)
+        # OSM tag key: tag values (or "*" for any value) that are selected by the filter / mapped to activities
+        self.filter_values = {
+            key: values if values == "*" else frozenset(values)
+            for key, values in config.get("filter", {}).items()
+        }
+        self.activity_values = {
+            key: values if values == "*" else frozenset(values)
+            for key, values in config.get("activity_mapping", {}).items()
+        }
+
+    def __getitem__(self, key):
+        """Get a config item."""
+        return self._config[key]
+
+    def __iter__(self):
+        """Iterate over config keys."""
+        return iter(self._config)
+
+    def __len__(self):
+        """Number of config items."""
+        return len(self._config)
+
+    def __repr__(self):
+        """Represent the config by its digest."""
+        return f"CompiledConfig(digest={self.digest!r})"
+
+    def selects(self, tags: dict) -> bool:
+        """Check if any of the given OSM tags are selected by the config filter."""
+        return any(
+            (values := self.filter_values.get(k)) is not None
+            and (values == "*" or v in values)
+            for k, v in tags.items()
+        )
+
+    def mapped_tags(self, tags: dict) -> list[tuple[str, str]]:
+        """Get the (key, value) pairs of the given OSM tags which are mapped to activities by the config."""
+        return [
+            (k, v)
+            for k, v in tags.items()
+            if (values := self.activity_values.get(k)) is not None
+            and (values == "*" or v in values)
+        ]
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(content: str) -> CompiledConfig:
+    return CompiledConfig(
+        json.loads(content), hashlib.sha256(content.encode()).hexdigest()
+    )
+
+
+def compile_config(config: dict | CompiledConfig) -> CompiledConfig:
+    """Compile a config, or get it from the cache if a config with the same content has already been compiled.
+
+    Args:
+        config (dict | CompiledConfig): Config. If already compiled, it is returned as is.
+
+    Returns:
+        CompiledConfig: Compiled config.
+    """
+    if isinstance(config, CompiledConfig):
+        return config
+    return _compile(json.dumps(config, sort_keys=True))
+
+
+def load_compiled(config_path) -> CompiledConfig:
+    """Load and compile a config from file.
+
+    If a config with the same content has already been compiled, it is taken from the cache.
+    """
+    return compile_config(load(config_path))
 
 
 def get_acts(config):
@@ -50,12 +171,49 @@ def get_tags(config):
     return set([]), set([])
 
 
+def union_config(configs) -> dict:
+    """Config whose filter and activity mapping cover all the tags of the given configs.
+
+    A handler with this config can parse an input once, for handlers with any of the given configs to share (see
+    `osmox.build.ObjectHandler.apply_parsed`).
+
+    Args:
+        configs (Iterable[dict | CompiledConfig]): Configs.
+
+    Returns:
+        dict: Union config, which only has `filter`, `activity_mapping`, `object_features` and `default_tags` items.
+    """
+    filter_values = {}
+    activity_mapping = {}
+    for cnfg in configs:
+        for key, values in cnfg.get("filter", {}).items():
+            filter_values.setdefault(key, set()).update(values)
+        for key, mapping in cnfg.get("activity_mapping", {}).items():
+            for value, acts in mapping.items():
+                activity_mapping.setdefault(key, {}).setdefault(value, set()).update(
+                    acts
+                )
+    return {
+        "filter": {key: sorted(values) for key, values in filter_values.items()},
+        "activity_mapping": {
+            key: {value: sorted(acts) for value, acts in mapping.items()}
+            for key, mapping in activity_mapping.items()
+        },
+        "object_features": [],
+        "default_tags": [],
+    }
+
+
 def validate_activity_config(config):
-    validate(config)
-    keys, tags = get_tags(config)
+    if isinstance(config, CompiledConfig):
+        if config.valid:
+            return
+        validate(config)
+        keys, acts = config.filter_keys, config.activities
+    else:
+        validate(config)
+        keys, acts = get_tags(config)[0], get_acts(config)
     logger.info(f"Configured OSM tag keys: {sorted(keys)}")
-
-    acts = get_acts(config)
     logger.info(f"Configured activities: {sorted(acts)}")
 
     if "distance_to_nearest" in config:
@@ -72,3 +230,6 @@ def validate_activity_config(config):
                 raise ValueError(
                     f"'Fill missing activities' group has non-configured activities: {act_diff}"
                 )
+
+    if isinstance(config, CompiledConfig):
+        config.valid = True
@@ -0,0 +1,592 @@
+"""Persisted and in-memory indexes for querying OSMOX output facilities."""
+
+import json
+import logging
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+from rtree import index
+
+logger = logging.getLogger(__name__)
+
+# files of a facility index directory
+OBJECTS_FILE = "objects.arrow"
+TREE_NAME = "objects"  # R-tree files, i.e. `objects.idx` and `objects.dat`
+GRID_FILE = "grid.json"  # origin, cell size and number of columns of the grid used for range queries
+GRID_ROWS_FILE = "grid.npy"  # start of each grid cell in the rows sorted by grid cell, then the sorted rows
+# mean number of facilities per cell of the grid used for range queries (see `FacilityIndex.bbox_rows`)
+CELL_SIZE = 16
+
+
+def _array(values: np.ndarray) -> pa.Array:
+    """Arrow array sharing the memory of a numeric numpy array.
+
+    Unlike `pa.array`, this does not import pandas, which would delay the first query by about half a second.
+    """
+    values = np.ascontiguousarray(values)
+    return pa.Array.from_buffers(
+        pa.from_numpy_dtype(values.dtype), len(values), [None, pa.py_buffer(values)]
+    )
+
+
+def _numpy(values: pa.Array, dtype: type = np.float64) -> np.ndarray:
+    """Numpy view of the values of a numeric arrow array without nulls (e.g. of a memory-mapped file).
+
+    Like `_array`, this avoids `pa.Array.to_numpy`, which imports pandas.
+    """
+    dtype = np.dtype(dtype)
+    return np.frombuffer(
+        values.buffers()[1],
+        dtype=dtype,
+        count=len(values),
+        offset=values.offset * dtype.itemsize,
+    )
+
+
+def _valid(values: pa.Array) -> np.ndarray:
+    """Mask of the values of an arrow array which are not null."""
+    if not values.null_count:
+        return np.ones(len(values), dtype=bool)
+    bits = np.unpackbits(
+        np.frombuffer(values.buffers()[0], dtype=np.uint8), bitorder="little"
+    )
+    return bits[values.offset : values.offset + len(values)].astype(bool)
+
+
+def _grid(x: np.ndarray, y: np.ndarray) -> tuple:
+    """Square grid over facility coordinates, with about `CELL_SIZE` facilities per cell on average.
+
+    Returns:
+        tuple: Grid origin x and y, cell size, number of columns (and rows), start of each cell in the sorted rows
+            (and the end of the last cell), and the rows sorted by grid cell, row by row of the grid.
+    """
+    if not len(x):
+        return (
+            0.0,
+            0.0,
+            1.0,
+            1,
+            np.zeros(2, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+        )
+    x0, y0 = float(x.min()), float(y.min())
+    columns = max(int(np.sqrt(len(x) / CELL_SIZE)), 1)
+    size = float(max(x.max() - x0, y.max() - y0) / columns) or 1.0
+    # facilities on the maximum edges are put in the last cells
+    cells = np.minimum((y - y0) // size, columns - 1) * columns + np.minimum(
+        (x - x0) // size, columns - 1
+    )
+    order = np.argsort(cells, kind="stable")
+    starts = np.searchsorted(cells[order], np.arange(columns * columns + 1))
+    return x0, y0, size, columns, starts, order
+
+
+def index_path(output_name: str, crs: str) -> str:
+    """Facility index directory path, e.g. `<output_name>_epsg_27700.index`."""
+    return f"{output_name}_{crs.replace(':', '_')}.index"
+
+
+def write_facility_index(
+    handler,
+    path: str | Path,
+    crs: str | None = None,
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    features: pa.Schema | None = None,
+) -> None:
+    """Write handler objects, and a spatial index of them, to a directory which `FacilityIndex` can query.
+
+    Objects are streamed to an uncompressed Arrow IPC file with native point geometries (a struct of x and y
+    coordinates), which readers memory-map rather than load.
+    Rows of the file are indexed by their coordinates in an R-tree stored on disk,
+    which is bulk loaded once all objects have been written, and sorted by the cells of a grid used for range queries.
+
+    Args:
+        handler (build.ObjectHandler | writers.ObjectTable): Handler whose objects will be indexed.
+        path (str | Path): Index directory path. Any existing directory at this path will be replaced.
+        crs (str | None, optional): CRS of the index, if different from the handler CRS. Defaults to None.
+        single_use (bool, optional): If True, index one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects written at a time. Defaults to 100_000.
+        features (pa.Schema | None, optional):
+            Feature types (see `writers.feature_schema`), if already inferred.
+            Defaults to None, i.e. inferred from the objects.
+    """
+    from osmox import writers
+
+    crs = crs or handler.crs
+    path = Path(path)
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+
+    if features is None:
+        features = writers.feature_schema(handler, batch_size)
+    schema = writers.output_schema(
+        features,
+        crs,
+        single_use,
+        geometry_encoding="geoarrow",
+    )
+    xs, ys = [], []
+    with (
+        pa.OSFile(str(path / OBJECTS_FILE), "wb") as sink,
+        pa.ipc.new_file(sink, schema) as writer,
+    ):
+        for batch in writers.record_batches(
+            handler, schema, crs, single_use, batch_size, geometry_encoding="geoarrow"
+        ):
+            writer.write_batch(batch)
+            geometry = batch.column("geometry")
+            xs.append(geometry.field("x").to_numpy())
+            ys.append(geometry.field("y").to_numpy())
+
+    x, y = np.concatenate([[], *xs]), np.concatenate([[], *ys])
+    properties = index.Property()
+    properties.overwrite = True
+    if len(x):
+        stream = (
+            (row, (x[row], y[row], x[row], y[row]), None) for row in range(len(x))
+        )
+        tree = index.Index(str(path / TREE_NAME), stream, properties=properties)
+    else:  # rtree can't bulk load nothing
+        tree = index.Index(str(path / TREE_NAME), properties=properties)
+    tree.close()
+
+    x0, y0, size, columns, starts, order = _grid(x, y)
+    (path / GRID_FILE).write_text(
+        json.dumps({"x0": x0, "y0": y0, "size": size, "columns": columns})
+    )
+    np.save(path / GRID_ROWS_FILE, np.concatenate([starts, order]).astype(np.int64))
+
+
+class FacilityIndex:
+    """Bounding box, radius, nearest neighbour and sampling queries on OSMOX output facilities.
+
+    Opening an index persisted by `write_facility_index` only memory-maps its object and grid files and reads the
+    header of its R-tree, so queries can be run within milliseconds of starting a process, however many objects
+    there are. Objects, grid cells and R-tree pages are read from disk as queries need them.
+    Output files can also be loaded and indexed in memory with `FacilityIndex.from_output`.
+
+    All queries can be restricted to facilities with any of a list of activities.
+
+    Example:
+        >>> with FacilityIndex("outputs/london_epsg_27700.index") as facilities:
+        ...     facilities.bbox(529000, 181000, 530000, 182000).to_pandas()
+        ...     facilities.nearest(529500, 181500, k=5, activities=["shop"])
+        ...     facilities.sample(529500, 181500, 2000, n=10, activities=["work"], weight="floor_area")
+    """
+
+    def __init__(self, path: str | Path):
+        """Open a persisted facility index.
+
+        Args:
+            path (str | Path): Facility index directory path (see `index_path`).
+
+        Raises:
+            FileNotFoundError: If there is no facility index at the path.
+        """
+        self.path = Path(path)
+        if not (self.path / OBJECTS_FILE).exists():
+            raise FileNotFoundError(f"No facility index found at {self.path}")
+        self._source = pa.memory_map(str(self.path / OBJECTS_FILE))
+        self.table = pa.ipc.open_file(self._source).read_all()
+        self.tree = index.Index(str(self.path / TREE_NAME))
+        self._activities = None
+        self._activity_masks = {}
+        self._xy = None
+        self._grid = self._read_grid()
+        self._features = {}
+
+    @classmethod
+    def from_output(cls, path: str | Path) -> "FacilityIndex":
+        """Load an OSMOX output file (e.g. `<output_name>_epsg_27700.gpkg`) and index it in memory.
+
+        Args:
+            path (str | Path): Output file path, in any output format.
+
+        Returns:
+            FacilityIndex: Index of the output facilities, in the CRS of the output.
+        """
+        # deferred, so that opening a persisted index doesn't import pandas
+        import pandas as pd
+        import shapely
+
+        from osmox import helpers, writers
+
+        gdf = helpers.read_geofile(path)
+        x, y = shapely.get_x(gdf.geometry.values), shapely.get_y(gdf.geometry.values)
+        table = pa.Table.from_pandas(
+            pd.DataFrame(gdf.drop(columns="geometry")), preserve_index=False
+        )
+        position = table.schema.get_field_index(
+            "activity" if "activity" in table.column_names else "activities"
+        )
+        table = table.add_column(
+            position + 1,
+            writers.geometry_field(gdf.crs.to_string(), geometry_encoding="geoarrow"),
+            pa.StructArray.from_arrays([_array(x), _array(y)], names=["x", "y"]),
+        )
+
+        stream = (
+            (row, (x[row], y[row], x[row], y[row]), None) for row in range(len(x))
+        )
+        facilities = cls.__new__(cls)
+        facilities.path = Path(path)
+        facilities._source = None
+        facilities.table = table
+        facilities.tree = index.Index(stream) if len(x) else index.Index()
+        facilities._activities = None
+        facilities._activity_masks = {}
+        facilities._xy = (x, y)
+        facilities._grid = _grid(x, y)
+        facilities._features = {}
+        return facilities
+
+    def _read_grid(self) -> tuple | None:
+        """Memory-map the grid persisted with the index, or get None if the index was written without one."""
+        if not (self.path / GRID_FILE).exists():
+            return None
+        grid = json.loads((self.path / GRID_FILE).read_text())
+        rows = np.load(self.path / GRID_ROWS_FILE, mmap_mode="r")
+        cells = grid["columns"] * grid["columns"] + 1
+        return (
+            grid["x0"],
+            grid["y0"],
+            grid["size"],
+            grid["columns"],
+            rows[:cells],
+            rows[cells:],
+        )
+
+    def __len__(self):
+        """Number of facility rows."""
+        return self.table.num_rows
+
+    def __enter__(self):
+        """Use the index as a context manager, which closes it on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the index."""
+        self.close()
+
+    def close(self):
+        """Close the index files."""
+        self.tree.close()
+        if self._source is not None:
+            self._source.close()
+
+    @property
+    def crs(self):
+        """CRS of the facility coordinates, as a `pyproj.CRS`."""
+        from pyproj import CRS
+
+        metadata = self.table.schema.field("geometry").metadata[
+            b"ARROW:extension:metadata"
+        ]
+        return CRS.from_json_dict(json.loads(metadata)["crs"])
+
+    def activity_rows(
+        self, activities: str | list[str] | None, rows: np.ndarray
+    ) -> np.ndarray:
+        """Keep only the rows of facilities with any of the given activities.
+
+        Masks of the rows with each activity are built on first use of the activity, from the activities of all
+        facilities split at once, so that filtering rows costs no more than indexing an array.
+
+        Args:
+            activities (str | list[str] | None): Activities. If None, all rows are kept.
+            rows (np.ndarray): Facility rows.
+
+        Returns:
+            np.ndarray: Rows of facilities with any of the activities, in the order given.
+        """
+        if activities is None:
+            return rows
+        if isinstance(activities, str):
+            activities = [activities]
+        if self._activities is None:
+            # deferred, so that opening an index doesn't wait for it
+            import pyarrow.compute as pc
+
+            column = self.table.column(
+                "activity" if "activity" in self.table.column_names else "activities"
+            )
+            split = pc.split_pattern(column, ",")
+            # code of each activity of each facility, and the row of the facility
+            encoded = pc.dictionary_encode(pc.list_flatten(split).combine_chunks())
+            parents = pc.list_parent_indices(split).combine_chunks()
+            self._activities = (
+                {act: code for code, act in enumerate(encoded.dictionary.to_pylist())},
+                _numpy(encoded.indices, np.int32),
+                _numpy(parents, np.int64),
+            )
+        codes, values, parents = self._activities
+        keep = np.zeros(len(rows), dtype=bool)
+        for act in activities:
+            if act not in codes:
+                continue
+            if act not in self._activity_masks:
+                mask = np.zeros(len(self), dtype=bool)
+                mask[parents[values == codes[act]]] = True
+                self._activity_masks[act] = mask
+            keep |= self._activity_masks[act][rows]
+        return rows[keep]
+
+    def coordinates(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Get x and y coordinates of facility rows.
+
+        Coordinates are read from views of the geometry column buffers, which are only copied if the column
+        is split into more than one chunk.
+        """
+        if self._xy is None:
+            chunks = self.table.column("geometry").chunks
+            xs = [_numpy(chunk.field("x")) for chunk in chunks]
+            ys = [_numpy(chunk.field("y")) for chunk in chunks]
+            self._xy = (
+                (xs[0], ys[0])
+                if len(chunks) == 1
+                else (np.concatenate([[], *xs]), np.concatenate([[], *ys]))
+            )
+        x, y = self._xy
+        return x[rows], y[rows]
+
+    def feature_values(self, name: str, rows: np.ndarray) -> np.ndarray:
+        """Get values of a numeric feature of facility rows, where facilities without the feature have NaN values.
+
+        Raises:
+            KeyError: If the feature is unknown.
+        """
+        if name not in self._features:
+            if name not in self.table.column_names:
+                raise KeyError(f"Unknown feature: {name}")
+            chunks = self.table.column(name).cast(pa.float64()).chunks
+            self._features[name] = np.concatenate(
+                [
+                    [],
+                    *(
+                        np.where(_valid(chunk), _numpy(chunk), np.nan)
+                        for chunk in chunks
+                    ),
+                ]
+            )
+        return self._features[name][rows]
+
+    def take(self, rows: np.ndarray, distance: np.ndarray | None = None) -> pa.Table:
+        """Get facility rows, optionally with their "distance" to a query point."""
+        facilities = self.table.take(_array(rows))
+        if distance is not None:
+            facilities = facilities.append_column("distance", _array(distance))
+        return facilities
+
+    def bbox(
+        self,
+        minx: float,
+        miny: float,
+        maxx: float,
+        maxy: float,
+        activities: str | list[str] | None = None,
+    ) -> pa.Table:
+        """Get the facilities within a bounding box, in index CRS coordinates.
+
+        Args:
+            minx (float): Minimum x coordinate.
+            miny (float): Minimum y coordinate.
+            maxx (float): Maximum x coordinate.
+            maxy (float): Maximum y coordinate.
+            activities (str | list[str] | None, optional): Only get facilities with any of these activities.
+                Defaults to None.
+
+        Returns:
+            pa.Table: Facilities within the bounding box, in index order.
+        """
+        return self.take(self.bbox_rows(minx, miny, maxx, maxy, activities))
+
+    def bbox_rows(
+        self,
+        minx: float,
+        miny: float,
+        maxx: float,
+        maxy: float,
+        activities: str | list[str] | None = None,
+    ) -> np.ndarray:
+        """Get the rows of facilities within a bounding box, in index order (see `bbox`).
+
+        Rather than querying the R-tree, which returns rows one at a time, rows are sliced from a list of all rows
+        sorted by the cells of a regular grid, row by row of the grid, so that large ranges are quick to query.
+        The grid is persisted with the index, and only built on first use for indexes written without one.
+        """
+        if self._grid is None:
+            self._grid = _grid(*self.coordinates(slice(None)))
+        x0, y0, size, columns, starts, order = self._grid
+        if not len(order) or maxx < x0 or maxy < y0:
+            return np.empty(0, dtype=np.int64)
+        first, last = np.clip(
+            ((minx - x0) // size, (maxx - x0) // size), 0, columns - 1
+        ).astype(np.int64)
+        grid_rows = range(
+            max(int((miny - y0) // size), 0), min(int((maxy - y0) // size) + 1, columns)
+        )
+        rows = np.concatenate(
+            [
+                [],
+                *(
+                    order[starts[r * columns + first] : starts[r * columns + last + 1]]
+                    for r in grid_rows
+                ),
+            ]
+        ).astype(np.int64)
+        x, y = self.coordinates(rows)
+        rows = rows[(x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)]
+        return self.activity_rows(activities, np.sort(rows))
+
+    def within(
+        self,
+        x: float,
+        y: float,
+        distance: float,
+        activities: str | list[str] | None = None,
+    ) -> pa.Table:
+        """Get the facilities within a distance of a point, in index CRS coordinates.
+
+        Args:
+            x (float): Point x coordinate.
+            y (float): Point y coordinate.
+            distance (float): Maximum euclidean distance to the point.
+            activities (str | list[str] | None, optional): Only get facilities with any of these activities.
+                Defaults to None.
+
+        Returns:
+            pa.Table: Facilities within the distance of the point, in index order, with their "distance" to it.
+        """
+        return self.take(*self.within_rows(x, y, distance, activities))
+
+    def within_rows(
+        self,
+        x: float,
+        y: float,
+        distance: float,
+        activities: str | list[str] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Get the rows of facilities within a distance of a point, and their distances (see `within`)."""
+        rows = self.bbox_rows(
+            x - distance, y - distance, x + distance, y + distance, activities
+        )
+        xs, ys = self.coordinates(rows)
+        distances = np.hypot(xs - x, ys - y)
+        keep = distances <= distance
+        return rows[keep], distances[keep]
+
+    def nearest(
+        self, x: float, y: float, k: int = 1, activities: str | list[str] | None = None
+    ) -> pa.Table:
+        """Get the facilities nearest to a point, in index CRS coordinates.
+
+        Args:
+            x (float): Point x coordinate.
+            y (float): Point y coordinate.
+            k (int, optional): Number of facilities to get. Defaults to 1.
+            activities (str | list[str] | None, optional): Only get facilities with any of these activities.
+                Defaults to None.
+
+        Returns:
+            pa.Table: Up to `k` facilities, nearest first, with their euclidean "distance" to the point.
+        """
+        return self.take(*self.nearest_rows(x, y, k, activities))
+
+    def nearest_rows(
+        self, x: float, y: float, k: int = 1, activities: str | list[str] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Get the rows of facilities nearest to a point, and their distances (see `nearest`)."""
+        if k < 1 or not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        # widen the search until enough nearby facilities have the activities
+        candidates = k
+        while True:
+            # rtree returns all facilities tied for k-th nearest
+            rows = np.fromiter(
+                self.tree.nearest((x, y, x, y), candidates), dtype=np.int64
+            )
+            searched = len(rows) >= len(self)
+            rows = self.activity_rows(activities, rows)
+            if len(rows) >= k or searched:
+                break
+            candidates *= 4
+        xs, ys = self.coordinates(rows)
+        distance = np.hypot(xs - x, ys - y)
+        order = np.argsort(distance, kind="stable")[:k]
+        return rows[order], distance[order]
+
+    def sample(
+        self,
+        x: float,
+        y: float,
+        distance: float,
+        n: int = 1,
+        activities: str | list[str] | None = None,
+        weight: str | None = None,
+        replace: bool = True,
+        seed: int | None = None,
+    ) -> pa.Table:
+        """Randomly sample facilities within a distance of a point, in index CRS coordinates.
+
+        Args:
+            x (float): Point x coordinate.
+            y (float): Point y coordinate.
+            distance (float): Maximum euclidean distance to the point.
+            n (int, optional): Number of facilities to sample. Defaults to 1.
+            activities (str | list[str] | None, optional): Only sample facilities with any of these activities.
+                Defaults to None.
+            weight (str | None, optional):
+                Name of a numeric feature (e.g. "floor_area") to weight sampling by.
+                Facilities without the feature are never sampled.
+                Defaults to None, i.e. all facilities are equally likely to be sampled.
+            replace (bool, optional):
+                If False, sample each facility at most once, so fewer than `n` facilities may be sampled.
+                Defaults to True.
+            seed (int | None, optional): Random number generator seed. Defaults to None.
+
+        Raises:
+            KeyError: If the weight is not a facility feature.
+            ValueError: If any weights are negative.
+
+        Returns:
+            pa.Table: Sampled facilities, with their "distance" to the point.
+        """
+        rows, distances = self.sample_rows(
+            x, y, distance, n, activities, weight, replace, seed
+        )
+        return self.take(rows, distances)
+
+    def sample_rows(
+        self,
+        x: float,
+        y: float,
+        distance: float,
+        n: int = 1,
+        activities: str | list[str] | None = None,
+        weight: str | None = None,
+        replace: bool = True,
+        seed: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Randomly sample rows of facilities within a distance of a point, and their distances (see `sample`)."""
+        if weight is not None and weight not in self.table.column_names:
+            raise KeyError(f"Unknown weight feature: {weight}")
+        rows, distances = self.within_rows(x, y, distance, activities)
+        if weight is None:
+            p = np.ones(len(rows))
+        else:
+            p = np.nan_to_num(self.feature_values(weight, rows), nan=0.0)
+            if (p < 0).any():
+                raise ValueError(f"Weight feature {weight} has negative values")
+        total = p.sum()
+        if n < 1 or not total > 0:
+            return rows[:0], distances[:0]
+        if not replace:
+            n = min(n, np.count_nonzero(p))
+        choice = np.random.default_rng(seed).choice(
+            len(rows), size=n, replace=replace, p=p / total
+        )
+        return rows[choice], distances[choice]
@@ -1,41 +1,93 @@
 import logging
+import sys
+import time
+from collections import namedtuple
 from pathlib import Path
 
-import click
 import geopandas as gp
+import numpy as np
+import shapely
 from rtree import index
-from shapely.geometry import Point, Polygon
+from shapely.geometry import Polygon
 
 from osmox import build
+from osmox.click_types import PathPath as PathPath
 
 logger = logging.getLogger(__name__)
 
 
-class PathPath(click.Path):
-    """A Click path argument that returns a pathlib Path, not a string"""
-
-    def convert(self, value, param, ctx):
-        return Path(super().convert(value, param, ctx))
-
-
 class AutoTree(index.Index):
     """Spatial bounding box transforming (using pyproj) and indexing (using Rtree).
     """
 
-    def __init__(self):
-        super().__init__()
-        self.objects = []
-        self.counter = 0
+    def __init__(self, objects=None, bounds=None):
+        """Create an in-memory index, optionally bulk loading objects.
+
+        Args:
+            objects (Iterable, optional):
+                Objects to bulk load into the index, which is faster than inserting them one at a time.
+                Defaults to None.
+            bounds (np.ndarray, optional):
+                Bounds of the objects, as (minx, miny, maxx, maxy) rows, if already known.
+                Defaults to None, i.e. bounds are computed from the object geometries.
+        """
+        objects = list(objects) if objects is not None else []
+        if objects:
+            if bounds is None:
+                bounds = shapely.bounds([o.geom for o in objects])
+            super().__init__((i, tuple(bound), None) for i, bound in enumerate(bounds))
+        else:
+            super().__init__()
+        self.objects = objects
+        self.counter = len(objects)
 
     def auto_insert(self, object):
         super().insert(self.counter, object.geom.bounds)
         self.objects.append(object)
         self.counter += 1
 
+    def extend(self, objects):
+        """Insert many objects at once, computing their bounds in bulk."""
+        objects = list(objects)
+        if not objects:
+            return
+        bounds = shapely.bounds([o.geom for o in objects])
+        for i, bound in enumerate(bounds, start=self.counter):
+            super().insert(i, tuple(bound))
+        self.objects.extend(objects)
+        self.counter += len(objects)
+
+    def sorted(self, curve="hilbert"):
+        """Copy of this tree with objects sorted along a space-filling curve (see `spatial_order`).
+
+        Args:
+            curve (Literal["hilbert", "zorder"], optional): Space-filling curve to sort along. Defaults to "hilbert".
+
+        Returns:
+            AutoTree: Spatially sorted tree.
+        """
+        order = spatial_order([o.geom for o in self.objects], curve=curve)
+        return AutoTree(self.objects[i] for i in order)
+
     def intersection(self, coordinates):
         ids = super().intersection(coordinates, objects=False)
         return [self.objects[i] for i in ids]
 
+    def intersection_ids(self, coordinates) -> np.ndarray:
+        """Positions in `objects` of the objects whose bounds intersect the given bounds."""
+        return np.fromiter(
+            super().intersection(coordinates, objects=False), dtype=np.int64
+        )
+
+    def nearest_ids(self, coordinates, num_results=1) -> np.ndarray:
+        """Positions in `objects` of the objects whose bounds are nearest to the given bounds.
+
+        All objects tied for the last place are included, so more than `num_results` positions may be returned.
+        """
+        return np.fromiter(
+            super().nearest(coordinates, num_results, objects=False), dtype=np.int64
+        )
+
     def __iter__(self):
         for o in self.objects:
             yield o
@@ -47,6 +99,71 @@ class AutoTree(index.Index):
         print(list(self))
 
 
+def spatial_order(geoms, curve="hilbert", level=16) -> np.ndarray:
+    """Positions that sort geometries by the distance of their centroids along a space-filling curve.
+
+    Geometries that are close together in space will be close together in the sorted order.
+    The sort is stable, so geometries with equal distances along the curve keep their relative order.
+
+    Args:
+        geoms (Sequence[shapely.Geometry]): Geometries to sort.
+        curve (Literal["hilbert", "zorder"], optional): Space-filling curve to sort along. Defaults to "hilbert".
+        level (int, optional):
+            Curve level, i.e. the number of bits per dimension of the grid that centroids are snapped to.
+            Defaults to 16.
+
+    Raises:
+        ValueError: If `curve` is not a known space-filling curve.
+
+    Returns:
+        np.ndarray: Sorting positions, as returned by `np.argsort`.
+    """
+    centroids = shapely.centroid(np.asarray(geoms, dtype=object))
+    if curve == "hilbert":
+        if not len(centroids):
+            return np.array([], dtype=int)
+        distances = gp.GeoSeries(centroids).hilbert_distance(level=level).to_numpy()
+    elif curve == "zorder":
+        distances = z_order_distance(
+            shapely.get_x(centroids), shapely.get_y(centroids), level
+        )
+    else:
+        raise ValueError(
+            f"Unknown space-filling curve: {curve}; expected 'hilbert' or 'zorder'"
+        )
+    return np.argsort(distances, kind="stable")
+
+
+def z_order_distance(x: np.ndarray, y: np.ndarray, level: int = 16) -> np.ndarray:
+    """Distance of coordinates along a Z-order (Morton) curve through their bounding box.
+
+    Coordinates are snapped to a grid of 2**level by 2**level cells and the bits of their grid cell indices interleaved.
+
+    Args:
+        x (np.ndarray): x coordinates.
+        y (np.ndarray): y coordinates.
+        level (int, optional): Number of bits per dimension, up to 32. Defaults to 16.
+
+    Returns:
+        np.ndarray: Distances along the curve.
+    """
+    if not len(x):
+        return np.array([], dtype=np.uint64)
+    n = 2**level - 1
+    cells = []
+    for values in (x, y):
+        extent = values.max() - values.min()
+        scaled = (values - values.min()) / extent if extent else np.zeros_like(values)
+        cells.append((scaled * n).astype(np.uint64))
+    distances = np.zeros(len(x), dtype=np.uint64)
+    for bit in range(level):
+        for dim, cell in enumerate(cells):
+            distances |= ((cell >> np.uint64(bit)) & np.uint64(1)) << np.uint64(
+                2 * bit + dim
+            )
+    return distances
+
+
 def dict_list_match(d, dict_list):
     """Check if simple key value pairs from dict d are in dictionary of lists.
     eg:
@@ -105,40 +222,93 @@ def imperial_to_metric(height):
     return round(inches / 39.3701, 3)
 
 
+ProgressEvent = namedtuple("ProgressEvent", "stage, done, total, rate")
+
+
 def progressBar(
-    iterable, prefix="", suffix="", decimals=1, length=100, fill="|", printEnd="\r"
+    iterable,
+    prefix="",
+    suffix="",
+    decimals=1,
+    length=100,
+    fill="|",
+    printEnd="\r",
+    stage=None,
+    callback=None,
+    interval=0.5,
+    step=1.0,
+    stream=None,
+    enabled=None,
 ):
-    """From here: https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
-    Call in a loop to create terminal progress bar
-    @params:
-        iteration   - Required  : current iteration (Int)
-        total       - Required  : total iterations (Int)
-        prefix      - Optional  : prefix string (Str)
-        suffix      - Optional  : suffix string (Str)
-        decimals    - Optional  : positive number of decimals in percent complete (Int)
-        length      - Optional  : character length of bar (Int)
-        fill        - Optional  : bar fill character (Str)
-        printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
+    """Wrap an iterable to report progress through it as a terminal progress bar and/or structured progress events.
+
+    Progress is reported at the start and end of iteration and in between at most once per `interval` seconds or
+    per `step` percent of progress, whichever comes first, so that fast loops are not slowed down by reporting.
+
+    Adapted from: https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
+
+    Args:
+        iterable (Sized): Items to iterate over.
+        prefix (str, optional): Progress bar prefix. Defaults to "".
+        suffix (str, optional): Progress bar suffix. Defaults to "".
+        decimals (int, optional): Number of decimals in percent complete. Defaults to 1.
+        length (int, optional): Character length of bar. Defaults to 100.
+        fill (str, optional): Bar fill character. Defaults to "|".
+        printEnd (str, optional): End character (e.g. "\r", "\r\n"). Defaults to "\r".
+        stage (str, optional): Stage name to include in progress events. Defaults to None.
+        callback (Callable[[ProgressEvent], None], optional):
+            Function to call with a `ProgressEvent(stage, done, total, rate)` on each progress update,
+            where `rate` is the number of items done per second so far. Defaults to None.
+        interval (float, optional): Minimum number of seconds between progress updates. Defaults to 0.5.
+        step (float, optional): Percentage of progress that triggers an update regardless of `interval`.
+            Defaults to 1.0.
+        stream (TextIO, optional): Stream to write the progress bar to. Defaults to `sys.stdout`.
+        enabled (bool, optional):
+            If True, write the progress bar to `stream`. Defaults to None, which only writes it if `stream` is a TTY,
+            e.g. not when output is piped to a log file.
+
+    Yields:
+        Items of `iterable`.
     """
-    total = len(iterable)
+    stream = sys.stdout if stream is None else stream
+    if enabled is None:
+        enabled = stream.isatty()
+    if not enabled and callback is None:
+        yield from iterable
+        return
 
-    # Progress Bar Printing Function
-    def printProgressBar(iteration):
-        percent = ("{0:." + str(decimals) + "f}").format(
-            100 * (iteration / float(total))
-        )
-        filledLength = int(length * iteration // total)
-        bar = fill * filledLength + "-" * (length - filledLength)
-        print(f"\r{prefix} |{bar}| {percent}% {suffix}", end=printEnd)
-
-    # Initial Call
-    printProgressBar(0)
-    # Update Progress Bar
-    for i, item in enumerate(iterable):
+    total = len(iterable)
+    items_per_step = max(1, int(total * step / 100))
+    start = time.perf_counter()
+
+    def report(done):
+        elapsed = time.perf_counter() - start
+        if callback is not None:
+            callback(
+                ProgressEvent(stage, done, total, done / elapsed if elapsed else None)
+            )
+        if enabled:
+            fraction = done / float(total) if total else 1.0
+            percent = ("{0:." + str(decimals) + "f}").format(100 * fraction)
+            filledLength = int(length * fraction)
+            bar = fill * filledLength + "-" * (length - filledLength)
+            stream.write(f"\r{prefix} |{bar}| {percent}% {suffix}{printEnd}")
+            stream.flush()
+
+    report(0)
+    last_time, next_done = start, items_per_step
+    done = 0
+    for item in iterable:
         yield item
-        printProgressBar(i + 1)
-    # Print New Line on Complete
-    print()
+        done += 1
+        if done >= next_done or time.perf_counter() - last_time >= interval:
+            if done < total:
+                report(done)
+            last_time, next_done = time.perf_counter(), done + items_per_step
+    report(done)
+    if enabled:
+        stream.write("\n")
+        stream.flush()
 
 
 def get_distance(p):
@@ -164,22 +334,36 @@ def tag_match(a, b):
     return False
 
 
-def bounding_grid(area, spacing):
-    grid = []
+def bounding_grid_xy(area, spacing) -> tuple[np.ndarray, np.ndarray]:
+    """Return x and y coordinate arrays of a regular grid covering the bounds of an area.
+
+    Grid points start from the bottom-left corner of the area bounds.
+    """
     min_x, min_y, max_x, max_y = area.bounds
     nxs = 1 + int((max_x - min_x) / spacing[0])
     nys = 1 + int((max_y - min_y) / spacing[1])
-    for ix in range(0, nxs):
-        x = min_x + (ix * spacing[0])
-        for iy in range(0, nys):
-            y = min_y + (iy * spacing[1])
-            grid.append((x, y))
-    return grid
+    xs = min_x + np.arange(nxs) * spacing[0]
+    ys = min_y + np.arange(nys) * spacing[1]
+    xx, yy = np.meshgrid(xs, ys, indexing="ij")
+    return xx.ravel(), yy.ravel()
+
+
+def area_grid_xy(area, spacing) -> tuple[np.ndarray, np.ndarray]:
+    """Return x and y coordinate arrays of the grid points that intersect an area."""
+    xs, ys = bounding_grid_xy(area, spacing)
+    shapely.prepare(area)
+    mask = shapely.intersects_xy(area, xs, ys)
+    return xs[mask], ys[mask]
+
+
+def bounding_grid(area, spacing):
+    xs, ys = bounding_grid_xy(area, spacing)
+    return list(zip(xs.tolist(), ys.tolist(), strict=True))
 
 
 def area_grid(area, spacing):
-    grid = bounding_grid(area, spacing)
-    return [p for p in grid if area.intersects(Point(p))]
+    xs, ys = area_grid_xy(area, spacing)
+    return list(zip(xs.tolist(), ys.tolist(), strict=True))
 
 
 def fill_object(i, point, size, new_osm_tags, new_tags, required_acts):
@@ -192,6 +376,48 @@ def fill_object(i, point, size, new_osm_tags, new_tags, required_acts):
     return object
 
 
+def fill_objects(
+    area_idx, xs, ys, size, new_osm_tags, new_tags, required_acts, start=0
+):
+    """Create fill objects with footprints extending from the bottom-left points `(xs, ys)`.
+
+    Footprints are created in bulk.
+    Objects are given IDs of the form `fill_<area_idx>_<n>`, with `n` counting up from `start`.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    geoms = shapely.box(xs, ys, xs + size[0], ys + size[1])
+    objects = []
+    for i, geom in enumerate(geoms, start=start):
+        object = build.Object(
+            idx=f"fill_{area_idx}_{i}",
+            osm_tags=new_osm_tags,
+            activity_tags=new_tags,
+            geom=geom,
+        )
+        object.activities = list(required_acts)
+        objects.append(object)
+    return objects
+
+
+def transform_xy(transformer, x, y) -> tuple[np.ndarray, np.ndarray]:
+    """Transform coordinate arrays with a pyproj Transformer, in a single vectorised call.
+
+    Args:
+        transformer (pyproj.Transformer): Coordinate transformer.
+        x (np.ndarray): x coordinates.
+        y (np.ndarray): y coordinates.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Transformed x and y coordinates.
+    """
+    if len(x) == 1:
+        # pyproj would treat single element arrays as scalars
+        x, y = np.asarray(x).tolist(), np.asarray(y).tolist()
+    x, y = transformer.transform(x, y)
+    return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+
 def point_to_poly(point: tuple[float, float], size: tuple[float, float]) -> Polygon:
     dx, dy = size[0], size[1]
     x, y = point
@@ -204,9 +430,61 @@ def path_leaf(filepath):
     return folder_path
 
 
-def read_geofile(filepath: str | Path) -> gp.GeoDataFrame:
+def read_geofile(
+    filepath: str | Path,
+    bbox: tuple | gp.GeoSeries | gp.GeoDataFrame | None = None,
+    mask: Polygon | gp.GeoSeries | gp.GeoDataFrame | None = None,
+) -> gp.GeoDataFrame:
+    """Read a geospatial data file, optionally keeping only the features within a bounding box or mask.
+
+    Args:
+        filepath (str | Path): Path to file that can be loaded by GeoPandas.
+        bbox (tuple | gp.GeoSeries | gp.GeoDataFrame | None, optional):
+            Filter features by a bounding box, either a (minx, miny, maxx, maxy) tuple in the CRS of the file,
+            or GeoPandas data whose bounds will be used, reprojected to the CRS of the file.
+            Defaults to None.
+        mask (Polygon | gp.GeoSeries | gp.GeoDataFrame | None, optional):
+            Filter features that intersect the given geometry.
+            Geometries in GeoPandas data will be reprojected to the CRS of the file.
+            Cannot be used together with `bbox`.
+            Defaults to None.
+
+    Returns:
+        gp.GeoDataFrame: Features loaded from file.
+    """
+    if bbox is not None and mask is not None:
+        raise ValueError(
+            "Only one of `bbox` and `mask` can be used to filter a geospatial data file."
+        )
     filepath_extension = Path(filepath).suffixes
     if ".parquet" in filepath_extension:
-        return gp.read_parquet(filepath)
+        gdf = gp.read_parquet(filepath)
+        return _filter_geofile(gdf, bbox, mask)
     else:
-        return gp.read_file(filepath)
+        return gp.read_file(filepath, bbox=bbox, mask=mask)
+
+
+def _filter_geofile(
+    gdf: gp.GeoDataFrame,
+    bbox: tuple | gp.GeoSeries | gp.GeoDataFrame | None,
+    mask: Polygon | gp.GeoSeries | gp.GeoDataFrame | None,
+) -> gp.GeoDataFrame:
+    """Keep only the features within a bounding box or mask, using the spatial index of the data."""
+    if bbox is None and mask is None:
+        return gdf
+    if bbox is not None:
+        if isinstance(bbox, gp.GeoSeries | gp.GeoDataFrame):
+            bbox = _to_crs_of(bbox, gdf).total_bounds
+        geom = shapely.box(*bbox)
+    elif isinstance(mask, gp.GeoSeries | gp.GeoDataFrame):
+        geom = shapely.union_all(_to_crs_of(mask, gdf).geometry.values)
+    else:
+        geom = mask
+    positions = np.sort(gdf.sindex.query(geom, predicate="intersects"))
+    return gdf.iloc[positions]
+
+
+def _to_crs_of(data: gp.GeoSeries | gp.GeoDataFrame, gdf: gp.GeoDataFrame):
+    if data.crs is not None and gdf.crs is not None:
+        return data.to_crs(gdf.crs)
+    return data
@@ -0,0 +1,225 @@
+"""Stage-level time and memory profiling of OSMOX runs."""
+
+import cProfile
+import ctypes
+import ctypes.util
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import osmox
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process so far, in MB, if it can be measured on this platform."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def rss_mb() -> float | None:
+    """Current resident set size of this process, in MB, if it can be measured on this platform."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def trim_heap() -> bool:
+    """Return memory freed by the C allocator to the operating system, so that releasing data lowers RSS.
+
+    Only glibc supports this, other platforms return freed memory by themselves or not at all.
+
+    Returns:
+        bool: True if the heap could be trimmed.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        libc.malloc_trim(0)
+    except (OSError, AttributeError):  # not glibc, e.g. musl
+        return False
+    return True
+
+
+def _difference(end: float | None, start: float | None) -> float | None:
+    """Difference between two measurements, if both could be made."""
+    return None if end is None or start is None else end - start
+
+
+class Profiler:
+    """Record the wall time, CPU time and memory use of each stage of an OSMOX run.
+
+    Stages are profiled with the `stage` context manager and the results collected into a JSON serialisable report.
+    A disabled profiler records nothing, so stages can be wrapped unconditionally.
+
+    Example:
+        >>> profiler = Profiler()
+        >>> with profiler.stage("parse", handler):
+        ...     handler.apply_file(path, locations=True, idx="flex_mem")
+        >>> profiler.write("report.json")
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        trace_memory: bool = False,
+        top_allocations: int = 10,
+        cprofile_dir: str | Path | None = None,
+    ):
+        """Set up what to profile.
+
+        Args:
+            enabled (bool, optional): If False, do not profile anything. Defaults to True.
+            trace_memory (bool, optional):
+                If True, trace Python memory allocations with `tracemalloc` to report each stage's peak traced memory
+                and top allocating source lines. This slows runs down noticeably. Defaults to False.
+            top_allocations (int, optional): Number of top allocating source lines to report per stage. Defaults to 10.
+            cprofile_dir (str | Path | None, optional):
+                If given, dump `cProfile` statistics for each stage to `<cprofile_dir>/<stage>.prof`,
+                which can be inspected with e.g. `snakeviz` or `python -m pstats`.
+                Only the main thread is profiled. Defaults to None.
+        """
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.top_allocations = top_allocations
+        self.cprofile_dir = Path(cprofile_dir) if cprofile_dir is not None else None
+        self.stages = []
+        self.metadata = {}
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str, handler=None):
+        """Profile the code run within this context as a named stage.
+
+        Args:
+            name (str): Stage name.
+            handler (build.ObjectHandler, optional):
+                Handler whose object, point and area counts will be recorded at the end of the stage. Defaults to None.
+
+        Yields:
+            dict: Stage record, to which extra items can be added.
+        """
+        record = {"name": name}
+        if not self.enabled:
+            yield record
+            return
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            snapshot = self._snapshot()
+        if self.cprofile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        start_rss, start_peak_rss = rss_mb(), peak_rss_mb()
+        try:
+            yield record
+        finally:
+            wall_time = time.perf_counter() - start
+            record["wall_time_s"] = wall_time
+            record["cpu_time_s"] = time.process_time() - start_cpu
+            if self.cprofile_dir is not None:
+                profile.disable()
+                self.cprofile_dir.mkdir(parents=True, exist_ok=True)
+                path = self.cprofile_dir / f"{name}.prof"
+                profile.dump_stats(path)
+                record["cprofile"] = str(path)
+            record["rss_mb"] = rss_mb()
+            record["rss_change_mb"] = _difference(record["rss_mb"], start_rss)
+            # the process peak is a high-water mark which later stages inherit, so also record how much this stage raised it
+            record["process_peak_rss_mb"] = peak_rss_mb()
+            record["peak_rss_increase_mb"] = _difference(
+                record["process_peak_rss_mb"], start_peak_rss
+            )
+            if self.trace_memory:
+                record["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+                record["top_allocations"] = self._top_allocations(snapshot)
+            if handler is not None:
+                record["objects"] = len(handler.objects)
+                record["points"] = len(handler.points)
+                record["areas"] = len(handler.areas)
+                record["objects_per_s"] = (
+                    len(handler.objects) / wall_time if wall_time else None
+                )
+            self.stages.append(record)
+            memory = (
+                f", {record['rss_mb']:.0f} MB RSS"
+                if record["rss_mb"] is not None
+                else ""
+            )
+            logger.info(
+                f" Stage {name} took {wall_time:.2f}s wall time, {record['cpu_time_s']:.2f}s CPU time{memory}."
+            )
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        """Snapshot of traced memory allocations, excluding those of tracemalloc itself."""
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    def _top_allocations(self, before: tracemalloc.Snapshot) -> list[dict]:
+        """Source lines with the largest net memory allocations since the `before` snapshot."""
+        stats = [
+            stat
+            for stat in self._snapshot().compare_to(before, "lineno")
+            if stat.size_diff > 0
+        ]
+        stats.sort(key=lambda stat: stat.size_diff, reverse=True)
+        return [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_diff_mb": stat.size_diff / 1024**2,
+                "count_diff": stat.count_diff,
+            }
+            for stat in stats[: self.top_allocations]
+        ]
+
+    def report(self) -> dict:
+        """Profiling report of all stages recorded so far, with run metadata and totals."""
+        return {
+            "osmox_version": osmox.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            **self.metadata,
+            "total": {
+                "wall_time_s": time.perf_counter() - self._start,
+                "cpu_time_s": time.process_time() - self._start_cpu,
+                "process_peak_rss_mb": peak_rss_mb(),
+            },
+            "stages": self.stages,
+        }
+
+    def write(self, path: str | Path):
+        """Write the profiling report to a JSON file."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        logger.info(f" Profiling report written to {path}")
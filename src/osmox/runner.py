@@ -0,0 +1,388 @@
+"""Stages of `osmox run` and `osmox batch`, shared by the command line and by tiled and out-of-core runs."""
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from osmox import build, config, profiling, writers
+
+logger = logging.getLogger(__name__)
+
+# options of a batch job, with the same defaults as `osmox run`
+JOB_DEFAULTS = {
+    "format": "geopackage",
+    "crs": ["epsg:27700"],
+    "single_use": False,
+    "lazy": False,
+    "workers": 1,
+    "geometry_storage": "shapely",
+    "geometry_precision": None,
+    "id_column": "id",
+    "tags_column": "tags",
+    "sort": None,
+    "batch_size": 100_000,
+    "compression": "snappy",
+    "bbox_covering": False,
+    "spatial_index": True,
+    "engine": "auto",
+    "partition_by": [],
+    "quadkey_zoom": 10,
+    "facility_index": False,
+}
+JOB_PATHS = ["config", "input", "output"]
+
+
+def parse_input(
+    handler: build.ObjectHandler,
+    input_path: Path,
+    id_column: str = "id",
+    tags_column: str = "tags",
+    batch_size: int = 100_000,
+    profiler: profiling.Profiler | None = None,
+):
+    """Parse an OSM file, or a GeoParquet file or dataset directory, into a handler.
+
+    Args:
+        handler (build.ObjectHandler): Handler to parse the input into.
+        input_path (Path): Input path.
+        id_column (str, optional): Name of the OSM ID column, if reading from geoparquet. Defaults to "id".
+        tags_column (str, optional): Name of the OSM tags column, if reading from geoparquet. Defaults to "tags".
+        batch_size (int, optional): Maximum number of rows to read at a time, if reading from geoparquet.
+            Defaults to 100_000.
+        profiler (profiling.Profiler | None, optional): Profiler to record the parse stage with. Defaults to None.
+    """
+    profiler = profiler or profiling.Profiler(enabled=False)
+    input_path = Path(input_path)
+    logger.info(
+        f" Filtering all objects found in {input_path}. This may take a long while."
+    )
+    with profiler.stage("parse", handler):
+        if input_path.is_dir() or input_path.suffix == ".parquet":
+            handler.apply_geoparquet(
+                input_path,
+                id_column=id_column,
+                tags_column=tags_column,
+                batch_size=batch_size,
+            )
+        else:
+            handler.apply_file(str(input_path), locations=True, idx="flex_mem")
+    logger.info(f" Found {len(handler.objects)} buildings.")
+    logger.info(f" Found {len(handler.points)} nodes with valid tags.")
+    logger.info(f" Found {len(handler.areas)} areas with valid tags.")
+
+
+def run_stages(
+    handler: build.ObjectHandler,
+    sort: str | None = None,
+    profiler: profiling.Profiler | None = None,
+):
+    """Run all OSMOX stages configured in a handler's config on the objects it has parsed.
+
+    Points, areas and object polygons are released as soon as no later stage uses them (see `release_unused`),
+    so only object centroids and footprint areas are kept for the features, distances and outputs.
+
+    Args:
+        handler (build.ObjectHandler): Handler which has parsed an input.
+        sort (str | None, optional): Space-filling curve to sort objects along before processing. Defaults to None.
+        profiler (profiling.Profiler | None, optional): Profiler to record stages with. Defaults to None.
+    """
+    profiler = profiler or profiling.Profiler(enabled=False)
+    cnfg = handler.cnfg
+
+    if sort:
+        logger.info(f" Sorting objects along a {sort} curve.")
+        with profiler.stage("sort", handler):
+            handler.sort(sort)
+
+    logger.info(" Assigning object tags.")
+    with profiler.stage("assign_tags", handler) as record:
+        handler.assign_tags()
+        release_unused(handler, record)
+    logger.info(f" Finished assigning tags: f{handler.log}.")
+
+    logger.info(" Assigning object activities.")
+    with profiler.stage("assign_activities", handler):
+        handler.assign_activities()
+
+    if cnfg.get("fill_missing_activities"):
+        with profiler.stage("fill", handler) as record:
+            for group in cnfg["fill_missing_activities"]:
+                logger.info(f" Filling missing activities: {group}.")
+                zones, objects = handler.fill_missing_activities(**group)
+                logger.info(f" Filled {zones} zones with {objects} objects.")
+            release_unused(handler, record)
+
+    if cnfg.get("object_features"):
+        logger.info(f" Assigning object features: {cnfg['object_features']}.")
+        with profiler.stage("features", handler):
+            handler.add_features()
+
+    if "distance_to_nearest" in cnfg:
+        with profiler.stage("distances", handler):
+            for target_activity in cnfg["distance_to_nearest"]:
+                logger.info(f" Assigning distances to nearest {target_activity}.")
+                handler.assign_nearest_distance(target_activity)
+
+
+def release_unused(handler: build.ObjectHandler, record: dict):
+    """Release the parsed data of a handler which no stage after the given one uses, logging memory use.
+
+    Args:
+        handler (build.ObjectHandler): Handler which has just finished a stage.
+        record (dict): Stage record (see `profiling.Profiler.stage`), to which the released structures are added.
+    """
+    before = profiling.rss_mb()
+    record["released"] = handler.release_unused(record["name"])
+    if record["released"]:
+        profiling.trim_heap()
+    after = profiling.rss_mb()
+    if record["released"] and before is not None:
+        logger.info(
+            f" Released {', '.join(record['released'])} after {record['name']}:"
+            f" RSS {before:.0f} MB -> {after:.0f} MB."
+        )
+
+
+def write(
+    handler: build.ObjectHandler,
+    output_name: str,
+    format: str = "geopackage",
+    crs: list[str] = ("epsg:27700",),
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    compression: str = "snappy",
+    bbox_covering: bool = False,
+    spatial_index: bool = True,
+    engine: str = "auto",
+    partition_by: list[str] = (),
+    quadkey_zoom: int = 10,
+    facility_index: bool = False,
+    profiler: profiling.Profiler | None = None,
+) -> list[Path]:
+    """Write a handler's objects to file(s).
+
+    Args:
+        handler (build.ObjectHandler): Handler which has processed its objects.
+        output_name (str): Output file path prefix, to which the CRS and file extension will be added.
+        format (str, optional): Output file format. Defaults to "geopackage".
+        crs (list[str], optional): Output CRSs, as for `writers.write_outputs`. Defaults to ("epsg:27700",).
+        single_use (bool, optional): If True, write one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects written at a time. Defaults to 100_000.
+        compression (str, optional): Geoparquet compression codec. Defaults to "snappy".
+        bbox_covering (bool, optional): If True, add a bounding box column to geoparquet output. Defaults to False.
+        spatial_index (bool, optional): If True, build a spatial index in geopackage or flatgeobuf output.
+            Defaults to True.
+        engine (str, optional): Engine to write geojson, geopackage and flatgeobuf outputs with. Defaults to "auto".
+        partition_by (list[str], optional): Keys to partition geoparquet output by. Defaults to ().
+        quadkey_zoom (int, optional): Tile zoom level of quadkey partitions. Defaults to 10.
+        facility_index (bool, optional): If True, also write a facility index next to each output. Defaults to False.
+        profiler (profiling.Profiler | None, optional): Profiler to record the write stage with. Defaults to None.
+
+    Returns:
+        list[Path]: Paths of the written outputs.
+    """
+    profiler = profiler or profiling.Profiler(enabled=False)
+    logger.info(f" Writing objects to {format} format.")
+    with profiler.stage("write", handler) as record:
+        record["paths"] = writers.write_outputs(
+            handler,
+            output_name,
+            format=format,
+            crs=list(crs),
+            single_use=single_use,
+            batch_size=batch_size,
+            compression=compression,
+            bbox_covering=bbox_covering,
+            spatial_index=spatial_index,
+            engine=engine,
+            partition_by=list(partition_by),
+            quadkey_zoom=quadkey_zoom,
+            facility_index=facility_index,
+        )
+    return record["paths"]
+
+
+def process(
+    handler: build.ObjectHandler,
+    output_name: str,
+    sort: str | None = None,
+    profiler: profiling.Profiler | None = None,
+    **write_options,
+) -> list[Path]:
+    """Run all OSMOX stages configured in a handler's config on the objects it has parsed, then write the outputs.
+
+    Args:
+        handler (build.ObjectHandler): Handler which has parsed an input.
+        output_name (str): Output file path prefix, to which the CRS and file extension will be added.
+        sort (str | None, optional): Space-filling curve to sort objects along before processing. Defaults to None.
+        profiler (profiling.Profiler | None, optional): Profiler to record stages with. Defaults to None.
+        **write_options: Output options, as for `write`.
+
+    Returns:
+        list[Path]: Paths of the written outputs.
+    """
+    run_stages(handler, sort=sort, profiler=profiler)
+    return write(handler, output_name, profiler=profiler, **write_options)
+
+
+def load_manifest(manifest_path) -> list[dict]:
+    """Load a batch manifest of OSMOX jobs from a JSON file.
+
+    The manifest must contain a list of `jobs`, each with `config`, `input` and `output` paths,
+    which are relative to the manifest's directory, unless absolute.
+    Jobs can also have any of the `osmox run` options, named as in `JOB_DEFAULTS`.
+    Options given in the manifest's optional `defaults` apply to all jobs that don't set them.
+
+    Example:
+        {
+            "defaults": {"format": "geoparquet", "single_use": true},
+            "jobs": [
+                {"config": "configs/a.json", "input": "england.osm.pbf", "output": "outputs/a"},
+                {"config": "configs/b.json", "input": "england.osm.pbf", "output": "outputs/b", "crs": ["epsg:4326"]}
+            ]
+        }
+
+    Args:
+        manifest_path (str | Path): Manifest path.
+
+    Raises:
+        ValueError: If any job is missing a path, has unknown options, or partitions non-geoparquet output.
+
+    Returns:
+        list[dict]: Jobs, with all options set.
+    """
+    manifest_path = Path(manifest_path)
+    with open(manifest_path) as read_file:
+        manifest = json.load(read_file)
+    defaults = {**JOB_DEFAULTS, **manifest.get("defaults", {})}
+    jobs = []
+    for i, job in enumerate(manifest["jobs"]):
+        job = {**defaults, **job}
+        unknown = set(job).difference(JOB_DEFAULTS, JOB_PATHS)
+        if unknown:
+            raise ValueError(f"Job {i} has unknown options: {sorted(unknown)}")
+        missing = [key for key in JOB_PATHS if key not in job]
+        if missing:
+            raise ValueError(f"Job {i} is missing paths: {missing}")
+        for key in JOB_PATHS:
+            job[key] = manifest_path.parent / job[key]
+        if isinstance(job["crs"], str):
+            job["crs"] = [job["crs"]]
+        if job["partition_by"] and job["format"] != "geoparquet":
+            raise ValueError(
+                f"Job {i} has partitioned output, which requires 'geoparquet' format"
+            )
+        jobs.append(job)
+    return jobs
+
+
+def run_job_group(jobs: list[dict]) -> list[list[Path]]:
+    """Run jobs which share an input, parsing the input only once.
+
+    Args:
+        jobs (list[dict]): Jobs with the same input, processing CRS, geoparquet ID and tags columns and batch size.
+
+    Returns:
+        list[list[Path]]: Paths of the written outputs of each job.
+    """
+    configs = [config.load_compiled(job["config"]) for job in jobs]
+    for cnfg in configs:
+        config.validate_activity_config(cnfg)
+    first = jobs[0]
+    parse_options = {
+        key: first[key] for key in ["id_column", "tags_column", "batch_size"]
+    }
+
+    shared = None
+    if len(jobs) > 1:
+        logger.info(f" Parsing {first['input']} once for {len(jobs)} jobs.")
+        shared = build.ObjectHandler(
+            config.union_config(configs), crs=first["crs"][0], share_parse=True
+        )
+        parse_input(shared, first["input"], **parse_options)
+
+    paths = []
+    for job, cnfg in zip(jobs, configs, strict=True):
+        logger.info(
+            f" Running job with config {job['config']}, writing to {job['output']}."
+        )
+        handler = build.ObjectHandler(
+            config=cnfg,
+            crs=job["crs"][0],
+            lazy=job["lazy"],
+            workers=job["workers"],
+            geometry_storage=job["geometry_storage"],
+            geometry_precision=job["geometry_precision"],
+        )
+        if shared is None:
+            parse_input(handler, job["input"], **parse_options)
+        else:
+            handler.apply_parsed(shared)
+        job["output"].parent.mkdir(parents=True, exist_ok=True)
+        options = {
+            key: job[key]
+            for key in JOB_DEFAULTS
+            if key
+            not in [
+                "lazy",
+                "workers",
+                "geometry_storage",
+                "geometry_precision",
+                "id_column",
+                "tags_column",
+            ]
+        }
+        paths.append(process(handler, str(job["output"]), **options))
+    return paths
+
+
+def run_batch(jobs: list[dict], processes: int = 1) -> list[list[Path]]:
+    """Run many OSMOX jobs, sharing one parse of each input between the jobs that use it.
+
+    Jobs which share an input (and the options it is parsed with: processing CRS, geoparquet ID and tags columns
+    and batch size) are run as a group.
+    With more than one process, groups run concurrently in a process pool, and groups are split across spare
+    processes, at the cost of parsing their input once per process.
+
+    Args:
+        jobs (list[dict]): Jobs, e.g. as loaded by `load_manifest`.
+        processes (int, optional): Number of processes to run jobs in. Defaults to 1.
+
+    Returns:
+        list[list[Path]]: Paths of the written outputs of each job, in the order of `jobs`.
+    """
+    groups = {}
+    for i, job in enumerate(jobs):
+        key = (
+            os.path.realpath(job["input"]),
+            job["crs"][0],
+            job["id_column"],
+            job["tags_column"],
+            job["batch_size"],
+        )
+        groups.setdefault(key, []).append(i)
+
+    # split groups into chunks, so that there is a chunk for each process if there are fewer groups than processes
+    chunks = []
+    for group in groups.values():
+        n = max(1, min(len(group), processes // len(groups)))
+        chunks.extend(group[i::n] for i in range(n))
+
+    paths = [None] * len(jobs)
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(chunks))) as pool:
+            futures = [
+                pool.submit(run_job_group, [jobs[i] for i in chunk]) for chunk in chunks
+            ]
+            for chunk, future in zip(chunks, futures, strict=True):
+                for i, job_paths in zip(chunk, future.result(), strict=True):
+                    paths[i] = job_paths
+    else:
+        for chunk in chunks:
+            for i, job_paths in zip(
+                chunk, run_job_group([jobs[i] for i in chunk]), strict=True
+            ):
+                paths[i] = job_paths
+    return paths
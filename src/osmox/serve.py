@@ -0,0 +1,348 @@
+"""Local HTTP API answering batched facility queries."""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from osmox.facilities import FacilityIndex
+
+logger = logging.getLogger(__name__)
+
+QUERY_TYPES = ["bbox", "within", "nearest", "sample"]
+MAX_REQUEST_SIZE = 64 * 2**20
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+def open_facilities(path: str | Path) -> FacilityIndex:
+    """Open a persisted facility index directory, or load and index an output file in memory."""
+    path = Path(path)
+    if path.is_dir():
+        return FacilityIndex(path)
+    return FacilityIndex.from_output(path)
+
+
+class FacilityServer:
+    """Answer facility queries over a local HTTP API, from a facility index which is only loaded once.
+
+    Clients POST a JSON object to `/query`, holding a list of `queries`, and receive a JSON object holding a list of
+    `results`: one list of facilities per query, or an object with an `error` message if the query is invalid.
+    A query is an object with a `type` and the arguments of the `FacilityIndex` query method of that name:
+
+    - `{"type": "bbox", "bbox": [minx, miny, maxx, maxy]}`
+    - `{"type": "within", "point": [x, y], "distance": 2000}`
+    - `{"type": "nearest", "point": [x, y], "k": 5}`
+    - `{"type": "sample", "point": [x, y], "distance": 2000, "n": 1, "weight": "floor_area", "seed": 42}`
+
+    Any query can also have a list of `activities` that facilities must have one of,
+    and a list of `columns` to return (default: all), where "x" and "y" are the facility coordinates.
+
+    Queries from all concurrent requests are queued and run together in batches, in a worker thread.
+    Results of repeated queries are cached, apart from those of samples without a seed,
+    and identical queries which are received while one is queued share its results.
+    `GET /health` returns the number of facilities, the CRS of their coordinates and query counts.
+    """
+
+    def __init__(
+        self,
+        facilities: FacilityIndex,
+        batch_size: int = 1024,
+        cache_size: int = 100_000,
+    ):
+        """Set up a server, which is started with `start`.
+
+        Args:
+            facilities (FacilityIndex): Facilities to query.
+            batch_size (int, optional): Maximum number of queries to run at a time. Defaults to 1024.
+            cache_size (int, optional): Maximum number of query results to cache. Defaults to 100_000.
+        """
+        self.facilities = facilities
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.stats = {"requests": 0, "queries": 0, "cache_hits": 0, "batches": 0}
+        self._queue = None
+        self._batcher = None
+        self._running = {}  # futures of queued queries, keyed by cache key
+        self._connections = {}  # handler tasks of open connections, and their writers
+
+    def query_rows(self, query: dict) -> tuple[np.ndarray, np.ndarray | None]:
+        """Run a single query, getting facility rows and their distances to the query point, if any.
+
+        Raises:
+            ValueError: If the query type is unknown.
+            KeyError: If a required query argument is missing.
+        """
+        if query.get("type") not in QUERY_TYPES:
+            raise ValueError(
+                f"Unknown query type: {query.get('type')}, expected one of {QUERY_TYPES}"
+            )
+        facilities = self.facilities
+        activities = query.get("activities")
+        if query["type"] == "bbox":
+            return facilities.bbox_rows(*query["bbox"], activities=activities), None
+        x, y = query["point"]
+        if query["type"] == "within":
+            return facilities.within_rows(x, y, query["distance"], activities)
+        if query["type"] == "nearest":
+            return facilities.nearest_rows(x, y, query.get("k", 1), activities)
+        return facilities.sample_rows(
+            x,
+            y,
+            query["distance"],
+            n=query.get("n", 1),
+            activities=activities,
+            weight=query.get("weight"),
+            replace=query.get("replace", True),
+            seed=query.get("seed"),
+        )
+
+    def run_batch(self, queries: list[dict]) -> list[list[dict] | dict]:
+        """Run a batch of queries, taking the facilities found by all of them from the index at once.
+
+        Returns:
+            list[list[dict] | dict]: Facility records per query, or an error message if the query is invalid.
+        """
+        found = []
+        for query in queries:
+            try:
+                found.append(self.query_rows(query))
+            except (KeyError, TypeError, ValueError) as err:
+                message = (
+                    f"Missing query argument: {err}"
+                    if type(err) is KeyError
+                    else str(err)
+                )
+                found.append({"error": message})
+        succeeded = [f for f in found if isinstance(f, tuple)]
+        rows = (
+            np.concatenate([f[0] for f in succeeded])
+            if succeeded
+            else np.empty(0, dtype=np.int64)
+        )
+        records = self.records(rows)
+
+        results = []
+        start = 0
+        for query, f in zip(queries, found, strict=True):
+            if isinstance(f, dict):
+                results.append(f)
+                continue
+            query_rows, distances = f
+            result = records[start : start + len(query_rows)]
+            start += len(query_rows)
+            if distances is not None:
+                result = [
+                    {**r, "distance": float(d)}
+                    for r, d in zip(result, distances, strict=True)
+                ]
+            if query.get("columns") is not None:
+                result = [{c: r.get(c) for c in query["columns"]} for r in result]
+            results.append(result)
+        return results
+
+    def records(self, rows: np.ndarray) -> list[dict]:
+        """Get facility rows as JSON serialisable records, with "x" and "y" coordinates instead of a geometry."""
+        records = self.facilities.take(rows).to_pylist()
+        for record in records:
+            record.update(record.pop("geometry"))
+        return records
+
+    @staticmethod
+    def cache_key(query: dict) -> str | None:
+        """Key of a query in the result cache, or None if its results should not be cached."""
+        if query.get("type") == "sample" and query.get("seed") is None:
+            return None
+        return json.dumps(query, sort_keys=True)
+
+    async def query(self, queries: list[dict]) -> list[list[dict] | dict]:
+        """Answer queries, from the result cache or by queueing them to be run in the next batch."""
+        self.stats["queries"] += len(queries)
+        results = [None] * len(queries)
+        pending = {}
+        loop = asyncio.get_running_loop()
+        for n, query in enumerate(queries):
+            key = self.cache_key(query)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                results[n] = self.cache[key]
+                self.stats["cache_hits"] += 1
+            elif key in self._running:
+                pending[n] = (key, self._running[key])
+                self.stats["cache_hits"] += 1
+            else:
+                future = loop.create_future()
+                self._queue.put_nowait((query, future))
+                pending[n] = (key, future)
+                if key is not None:
+                    self._running[key] = future
+        for n, (key, future) in pending.items():
+            results[n] = await future
+            # only the first query to get a shared result caches it
+            first = key is not None and self._running.pop(key, None) is not None
+            if first and self.cache_size and not isinstance(results[n], dict):
+                self.cache[key] = results[n]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return results
+
+    async def _run_batches(self):
+        """Run queued queries in batches, in a worker thread so that requests can still be received."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(
+                    None, self.run_batch, [q for q, _ in batch]
+                )
+            except Exception as err:
+                logger.exception("Failed to run a batch of queries")
+                results = [{"error": f"Failed to run query: {err}"}] * len(batch)
+            self.stats["batches"] += 1
+            for (_, future), result in zip(batch, results, strict=True):
+                if not future.done():
+                    future.set_result(result)
+
+    async def respond(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        """Get the status code and JSON payload of the response to a request."""
+        self.stats["requests"] += 1
+        path = path.split("?")[0]
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "Use GET /health"}
+            return 200, {
+                "facilities": len(self.facilities),
+                "crs": self.facilities.crs.to_string(),
+                **self.stats,
+            }
+        if path != "/query":
+            return 404, {"error": f"Unknown path: {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST /query"}
+        try:
+            queries = json.loads(body)["queries"]
+            if not isinstance(queries, list) or not all(
+                isinstance(q, dict) for q in queries
+            ):
+                raise ValueError("queries must be a list of objects")
+        except (KeyError, TypeError, ValueError) as err:
+            return 400, {
+                "error": f'Expected a JSON object holding a list of "queries": {err}'
+            }
+        return 200, {"results": await self.query(queries)}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handle the HTTP/1.1 requests of a client connection, which is kept alive unless the client closes it."""
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while request_line := await reader.readline():
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                    headers = {}
+                    while (line := await reader.readline()).strip():
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length", 0))
+                    if length > MAX_REQUEST_SIZE:
+                        raise ValueError(
+                            f"Request body is larger than {MAX_REQUEST_SIZE} bytes"
+                        )
+                except ValueError as err:
+                    await self._write(
+                        writer, 400, {"error": f"Malformed request: {err}"}, False
+                    )
+                    break
+                status, payload = await self.respond(
+                    method, path, await reader.readexactly(length)
+                )
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                await self._write(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            del self._connections[task]
+
+    @staticmethod
+    async def _write(
+        writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool
+    ):
+        body = json.dumps(payload).encode()
+        head = (
+            f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def start(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        unix_socket: str | Path | None = None,
+    ) -> asyncio.Server:
+        """Start serving, on a TCP host and port or a Unix socket.
+
+        Args:
+            host (str, optional): Host to listen on. Defaults to "127.0.0.1", i.e. only local clients.
+            port (int, optional): Port to listen on. Defaults to 8000. Use 0 to listen on any free port.
+            unix_socket (str | Path | None, optional):
+                If given, listen on a Unix socket at this path, instead of on a host and port. Defaults to None.
+
+        Returns:
+            asyncio.Server: Started server.
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self.handle, path=str(unix_socket))
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self, server: asyncio.Server):
+        """Stop a started server, closing any open connections, and the running of queued queries."""
+        server.close()
+        for writer in self._connections.values():
+            writer.transport.abort()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await server.wait_closed()
+        self._batcher.cancel()
+
+
+def serve(
+    facilities: FacilityIndex,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: str | Path | None = None,
+    batch_size: int = 1024,
+    cache_size: int = 100_000,
+) -> None:
+    """Serve facility queries until interrupted (see `FacilityServer`)."""
+
+    async def _serve():
+        server = FacilityServer(
+            facilities, batch_size=batch_size, cache_size=cache_size
+        )
+        started = await server.start(host, port, unix_socket)
+        address = unix_socket or "http://{}:{}".format(
+            *started.sockets[0].getsockname()[:2]
+        )
+        logger.warning(f" Serving {len(facilities)} facilities on {address}.")
+        try:
+            await started.serve_forever()
+        finally:
+            await server.stop(started)
+
+    asyncio.run(_serve())
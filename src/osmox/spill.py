@@ -0,0 +1,504 @@
+"""Out-of-core runs, which spill the input to disk and process it in spatial chunks that fit a memory limit."""
+
+import json
+import logging
+import math
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import osmium
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS, Transformer
+
+from osmox import build, config, helpers, profiling, runner, tiling
+
+logger = logging.getLogger(__name__)
+
+# rough memory use of one parsed object, point or area by the end of a run, with headroom for stage peaks
+BYTES_PER_ENTITY = 4096
+# resolution of the grid of entity counts which chunks are sized with
+GRID_CELLS = 512
+# memory used to read an OSM file with pyosmium however small it is, e.g. for read buffers and worker threads
+OSM_READ_MB = 48
+# memory used to merge chunk outputs and write them, on top of that used by the last chunk, e.g. for writer threads
+MERGE_MB = 32
+
+
+def spill_schema(
+    id_type: pa.DataType | None = None, tags_type: pa.DataType | None = None
+) -> pa.Schema:
+    """Schema of spilled OSM elements: ID (integer by default), map of tags and WKB geometry in OGC:CRS84 (lon, lat)."""
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+    }
+    return pa.schema(
+        [
+            ("id", id_type or pa.int64()),
+            ("tags", tags_type or pa.map_(pa.string(), pa.string())),
+            ("geometry", pa.binary()),
+        ],
+        metadata={b"geo": json.dumps(geo).encode()},
+    )
+
+
+class SpillWriter:
+    """Write OSM elements to a GeoParquet file, one batch at a time, tracking the bounds of their geometries.
+
+    With `max_rows`, elements are held in memory until there are more than `max_rows` of them,
+    and only then written to the file, so the file is only written if there are.
+
+    Args:
+        path (str | Path): Output path.
+        schema (pa.Schema, optional): Output schema (see `spill_schema`). Defaults to None, i.e. integer IDs.
+        batch_size (int, optional): Number of elements added with `add` to buffer before writing them. Defaults to 100_000.
+        max_rows (int, optional): Number of elements to hold in memory before writing any. Defaults to None, i.e. none.
+    """
+
+    def __init__(self, path, schema=None, batch_size=100_000, max_rows=None):
+        """Open the output file, unless elements are held in memory until there are more than `max_rows`."""
+        self.path = path
+        self.schema = schema or spill_schema()
+        self.writer = pq.ParquetWriter(path, self.schema) if max_rows is None else None
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.held = []
+        self.rows = []
+        self.count = 0
+        self.bounds = (math.inf, math.inf, -math.inf, -math.inf)
+
+    def add(self, idx, tags, wkb):
+        """Add an element, writing buffered elements once there are `batch_size` of them."""
+        self.rows.append((idx, tags, wkb))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered elements."""
+        if self.rows:
+            ids, tags, wkbs = zip(*self.rows, strict=True)
+            self.write(ids, tags, wkbs)
+            self.rows = []
+
+    def write(self, ids, tags, wkbs):
+        """Write a batch of elements, or hold it in memory if there are at most `max_rows` elements so far."""
+        bounds = shapely.total_bounds(shapely.from_wkb(np.asarray(wkbs, dtype=object)))
+        self.bounds = (
+            *np.fmin(self.bounds[:2], bounds[:2]).tolist(),
+            *np.fmax(self.bounds[2:], bounds[2:]).tolist(),
+        )
+        batch = pa.record_batch(
+            [
+                pa.array(ids, self.schema.field("id").type),
+                pa.array(tags, self.schema.field("tags").type),
+                pa.array(wkbs, pa.binary()),
+            ],
+            schema=self.schema,
+        )
+        self.count += len(ids)
+        if self.writer is None and self.count <= self.max_rows:
+            self.held.append(batch)
+            return
+        if self.writer is None:
+            logger.info(f" Spilling more than {self.max_rows} elements to {self.path}.")
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+            for held in self.held:
+                self.writer.write_batch(held)
+            self.held = []
+        self.writer.write_batch(batch)
+
+    @property
+    def spilled(self) -> bool:
+        """Whether elements have been written to the file, rather than held in memory."""
+        return self.writer is not None
+
+    def table(self) -> pa.Table:
+        """Elements held in memory, if they have not been spilled."""
+        return pa.Table.from_batches(self.held, schema=self.schema)
+
+    def close(self):
+        """Write any buffered elements, and close the output file if it was opened."""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class SpillHandler(osmium.SimpleHandler):
+    """Spill the OSM elements that a config selects or maps to a `SpillWriter`, with all of their tags.
+
+    An `ObjectHandler` reading the spilled file with `apply_geoparquet` finds the same objects, points and areas
+    as if it had parsed the OSM file itself.
+    """
+
+    wkbfab = osmium.geom.WKBFactory()
+
+    def __init__(self, cnfg, writer: SpillWriter):
+        """Spill elements selected or mapped by a config to a writer."""
+        super().__init__()
+        self.cnfg = config.compile_config(cnfg)
+        self.writer = writer
+
+    def spill(self, obj, create):
+        """Spill an OSM element if the config selects or maps any of its tags, with a geometry made by `create`."""
+        tags = dict(obj.tags)
+        if tags and (self.cnfg.selects(tags) or self.cnfg.mapped_tags(tags)):
+            try:
+                wkb = bytes.fromhex(create(obj))
+            except RuntimeError:
+                logger.warning(f" RuntimeError encountered for: {obj}")
+                return
+            self.writer.add(obj.id, list(tags.items()), wkb)
+
+    def node(self, n):
+        """Spill a node as a point."""
+        self.spill(n, self.wkbfab.create_point)
+
+    def area(self, a):
+        """Spill an area as a multipolygon."""
+        self.spill(a, self.wkbfab.create_multipolygon)
+
+
+def spill_input(
+    cnfg,
+    input_path,
+    spill_path,
+    id_column: str = "id",
+    tags_column: str = "tags",
+    batch_size: int = 100_000,
+    max_rows: int | None = None,
+) -> tuple[int, tuple[float, float, float, float], pa.Table | None]:
+    """Spill the OSM elements of an input that a config selects or maps to a GeoParquet file in OGC:CRS84.
+
+    OSM files are parsed with a file-based node location index next to the spilled file,
+    so that node locations are not held in memory either.
+    Only one batch of elements is held in memory at a time, unless there are at most `max_rows` elements,
+    in which case they are all held in memory and not spilled at all.
+
+    Args:
+        cnfg (dict): Config.
+        input_path (str | Path): OSM file, or GeoParquet file or dataset directory, as for `runner.parse_input`.
+        spill_path (str | Path): Spilled file path.
+        id_column (str, optional): Name of the OSM ID column, if reading from geoparquet. Defaults to "id".
+        tags_column (str, optional): Name of the OSM tags column, if reading from geoparquet. Defaults to "tags".
+        batch_size (int, optional): Maximum number of elements held in memory at a time. Defaults to 100_000.
+        max_rows (int | None, optional):
+            Number of elements to hold in memory rather than spill, if there are no more. Defaults to None, i.e. none.
+
+    Returns:
+        tuple[int, tuple[float, float, float, float], pa.Table | None]:
+            Number of elements, the bounds of their geometries, and the elements if they were not spilled.
+    """
+    cnfg = config.compile_config(cnfg)
+    input_path, spill_path = Path(input_path), Path(spill_path)
+    if not (input_path.is_dir() or input_path.suffix == ".parquet"):
+        writer = SpillWriter(spill_path, batch_size=batch_size, max_rows=max_rows)
+        index_path = spill_path.with_suffix(".locations")
+        SpillHandler(cnfg, writer).apply_file(
+            str(input_path), locations=True, idx=f"sparse_file_array,{index_path}"
+        )
+        index_path.unlink(missing_ok=True)
+        writer.close()
+        return writer.count, writer.bounds, None if writer.spilled else writer.table()
+
+    dataset = ds.dataset(input_path, format="parquet")
+    metadata = dataset.schema.metadata or {}
+    geo = json.loads(metadata[b"geo"]) if b"geo" in metadata else {}
+    geometry_column = geo.get("primary_column", "geometry")
+    crs = geo.get("columns", {}).get(geometry_column, {}).get("crs")
+    to_lonlat = (
+        Transformer.from_crs(CRS.from_json_dict(crs), CRS("epsg:4326"), always_xy=True)
+        if crs
+        else None
+    )
+    schema = spill_schema(
+        dataset.schema.field(id_column).type, dataset.schema.field(tags_column).type
+    )
+    writer = SpillWriter(
+        spill_path, schema=schema, batch_size=batch_size, max_rows=max_rows
+    )
+    predicates = [*cnfg.filter_values.items(), *cnfg.activity_values.items()]
+    for batch in dataset.to_batches(
+        columns=[id_column, tags_column, geometry_column], batch_size=batch_size
+    ):
+        batch = batch.filter(
+            build.ObjectHandler._tag_predicate(batch.column(tags_column), predicates)
+        )
+        if not len(batch):
+            continue
+        wkbs = batch.column(geometry_column).to_numpy(zero_copy_only=False)
+        if to_lonlat is not None:
+            geoms = shapely.transform(
+                shapely.from_wkb(wkbs),
+                lambda x, y: helpers.transform_xy(to_lonlat, x, y),
+                interleaved=False,
+            )
+            wkbs = shapely.to_wkb(geoms)
+        writer.write(batch.column(id_column), batch.column(tags_column), list(wkbs))
+    writer.close()
+    return writer.count, writer.bounds, None if writer.spilled else writer.table()
+
+
+def entity_counts(
+    spill_path, bounds: tuple[float, float, float, float], batch_size: int = 100_000
+) -> np.ndarray:
+    """Count spilled elements in a square grid of `GRID_CELLS` x `GRID_CELLS` cells from the minimum of the bounds.
+
+    Elements are counted in the cell containing the centre of their bounding box.
+
+    Returns:
+        np.ndarray: Counts, indexed by (column, row).
+    """
+    minx, miny, maxx, maxy = bounds
+    cell = max(maxx - minx, maxy - miny) / GRID_CELLS or 1.0
+    counts = np.zeros((GRID_CELLS, GRID_CELLS), dtype=np.int64)
+    for batch in ds.dataset(spill_path, format="parquet").to_batches(
+        columns=["geometry"], batch_size=batch_size
+    ):
+        b = shapely.bounds(
+            shapely.from_wkb(batch.column(0).to_numpy(zero_copy_only=False))
+        )
+        columns = np.clip(
+            ((b[:, 0] + b[:, 2]) / 2 - minx) // cell, 0, GRID_CELLS - 1
+        ).astype(int)
+        rows = np.clip(
+            ((b[:, 1] + b[:, 3]) / 2 - miny) // cell, 0, GRID_CELLS - 1
+        ).astype(int)
+        np.add.at(counts, (columns, rows), 1)
+    return counts
+
+
+def chunk_size(
+    counts: np.ndarray,
+    bounds: tuple[float, float, float, float],
+    halo: float,
+    max_entities: int,
+) -> float:
+    """Largest tile size (in degrees) whose tiles each parse at most `max_entities` elements within their halo.
+
+    Tile sizes are tried from the extent of the bounds, halving each time.
+
+    Args:
+        counts (np.ndarray): Element counts, as from `entity_counts`.
+        bounds (tuple[float, float, float, float]): Bounds of the elements.
+        halo (float): Tile halo, in metres.
+        max_entities (int): Maximum number of elements per tile.
+
+    Returns:
+        float: Tile size. If no tile size is small enough, the size at which halving tiles stops making the largest
+            tile smaller, e.g. once halos make up most of each tile.
+    """
+    minx, miny, maxx, maxy = bounds
+    extent = max(maxx - minx, maxy - miny) or 1.0
+    cell = extent / GRID_CELLS
+    # summed area table, so that counts within any range of cells can be looked up
+    table = np.zeros((GRID_CELLS + 1, GRID_CELLS + 1), dtype=np.int64)
+    table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+    previous = None
+    for k in range(int(math.log2(GRID_CELLS)) + 1):
+        tile_size = extent / 2**k
+        halos = np.array(
+            [tile.halo for tile in tiling.tile_grid(bounds, tile_size, halo)]
+        )
+        x0, y0 = (
+            np.floor((halos[:, :2] - (minx, miny)) / cell)
+            .clip(0, GRID_CELLS)
+            .astype(int)
+            .T
+        )
+        x1, y1 = (
+            np.ceil((halos[:, 2:] - (minx, miny)) / cell)
+            .clip(0, GRID_CELLS)
+            .astype(int)
+            .T
+        )
+        largest = (table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0]).max()
+        if largest <= max_entities:
+            return tile_size
+        if previous is not None and largest >= previous[1]:
+            break
+        previous = (tile_size, largest)
+    logger.warning(
+        f" Cannot split the input into chunks of at most {max_entities} elements. "
+        "Peak memory use may be above the memory limit."
+    )
+    return previous[0]
+
+
+def partition(plan: dict, spill_path, batch_size: int = 100_000):
+    """Split spilled elements into one GeoParquet file per tile of a tiled run plan, and set them as the tile inputs.
+
+    Each tile input holds the elements which intersect the tile's parse bounds (see `tiling.parse_bbox`),
+    so elements near tile edges are written to more than one tile input.
+    """
+    tiles = tiling.tiles(plan)
+    bboxes = shapely.box(
+        *np.array([tiling.parse_bbox(plan, tile) for tile in tiles.values()]).T
+    )
+    input_dir = tiling.tile_dir(plan) / "inputs"
+    input_dir.mkdir(parents=True, exist_ok=True)
+    dataset = ds.dataset(spill_path, format="parquet")
+    writers = {}
+    for batch in dataset.to_batches(batch_size=batch_size):
+        geoms = shapely.from_wkb(
+            batch.column("geometry").to_numpy(zero_copy_only=False)
+        )
+        tile_index, element_index = shapely.STRtree(geoms).query(
+            bboxes, predicate="intersects"
+        )
+        for i in np.unique(tile_index):
+            name = plan["tiles"][i]["name"]
+            if name not in writers:
+                writers[name] = pq.ParquetWriter(
+                    input_dir / f"{name}.parquet", dataset.schema
+                )
+            writers[name].write_batch(
+                batch.take(pa.array(np.sort(element_index[tile_index == i])))
+            )
+    for tile in plan["tiles"]:
+        path = input_dir / f"{tile['name']}.parquet"
+        if tile["name"] in writers:
+            writers[tile["name"]].close()
+        else:
+            pq.write_table(dataset.schema.empty_table(), path)
+        tile["input"] = str(path)
+
+
+def release_memory():
+    """Return freed memory of the Python heap and the arrow memory pool to the operating system."""
+    pa.default_memory_pool().release_unused()
+    profiling.trim_heap()
+
+
+def entity_budget(memory_limit: float) -> int:
+    """Number of OSM elements that can be processed at once within a memory budget (in MB), given current memory use."""
+    return max(
+        1, int((memory_limit - (profiling.rss_mb() or 0.0)) * 2**20 / BYTES_PER_ENTITY)
+    )
+
+
+def run_out_of_core(
+    config_path,
+    input_path,
+    output_name: str,
+    memory_limit: float,
+    halo: float = 5000.0,
+    profiler: profiling.Profiler | None = None,
+    **options,
+) -> list[Path]:
+    """Run OSMOX within a memory budget, by spilling the input to disk and processing it in spatial chunks if needed.
+
+    The OSM elements that the config selects or maps are first read into memory, as long as they fit in the budget.
+    If they all fit, the run carries on in memory as an unlimited run would.
+    Otherwise, all elements are spilled to a GeoParquet file,
+    and then split into a grid of tiles (with halos, see `osmox.tiling`) that each fit in the memory budget.
+    Tiles are run one at a time, and their outputs merged one at a time, as for `osmox tiles merge`.
+    If the input cannot be split into more than one tile, e.g. if it is smaller than the halo,
+    the spilled elements are run in memory instead.
+    Spilled and tile files are written to a temporary directory next to the outputs, and removed afterwards.
+
+    Args:
+        config_path (str | Path): Config path.
+        input_path (str | Path): OSM file, or GeoParquet file or dataset directory.
+        output_name (str): Output file path prefix, to which the CRS and file extension will be added.
+        memory_limit (float): Memory budget, in MB.
+        halo (float, optional): Minimum width of the overlap around each chunk, in metres. Defaults to 5000.0.
+        profiler (profiling.Profiler | None, optional): Profiler to record stages with. Defaults to None.
+        **options: `osmox run` options, as in `runner.JOB_DEFAULTS`.
+
+    Raises:
+        ValueError: If the memory budget is already used up.
+
+    Returns:
+        list[Path]: Paths of the written outputs.
+    """
+    profiler = profiler or profiling.Profiler(enabled=False)
+    rss = profiling.rss_mb() or 0.0
+    input_path = Path(input_path)
+    read_mb = (
+        0 if input_path.is_dir() or input_path.suffix == ".parquet" else OSM_READ_MB
+    )
+    if memory_limit <= rss + read_mb:
+        needed = f" plus the {read_mb}MB needed to read an OSM file" if read_mb else ""
+        raise ValueError(
+            f"Memory limit of {memory_limit}MB is below current memory use of {rss:.0f}MB{needed}"
+        )
+    options = {**runner.JOB_DEFAULTS, **options}
+    # elements are read and objects written a batch at a time, so batches must fit in the budget too
+    max_entities = entity_budget(memory_limit - read_mb)
+    batch_size = min(options["batch_size"], max_entities)
+    options["batch_size"] = batch_size
+    cnfg = config.load_compiled(config_path)
+
+    with tempfile.TemporaryDirectory(
+        dir=Path(output_name).resolve().parent,
+        prefix=f"{Path(output_name).name}_spill_",
+    ) as tmp:
+        spill_path = Path(tmp) / "spill.parquet"
+        with profiler.stage("spill") as record:
+            count, bounds, elements = spill_input(
+                cnfg,
+                input_path,
+                spill_path,
+                id_column=options.pop("id_column"),
+                tags_column=options.pop("tags_column"),
+                batch_size=batch_size,
+                max_rows=max_entities,
+            )
+            record["elements"] = count
+            record["spilled"] = elements is None
+
+        if elements is None:
+            logger.info(f" Spilled {count} elements to {spill_path}.")
+            release_memory()
+            chunk_entities = entity_budget(memory_limit - MERGE_MB)
+            tile_size = chunk_size(
+                entity_counts(spill_path, bounds, batch_size),
+                bounds,
+                halo,
+                chunk_entities,
+            )
+            plan = tiling.plan_tiles(
+                config_path, spill_path, output_name, tile_size, halo, bounds, **options
+            )
+            plan["tile_dir"] = tmp
+            if len(plan["tiles"]) > 1:
+                partition(plan, spill_path, batch_size)
+                spill_path.unlink()
+                logger.info(
+                    f" Running {len(plan['tiles'])} chunks of at most {chunk_entities} elements "
+                    f"within a memory limit of {memory_limit}MB."
+                )
+                with profiler.stage("chunks"):
+                    tiling.run_tiles(plan)
+                with profiler.stage("merge"):
+                    return tiling.merge_tiles(plan)
+
+        logger.info(
+            f" Running on {count} elements in memory, within a memory limit of {memory_limit}MB."
+        )
+        handler = build.ObjectHandler(
+            config=cnfg,
+            crs=options["crs"][0],
+            lazy=options["lazy"],
+            workers=options["workers"],
+            geometry_storage=options["geometry_storage"],
+            geometry_precision=options["geometry_precision"],
+        )
+        with profiler.stage("parse", handler):
+            handler.apply_geoparquet(
+                spill_path if elements is None else elements, batch_size=batch_size
+            )
+        del elements
+        release_memory()
+        return runner.process(
+            handler,
+            output_name,
+            sort=options["sort"],
+            profiler=profiler,
+            **{key: options[key] for key in tiling.WRITE_OPTIONS},
+        )
@@ -0,0 +1,581 @@
+"""Tiled runs, which run OSMOX on a grid of tiles with overlapping halos and merge the outputs."""
+
+import json
+import logging
+import math
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import osmium
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS, Transformer
+from shapely.geometry import box
+
+from osmox import build, config, helpers, runner, writers
+
+logger = logging.getLogger(__name__)
+
+METRES_PER_DEGREE = 111_320
+# options of a tiled run which are only used to write the merged outputs
+WRITE_OPTIONS = [
+    "format",
+    "crs",
+    "single_use",
+    "batch_size",
+    "compression",
+    "bbox_covering",
+    "spatial_index",
+    "engine",
+    "partition_by",
+    "quadkey_zoom",
+    "facility_index",
+]
+
+# IDs of objects created by activity infilling, `fill_<area ID>_<n>` (see `build.ObjectHandler.fill_missing_activities`)
+FILL_ID = r"^fill_(?P<area>.+)_(?P<n>\d+)$"
+
+# tiles may have their own input, e.g. the part of a larger input within their parse bounds (see `osmox.spill`)
+Tile = namedtuple("Tile", "name, column, row, core, halo, input", defaults=[None])
+
+
+class _BoundsHandler(osmium.SimpleHandler):
+    def __init__(self):
+        super().__init__()
+        self.bounds = [math.inf, math.inf, -math.inf, -math.inf]
+
+    def node(self, n):
+        lon, lat = n.location.lon, n.location.lat
+        self.bounds = [
+            min(self.bounds[0], lon),
+            min(self.bounds[1], lat),
+            max(self.bounds[2], lon),
+            max(self.bounds[3], lat),
+        ]
+
+
+def input_bounds(input_path) -> tuple[float, float, float, float]:
+    """Longitude and latitude bounds of an OSM file, or a GeoParquet file or dataset directory.
+
+    The bounds of OSM files are taken from the file header if given, or else from all node locations.
+
+    Args:
+        input_path (str | Path): Input path.
+
+    Returns:
+        tuple[float, float, float, float]: (min longitude, min latitude, max longitude, max latitude).
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir() or input_path.suffix == ".parquet":
+        dataset = ds.dataset(input_path, format="parquet")
+        metadata = dataset.schema.metadata or {}
+        geo = json.loads(metadata[b"geo"]) if b"geo" in metadata else {}
+        geometry_column = geo.get("primary_column", "geometry")
+        bounds = [math.inf, math.inf, -math.inf, -math.inf]
+        for batch in dataset.to_batches(columns=[geometry_column]):
+            geoms = shapely.from_wkb(batch.column(0).to_numpy(zero_copy_only=False))
+            if len(geoms):
+                batch_bounds = shapely.total_bounds(geoms)
+                bounds = [
+                    *np.minimum(bounds[:2], batch_bounds[:2]),
+                    *np.maximum(bounds[2:], batch_bounds[2:]),
+                ]
+        crs = geo.get("columns", {}).get(geometry_column, {}).get("crs")
+        if crs:
+            to_lonlat = Transformer.from_crs(
+                CRS.from_json_dict(crs), CRS("epsg:4326"), always_xy=True
+            )
+            outline = shapely.segmentize(box(*bounds), (bounds[2] - bounds[0]) / 100)
+            bounds = shapely.transform(
+                outline,
+                lambda x, y: helpers.transform_xy(to_lonlat, x, y),
+                interleaved=False,
+            ).bounds
+        return tuple(float(b) for b in bounds)
+
+    reader = osmium.io.Reader(str(input_path), osmium.osm.osm_entity_bits.NOTHING)
+    header_box = reader.header().box()
+    reader.close()
+    if header_box.valid():
+        return (
+            header_box.bottom_left.lon,
+            header_box.bottom_left.lat,
+            header_box.top_right.lon,
+            header_box.top_right.lat,
+        )
+    handler = _BoundsHandler()
+    handler.apply_file(str(input_path))
+    return tuple(handler.bounds)
+
+
+def tile_grid(
+    bounds: tuple[float, float, float, float], tile_size: float, halo: float
+) -> list[Tile]:
+    """Cut longitude and latitude bounds into a grid of square tiles, each with an overlapping halo.
+
+    Args:
+        bounds (tuple[float, float, float, float]): (min longitude, min latitude, max longitude, max latitude).
+        tile_size (float): Tile width and height, in degrees.
+        halo (float): Minimum width of the halo around each tile core, in metres.
+
+    Returns:
+        list[Tile]: Tiles, each with a `name`, grid `column` and `row`, and `core` and `halo` boxes as
+            (min longitude, min latitude, max longitude, max latitude).
+    """
+    minx, miny, maxx, maxy = bounds
+    columns = max(1, math.ceil((maxx - minx) / tile_size))
+    rows = max(1, math.ceil((maxy - miny) / tile_size))
+    tiles = []
+    for column in range(columns):
+        for row in range(rows):
+            core = (
+                minx + column * tile_size,
+                miny + row * tile_size,
+                minx + (column + 1) * tile_size,
+                miny + (row + 1) * tile_size,
+            )
+            halo_y = halo / METRES_PER_DEGREE
+            # degrees of longitude are shortest at the latitude furthest from the equator
+            max_lat = min(89.0, max(abs(core[1] - halo_y), abs(core[3] + halo_y)))
+            halo_x = halo / (METRES_PER_DEGREE * math.cos(math.radians(max_lat)))
+            tiles.append(
+                Tile(
+                    name=f"{column}_{row}",
+                    column=column,
+                    row=row,
+                    core=core,
+                    halo=(
+                        core[0] - halo_x,
+                        core[1] - halo_y,
+                        core[2] + halo_x,
+                        core[3] + halo_y,
+                    ),
+                )
+            )
+    return tiles
+
+
+def plan_tiles(
+    config_path,
+    input_path,
+    output_name: str,
+    tile_size: float = 1.0,
+    halo: float = 5000.0,
+    bounds: tuple[float, float, float, float] | None = None,
+    **options,
+) -> dict:
+    """Plan a tiled run of OSMOX, which can be run one tile at a time and then merged.
+
+    Args:
+        config_path (str | Path): Config path.
+        input_path (str | Path): Input path, as for `osmox run`.
+        output_name (str): Output file path prefix of the merged outputs, as for `osmox run`.
+            Tile outputs and the plan are written to the directory `<output_name>_tiles`.
+        tile_size (float, optional): Tile width and height, in degrees. Defaults to 1.0.
+        halo (float, optional): Minimum width of the overlap around each tile, in metres. Defaults to 5000.0.
+        bounds (tuple[float, float, float, float] | None, optional):
+            Longitude and latitude bounds to tile. Defaults to None, i.e. the bounds of the input.
+        **options: `osmox run` options, as in `runner.JOB_DEFAULTS`.
+
+    Raises:
+        ValueError: If any options are unknown.
+
+    Returns:
+        dict: Tiled run plan.
+    """
+    unknown = set(options).difference(runner.JOB_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown options: {sorted(unknown)}")
+    if bounds is None:
+        bounds = input_bounds(input_path)
+    tiles = tile_grid(bounds, tile_size, halo)
+    logger.info(
+        f" Planned {len(tiles)} tiles of {tile_size} degrees with {halo}m halos."
+    )
+    options = {**runner.JOB_DEFAULTS, **options}
+    options["crs"] = list(options["crs"])
+    options["partition_by"] = list(options["partition_by"])
+    return {
+        "config": str(Path(config_path).resolve()),
+        "input": str(Path(input_path).resolve()),
+        "output": str(Path(output_name).resolve()),
+        "bounds": list(bounds),
+        "tile_size": tile_size,
+        "halo": halo,
+        "options": options,
+        "tiles": [tile._asdict() for tile in tiles],
+    }
+
+
+def tile_dir(plan: dict) -> Path:
+    """Directory of the tile outputs and plan of a tiled run, `<output>_tiles` unless the plan sets a `tile_dir`."""
+    return Path(plan.get("tile_dir") or f"{plan['output']}_tiles")
+
+
+def write_plan(plan: dict) -> Path:
+    """Write a tiled run plan to `plan.json` in its tile directory, and return its path."""
+    path = tile_dir(plan) / "plan.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+    return path
+
+
+def load_plan(plan_path) -> dict:
+    """Load a tiled run plan."""
+    with open(plan_path) as f:
+        return json.load(f)
+
+
+def tiles(plan: dict) -> dict[str, Tile]:
+    """Tiles of a tiled run plan, by name."""
+    return {
+        tile["name"]: Tile(
+            **{**tile, "core": tuple(tile["core"]), "halo": tuple(tile["halo"])}
+        )
+        for tile in plan["tiles"]
+    }
+
+
+def grid_shape(plan: dict) -> tuple[int, int]:
+    """Number of columns and rows of tiles in a tiled run plan."""
+    return (
+        max(tile["column"] for tile in plan["tiles"]) + 1,
+        max(tile["row"] for tile in plan["tiles"]) + 1,
+    )
+
+
+def parse_bbox(plan: dict, tile: Tile) -> tuple[float, float, float, float]:
+    """Longitude and latitude bounds of the input parsed for a tile.
+
+    This is the tile halo, except that tiles on the edge of the grid also parse everything beyond the grid,
+    as objects may extend beyond the bounds of the input (e.g. beyond the bounds in an OSM file header).
+    """
+    columns, rows = grid_shape(plan)
+    minx, miny, maxx, maxy = tile.halo
+    return (
+        -180.0 if tile.column == 0 else minx,
+        -90.0 if tile.row == 0 else miny,
+        180.0 if tile.column == columns - 1 else maxx,
+        90.0 if tile.row == rows - 1 else maxy,
+    )
+
+
+def run_tile(plan: dict, name: str) -> Path:
+    """Run OSMOX for one tile of a tiled run plan, on the input within the tile halo.
+
+    Objects of the tile, including those in its halo, are written to `<name>.parquet` in the plan tile directory,
+    in the processing CRS and with one row per object.
+
+    Args:
+        plan (dict): Tiled run plan.
+        name (str): Tile name.
+
+    Returns:
+        Path: Tile output path.
+    """
+    tile = tiles(plan)[name]
+    options = plan["options"]
+    cnfg = config.load_compiled(plan["config"])
+    config.validate_activity_config(cnfg)
+    bbox = parse_bbox(plan, tile)
+    logger.info(f" Running tile {name} on input within {bbox}.")
+    handler = build.ObjectHandler(
+        config=cnfg,
+        crs=options["crs"][0],
+        lazy=options["lazy"],
+        workers=options["workers"],
+        geometry_storage=options["geometry_storage"],
+        geometry_precision=options["geometry_precision"],
+        bbox=bbox,
+    )
+    runner.parse_input(
+        handler,
+        tile.input or plan["input"],
+        id_column=options["id_column"],
+        tags_column=options["tags_column"],
+        batch_size=options["batch_size"],
+    )
+    runner.run_stages(handler, sort=options["sort"])
+    path = tile_dir(plan) / f"{name}.parquet"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(handler.to_arrow(), path)
+    return path
+
+
+def run_tiles(
+    plan: dict, names: list[str] | None = None, processes: int = 1
+) -> list[Path]:
+    """Run OSMOX for many tiles of a tiled run plan on this machine, in parallel processes.
+
+    Args:
+        plan (dict): Tiled run plan.
+        names (list[str] | None, optional): Names of the tiles to run. Defaults to None, i.e. all tiles.
+        processes (int, optional): Number of processes to run tiles in. Defaults to 1.
+
+    Returns:
+        list[Path]: Tile output paths.
+    """
+    names = list(tiles(plan)) if names is None else list(names)
+    if processes > 1 and len(names) > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(names))) as pool:
+            return list(pool.map(run_tile, [plan] * len(names), names))
+    return [run_tile(plan, name) for name in names]
+
+
+def merge_tiles(plan: dict) -> list[Path]:
+    """Merge the outputs of all tiles of a tiled run plan, and write them in the planned output format(s).
+
+    Objects are only kept from the tile whose core holds their centroid,
+    so objects which are in more than one tile (i.e. in the halo of others) are kept once.
+    Object IDs are then made unique across tiles (see `_unique_ids`).
+    Distances to the nearest activity are recalculated over all tiles for objects whose nearest target in their tile
+    is further away than the tile halo edge (or which had no target in their tile),
+    as their nearest target could lie beyond the halo.
+
+    Objects match those of an untiled run, other than in their order, if every object and area is parsed in full
+    by each tile it intersects, and if every tile that infills an area sees all existing objects in it,
+    i.e. if the halo is wider than the largest areas.
+    Tiles are merged one at a time into `merged.parquet` in the plan tile directory,
+    which is streamed to the outputs (see `writers.ObjectTable`) and then removed.
+    Only object IDs, and the centroids of targets and of objects with distances to recalculate,
+    are held in memory for all tiles.
+
+    Args:
+        plan (dict): Tiled run plan.
+
+    Raises:
+        FileNotFoundError: If any tile has not been run.
+
+    Returns:
+        list[Path]: Paths of the written outputs.
+    """
+    options = plan["options"]
+    crs = options["crs"][0]
+    cnfg = config.load_compiled(plan["config"])
+    distance_columns = [
+        f"distance_to_nearest_{act}" for act in cnfg.get("distance_to_nearest", [])
+    ]
+    paths = {name: tile_dir(plan) / f"{name}.parquet" for name in tiles(plan)}
+    missing = [name for name, path in paths.items() if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Tiles have not been run: {missing}")
+
+    to_lonlat = Transformer.from_crs(CRS(crs), CRS("epsg:4326"), always_xy=True)
+    from_lonlat = Transformer.from_crs(CRS("epsg:4326"), CRS(crs), always_xy=True)
+    minx, miny = plan["bounds"][:2]
+    columns, rows = grid_shape(plan)
+
+    # first pass: find the core rows of each tile, and where distances need recalculating
+    cores, fixes, ids = {}, {}, {}
+    targets = {name: [] for name in distance_columns}
+    offset = 0
+    for tile in tiles(plan).values():
+        names = pq.read_schema(paths[tile.name]).names
+        table = pq.read_table(
+            paths[tile.name],
+            columns=[
+                "id",
+                "activities",
+                "geometry",
+                *(n for n in distance_columns if n in names),
+            ],
+        )
+        geoms = shapely.from_wkb(
+            table.column("geometry").to_numpy(zero_copy_only=False)
+        )
+        lon, lat = helpers.transform_xy(
+            to_lonlat, shapely.get_x(geoms), shapely.get_y(geoms)
+        )
+        # outer tiles' cores extend to cover objects with centroids outside the tiled bounds
+        column = np.clip(np.floor((lon - minx) / plan["tile_size"]), 0, columns - 1)
+        row = np.clip(np.floor((lat - miny) / plan["tile_size"]), 0, rows - 1)
+        cores[tile.name] = np.flatnonzero((column == tile.column) & (row == tile.row))
+        table, geoms = table.take(pa.array(cores[tile.name])), geoms[cores[tile.name]]
+        ids[tile.name] = table.column("id")
+        x, y = shapely.get_x(geoms), shapely.get_y(geoms)
+
+        # distances within the halo of edge tiles are checked as for inner tiles, which is conservative
+        halo = shapely.segmentize(box(*tile.halo), plan["tile_size"] / 100)
+        halo = shapely.transform(
+            halo,
+            lambda x, y: helpers.transform_xy(from_lonlat, x, y),
+            interleaved=False,
+        )
+        to_halo_edge = shapely.distance(geoms, halo.exterior)
+        for name in distance_columns:
+            distances = _float_column(table, name)
+            to_fix = np.flatnonzero(np.isnan(distances) | (distances > to_halo_edge))
+            fixes[tile.name, name] = (to_fix, x[to_fix], y[to_fix])
+            act = name.removeprefix("distance_to_nearest_")
+            is_target = pc.match_substring_regex(
+                table.column("activities"), f"(^|,){re.escape(act)}(,|$)"
+            )
+            is_target = pc.fill_null(is_target, False).to_numpy(zero_copy_only=False)
+            targets[name].append(
+                (offset + np.flatnonzero(is_target), x[is_target], y[is_target])
+            )
+        offset += len(table)
+
+    keep, renamed = _unique_ids(list(ids.values()))
+    logger.info(
+        f" Merging {keep.sum()} objects from {len(cores)} tiles"
+        f" ({len(keep) - keep.sum()} dropped and {len(renamed)} renamed to give unique IDs)."
+    )
+
+    trees = {}
+    schema = pa.unify_schemas(
+        [pq.read_schema(path) for path in paths.values()], promote_options="permissive"
+    )
+    for name in distance_columns:
+        positions, x, y = (
+            np.concatenate(values) for values in zip(*targets[name], strict=True)
+        )
+        x, y = x[keep[positions]], y[keep[positions]]
+        fixed = sum(len(fixes[tile, name][0]) for tile in cores)
+        act = name.removeprefix("distance_to_nearest_")
+        logger.info(f" Recalculating {fixed} distances to nearest {act} across tiles.")
+        trees[name] = shapely.STRtree(shapely.points(x, y)) if len(x) else None
+        # as in an untiled run, a feature without any values has a null type
+        field = pa.field(name, pa.float64() if len(x) else pa.null())
+        if name in schema.names:
+            schema = schema.set(schema.get_field_index(name), field)
+        else:
+            schema = schema.append(field)
+
+    # second pass: write the core rows of each tile, with recalculated distances
+    merged_path = tile_dir(plan) / "merged.parquet"
+    offset = 0
+    with pq.ParquetWriter(merged_path, schema) as writer:
+        for tile_name, core in cores.items():
+            table = pq.read_table(paths[tile_name]).take(pa.array(core))
+            tile_keep = keep[offset : offset + len(core)]
+            for name in distance_columns:
+                distances = _float_column(table, name)
+                to_fix, x, y = fixes[tile_name, name]
+                if trees[name] is not None and len(to_fix):
+                    _, distances[to_fix] = trees[name].query_nearest(
+                        shapely.points(x, y), return_distance=True, all_matches=False
+                    )
+                else:
+                    distances[to_fix] = np.nan
+                missing = np.isnan(distances)
+                distances = (
+                    pa.nulls(len(distances))
+                    if missing.all()
+                    else pa.array(distances, mask=missing)
+                )
+                if name in table.column_names:
+                    table = table.set_column(
+                        table.column_names.index(name), name, distances
+                    )
+                else:
+                    table = table.append_column(name, distances)
+            tile_renamed = {
+                position - offset: idx
+                for position, idx in renamed.items()
+                if offset <= position < offset + len(core)
+            }
+            if tile_renamed:
+                tile_ids = table.column("id").to_pylist()
+                for position, idx in tile_renamed.items():
+                    tile_ids[position] = idx
+                table = table.set_column(
+                    table.column_names.index("id"), "id", pa.array(tile_ids)
+                )
+            table = table.filter(pa.array(tile_keep))
+            offset += len(core)
+            arrays = [
+                (
+                    table.column(field.name).cast(field.type)
+                    if field.name in table.column_names
+                    else pa.nulls(len(table), field.type)
+                )
+                for field in schema
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    try:
+        return writers.write_outputs(
+            writers.ObjectTable(ds.dataset(merged_path, format="parquet"), crs),
+            plan["output"],
+            **{key: options[key] for key in WRITE_OPTIONS},
+        )
+    finally:
+        merged_path.unlink()
+
+
+def _unique_ids(tile_ids: list[pa.ChunkedArray]) -> tuple[np.ndarray, dict[int, str]]:
+    """Find which objects to keep from each tile, and which to rename, so that object IDs are unique across tiles.
+
+    An OSM object with the ID of an object in an earlier tile is the same object,
+    kept again because its centroid differs between tiles (e.g. if it is only parsed in part by one tile),
+    so it is dropped.
+    Fill objects are created separately by each tile,
+    so a fill object with the ID of one in an earlier tile is a different object
+    (e.g. if tiles filled an area in different fill groups).
+    It is kept, and numbered after all other fill objects of its area.
+    Objects of the same tile which share an ID (e.g. an OSM node and area) are all kept, as in an untiled run.
+
+    Args:
+        tile_ids (list[pa.ChunkedArray]): IDs of the objects of each tile, in tile order.
+
+    Returns:
+        tuple[np.ndarray, dict[int, str]]:
+            Whether to keep each object, and the new IDs of renamed objects,
+            keyed by their position in the concatenated tile objects.
+    """
+    ids = pa.chunked_array(
+        [chunk for values in tile_ids for chunk in values.chunks], type=pa.string()
+    ).combine_chunks()
+    keep = np.ones(len(ids), dtype=bool)
+    if not len(ids):
+        return keep, {}
+    tile = np.repeat(np.arange(len(tile_ids)), [len(values) for values in tile_ids])
+    order = pc.sort_indices(
+        pa.table({"id": ids, "tile": tile}),
+        [("id", "ascending"), ("tile", "ascending")],
+    ).to_numpy()
+    # rows where the ID differs from that of the previous row start a run of equal IDs
+    sorted_ids = ids.take(order)
+    starts = np.ones(len(ids), dtype=bool)
+    starts[1:] = pc.not_equal(sorted_ids[1:], sorted_ids[:-1]).to_numpy(
+        zero_copy_only=False
+    )
+    first_tile = tile[order][starts][np.cumsum(starts) - 1]
+    repeated = np.sort(order[tile[order] != first_tile])
+    if not len(repeated):
+        return keep, {}
+
+    fills = pc.extract_regex(ids, FILL_ID)
+    is_fill = pc.is_valid(fills).to_numpy(zero_copy_only=False)
+    keep[repeated[~is_fill[repeated]]] = False
+    renumber = repeated[is_fill[repeated]]
+    areas = pc.struct_field(fills, "area")
+    numbers = pc.cast(pc.struct_field(fills, "n"), pa.int64())
+    next_number = {}
+    renamed = {}
+    for position in renumber:
+        area = areas[position].as_py()
+        if area not in next_number:
+            in_area = pc.equal(areas, area)
+            next_number[area] = pc.max(pc.filter(numbers, in_area)).as_py() + 1
+        renamed[int(position)] = f"fill_{area}_{next_number[area]}"
+        next_number[area] += 1
+    return keep, renamed
+
+
+def _float_column(table: pa.Table, name: str) -> np.ndarray:
+    """Values of a numeric column as floats, with NaN for nulls, or all NaN if there is no such column."""
+    if name not in table.column_names:
+        return np.full(len(table), np.nan)
+    return (
+        pc.cast(table.column(name), pa.float64())
+        .to_numpy(zero_copy_only=False)
+        .astype(float)
+    )
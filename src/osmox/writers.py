@@ -0,0 +1,915 @@
+"""Writers of OSMOX objects to GeoParquet, partitioned GeoParquet and OGR output files."""
+
+import json
+import logging
+import shutil
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal
+from urllib.parse import quote
+
+import geopandas as gp
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS, Transformer
+
+from osmox import build, facilities, helpers
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+logger = logging.getLogger(__name__)
+
+GEOPARQUET_VERSION = "1.0.0"
+GEOPARQUET_COVERING_VERSION = "1.1.0"
+
+EXTENSIONS = {
+    "geojson": "geojson",
+    "geopackage": "gpkg",
+    "flatgeobuf": "fgb",
+    "geoparquet": "parquet",
+}
+DRIVERS = {"geojson": "GeoJSON", "geopackage": "GPKG", "flatgeobuf": "FlatGeobuf"}
+SPATIAL_INDEX_FORMATS = ["geopackage", "flatgeobuf"]
+PARTITION_KEYS = ["activity", "quadkey"]
+# maximum number of partition files open at a time, after which the least recently written file is closed
+MAX_OPEN_PARTITION_FILES = 256
+# hive partition directory value of missing keys, as written by arrow
+HIVE_NULL = "__HIVE_DEFAULT_PARTITION__"
+# web mercator latitude limits
+MAX_LATITUDE = 85.05112878
+
+
+def chunks(objects: list, size: int) -> Iterator[list]:
+    """Yield successive slices of `size` objects."""
+    for start in range(0, len(objects), size):
+        yield objects[start : start + size]
+
+
+def reproject(geoms: np.ndarray, from_crs: str, to_crs: str) -> np.ndarray:
+    """Reproject an array of point geometries with a single vectorised coordinate transform."""
+    if CRS(from_crs) == CRS(to_crs):
+        return geoms
+    transformer = Transformer.from_crs(CRS(from_crs), CRS(to_crs), always_xy=True)
+    x, y = helpers.transform_xy(transformer, shapely.get_x(geoms), shapely.get_y(geoms))
+    return shapely.points(x, y)
+
+
+class ObjectTable:
+    """Objects which are already arrow data, to write without an object handler, e.g. the merged outputs of tiles.
+
+    Rows have the columns of `ObjectHandler.to_arrow` tables: a string "id", comma separated "activities",
+    a WKB point "geometry" and one column per feature.
+    They can be passed to `write_outputs` (and the writers it uses) in place of a handler,
+    and are only converted to handler columns (see `ObjectHandler.columns`) a batch at a time as they are written.
+
+    Example:
+        >>> objects = ObjectTable(pq.read_table("objects.parquet"), crs="epsg:27700")
+        >>> write_outputs(objects, "outputs/objects", format="geopackage")
+    """
+
+    def __init__(self, data: pa.Table | ds.Dataset, crs: str):
+        """Wrap object rows.
+
+        Args:
+            data (pa.Table | ds.Dataset):
+                Object rows. A dataset is streamed from disk each time objects are written, rather than loaded.
+            crs (str): CRS of the object geometries.
+        """
+        self.data = data
+        self.crs = crs
+
+    def __len__(self):
+        """Number of objects."""
+        if isinstance(self.data, pa.Table):
+            return len(self.data)
+        return self.data.count_rows()
+
+    def feature_schema(self) -> pa.Schema:
+        """Arrow schema of the object feature columns."""
+        return pa.schema(
+            [
+                field
+                for field in self.data.schema
+                if field.name not in ["id", "activities", "geometry"]
+            ]
+        )
+
+    def batches(self, batch_size: int = 100_000) -> Iterator[pa.RecordBatch]:
+        """Yield object rows, `batch_size` rows at a time."""
+        if isinstance(self.data, pa.Table):
+            yield from self.data.to_batches(max_chunksize=batch_size)
+        else:
+            # without reading ahead, so that only one batch is held in memory at a time
+            for batch in self.data.to_batches(
+                batch_size=batch_size, batch_readahead=0, fragment_readahead=0
+            ):
+                # dataset batches can be larger, at file boundaries
+                for start in range(0, len(batch), batch_size):
+                    yield batch.slice(start, batch_size)
+
+    def column_chunks(self, batch_size: int = 100_000) -> Iterator[dict]:
+        """Yield the columns (see `ObjectHandler.columns`) of successive chunks of `batch_size` objects.
+
+        IDs and features are kept as arrow arrays, rather than converted to Python objects.
+        """
+        for batch in self.batches(batch_size):
+            activities = batch.column("activities").to_pylist()
+            yield {
+                "id": batch.column("id"),
+                "activities": [acts.split(",") if acts else [] for acts in activities],
+                "geometry": shapely.from_wkb(
+                    batch.column("geometry").to_numpy(zero_copy_only=False)
+                ),
+                **{name: batch.column(name) for name in self.feature_schema().names},
+            }
+
+    def geodataframe(self, single_use: bool = False) -> gp.GeoDataFrame:
+        """Load all objects as a GeoDataFrame, as `ObjectHandler.geodataframe` would."""
+        table = self.data if isinstance(self.data, pa.Table) else self.data.to_table()
+        df = table.to_pandas()
+        df["geometry"] = shapely.from_wkb(df["geometry"].to_numpy())
+        if single_use:
+            df = df.rename(columns={"activities": "activity"})
+            df["activity"] = df["activity"].str.split(",")
+            df = df.explode("activity")
+            df = df[df["activity"].fillna("") != ""].reset_index(drop=True)
+        return gp.GeoDataFrame(df, geometry="geometry", crs=self.crs)
+
+
+def column_chunks(
+    handler: "build.ObjectHandler | ObjectTable", batch_size: int
+) -> Iterator[dict]:
+    """Yield the columns (see `ObjectHandler.columns`) of successive chunks of `batch_size` handler objects."""
+    if isinstance(handler, ObjectTable):
+        yield from handler.column_chunks(batch_size)
+        return
+    for chunk in chunks(handler.objects.objects, batch_size):
+        yield handler.columns(chunk)
+
+
+def feature_schema(
+    handler: "build.ObjectHandler | ObjectTable",
+    row_group_size: int,
+    objects: list | None = None,
+) -> pa.Schema:
+    """Infer a single arrow type per object feature, consistent across all row groups.
+
+    Types are inferred separately for each row group and then promoted to a common type,
+    e.g. a feature with integer values in one row group and float values in another is stored as float.
+    Types are inferred from all handler objects, unless `objects` are given.
+    The types of an `ObjectTable` are those of its feature columns.
+    """
+    if isinstance(handler, ObjectTable):
+        return handler.feature_schema()
+    if objects is None:
+        objects = handler.objects.objects
+    schemas = []
+    for chunk in chunks(objects, row_group_size):
+        feature_names = dict.fromkeys(name for o in chunk for name in o.features)
+        schemas.append(
+            pa.schema(
+                [
+                    (name, pa.array([o.features.get(name) for o in chunk]).type)
+                    for name in feature_names
+                ]
+            )
+        )
+    if not schemas:
+        return pa.schema([])
+    return pa.unify_schemas(schemas, promote_options="permissive")
+
+
+def geo_metadata(
+    crs: str,
+    bbox_covering: bool = False,
+    geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+) -> dict:
+    """GeoParquet file metadata for a point geometry column in the given CRS."""
+    column = {
+        "encoding": "point" if geometry_encoding == "geoarrow" else "WKB",
+        "geometry_types": ["Point"],
+        "crs": CRS(crs).to_json_dict(),
+    }
+    if bbox_covering:
+        column["covering"] = {
+            "bbox": {
+                "xmin": ["bbox", "xmin"],
+                "ymin": ["bbox", "ymin"],
+                "xmax": ["bbox", "xmax"],
+                "ymax": ["bbox", "ymax"],
+            }
+        }
+    native = bbox_covering or geometry_encoding == "geoarrow"
+    return {
+        "version": GEOPARQUET_COVERING_VERSION if native else GEOPARQUET_VERSION,
+        "primary_column": "geometry",
+        "columns": {"geometry": column},
+    }
+
+
+def explode(columns: dict) -> dict:
+    """Repeat handler object columns (see `ObjectHandler.columns`) once per object activity.
+
+    Adds an "activity" column with the single activity of each row.
+    """
+    activities = columns["activities"]
+    lengths = np.array([len(acts) for acts in activities], dtype=int)
+    rows = np.repeat(np.arange(len(activities)), lengths)
+    exploded = {}
+    for name, values in columns.items():
+        if isinstance(values, np.ndarray):
+            exploded[name] = values[rows]
+        elif isinstance(values, pa.Array):
+            exploded[name] = values.take(pa.array(rows, type=pa.int64()))
+        else:
+            exploded[name] = [values[i] for i in rows]
+    exploded["activity"] = [act for acts in activities for act in acts]
+    return exploded
+
+
+def record_batch(
+    columns: dict,
+    schema: pa.Schema,
+    single_use: bool = False,
+    bbox_covering: bool = False,
+    geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+) -> pa.RecordBatch:
+    """Convert handler object columns (see `ObjectHandler.columns`) to an arrow record batch.
+
+    Args:
+        columns (dict): Object columns, optionally already exploded to one row per activity (see `explode`).
+        schema (pa.Schema): Output schema.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        bbox_covering (bool, optional): If True, add a GeoParquet bounding box covering column. Defaults to False.
+        geometry_encoding (Literal["WKB", "geoarrow"], optional):
+            Geometry column encoding: well-known binary, or GeoArrow native points (a struct of x and y coordinates).
+            Defaults to "WKB".
+
+    Returns:
+        pa.RecordBatch: Record batch with the given schema.
+    """
+    columns = dict(columns)
+    if single_use and "activity" not in columns:
+        columns = explode(columns)
+    activities = columns.pop("activities")
+    if not single_use:
+        columns["activities"] = [",".join(acts) for acts in activities]
+
+    geoms = columns.pop("geometry")
+    x, y = shapely.get_x(geoms), shapely.get_y(geoms)
+    if geometry_encoding == "geoarrow":
+        columns["geometry"] = pa.StructArray.from_arrays([x, y], names=["x", "y"])
+    else:
+        columns["geometry"] = shapely.to_wkb(geoms)
+    if bbox_covering:
+        columns["bbox"] = pa.StructArray.from_arrays(
+            [x, y, x, y], names=["xmin", "ymin", "xmax", "ymax"]
+        )
+    arrays = []
+    for field in schema:
+        values = columns.get(field.name)
+        if values is None:
+            arrays.append(pa.nulls(len(columns["geometry"]), type=field.type))
+        elif isinstance(values, pa.Array):
+            arrays.append(values.cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def geometry_field(
+    crs: str, geometry_encoding: Literal["WKB", "geoarrow"] = "WKB"
+) -> pa.Field:
+    """Arrow field of a point geometry column, with GeoArrow extension type metadata."""
+    if geometry_encoding == "geoarrow":
+        type, extension = (
+            pa.struct([("x", pa.float64()), ("y", pa.float64())]),
+            "geoarrow.point",
+        )
+    else:
+        type, extension = pa.binary(), "geoarrow.wkb"
+    metadata = {
+        b"ARROW:extension:name": extension.encode(),
+        b"ARROW:extension:metadata": json.dumps(
+            {"crs": CRS(crs).to_json_dict()}
+        ).encode(),
+    }
+    return pa.field("geometry", type, metadata=metadata)
+
+
+def output_schema(
+    feature_schema: pa.Schema,
+    crs: str,
+    single_use: bool = False,
+    bbox_covering: bool = False,
+    geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+) -> pa.Schema:
+    """Arrow schema of object outputs, with GeoParquet metadata."""
+    fields = [
+        pa.field("id", pa.string()),
+        pa.field("activity" if single_use else "activities", pa.string()),
+        geometry_field(crs, geometry_encoding),
+        *feature_schema,
+    ]
+    if bbox_covering:
+        fields.append(
+            pa.field(
+                "bbox",
+                pa.struct(
+                    [(name, pa.float64()) for name in ["xmin", "ymin", "xmax", "ymax"]]
+                ),
+            )
+        )
+    metadata = {
+        b"geo": json.dumps(geo_metadata(crs, bbox_covering, geometry_encoding)).encode()
+    }
+    return pa.schema(fields, metadata=metadata)
+
+
+def write_geoparquet(
+    handler: "build.ObjectHandler | ObjectTable",
+    path: str | Path,
+    crs: str | None = None,
+    single_use: bool = False,
+    row_group_size: int = 100_000,
+    compression: Literal["zstd", "snappy", "gzip", "none"] = "snappy",
+    bbox_covering: bool = False,
+    features: pa.Schema | None = None,
+) -> None:
+    """Stream handler objects to a GeoParquet file, one row group at a time.
+
+    Only one row group of output data is held in memory at any time.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be written.
+        path (str | Path): Output file path.
+        crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        row_group_size (int, optional): Maximum number of objects per row group. Defaults to 100_000.
+        compression (Literal["zstd", "snappy", "gzip", "none"], optional): Parquet compression codec. Defaults to "snappy".
+        bbox_covering (bool, optional):
+            If True, add a bounding box column and GeoParquet covering metadata,
+            so readers can filter row groups spatially.
+            Defaults to False.
+        features (pa.Schema | None, optional):
+            Feature types (see `feature_schema`), if already inferred. Defaults to None, i.e. inferred from the objects.
+    """
+    crs = crs or handler.crs
+    if features is None:
+        features = feature_schema(handler, row_group_size)
+    schema = output_schema(features, crs, single_use, bbox_covering)
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for batch in record_batches(
+            handler, schema, crs, single_use, row_group_size, bbox_covering
+        ):
+            writer.write_table(
+                pa.Table.from_batches([batch]), row_group_size=len(batch)
+            )
+
+
+def record_batches(
+    handler: "build.ObjectHandler | ObjectTable",
+    schema: pa.Schema,
+    crs: str,
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    bbox_covering: bool = False,
+    geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+    geometry: np.ndarray | None = None,
+) -> Iterator[pa.RecordBatch]:
+    """Yield non-empty record batches of handler objects, `batch_size` objects at a time.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be converted.
+        schema (pa.Schema): Output schema (see `output_schema`).
+        crs (str): CRS of the output geometries.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects per batch. Defaults to 100_000.
+        bbox_covering (bool, optional): If True, add a bounding box covering column. Defaults to False.
+        geometry_encoding (Literal["WKB", "geoarrow"], optional): Geometry column encoding. Defaults to "WKB".
+        geometry (np.ndarray | None, optional):
+            Output geometries of all handler objects, already in `crs`.
+            Defaults to None, i.e. object centroids are computed and reprojected one batch at a time.
+
+    Yields:
+        pa.RecordBatch: Record batch with the given schema.
+    """
+    start = 0
+    for columns in column_chunks(handler, batch_size):
+        if geometry is None:
+            columns["geometry"] = reproject(columns["geometry"], handler.crs, crs)
+        else:
+            columns["geometry"] = geometry[start : start + len(columns["id"])]
+        start += len(columns["id"])
+        batch = record_batch(
+            columns, schema, single_use, bbox_covering, geometry_encoding
+        )
+        if len(batch):
+            yield batch
+
+
+def record_batch_reader(
+    handler: build.ObjectHandler,
+    crs: str | None = None,
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    geometry_encoding: Literal["WKB", "geoarrow"] = "WKB",
+) -> pa.RecordBatchReader:
+    """Stream of handler objects as arrow record batches, built lazily as they are read.
+
+    Object centroids are computed and reprojected up front, in the calling thread,
+    since pyproj cannot be used from the native threads that some arrow consumers read streams from.
+    All other columns are only built as each batch is read.
+
+    Args:
+        handler (build.ObjectHandler): Handler whose objects will be converted.
+        crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects per batch. Defaults to 100_000.
+        geometry_encoding (Literal["WKB", "geoarrow"], optional): Geometry column encoding. Defaults to "WKB".
+
+    Returns:
+        pa.RecordBatchReader: Record batch stream.
+    """
+    crs = crs or handler.crs
+    schema = output_schema(
+        feature_schema(handler, batch_size),
+        crs,
+        single_use,
+        geometry_encoding=geometry_encoding,
+    )
+    geometry = reproject(handler.centroid_points(), handler.crs, crs)
+    return pa.RecordBatchReader.from_batches(
+        schema,
+        record_batches(
+            handler,
+            schema,
+            crs,
+            single_use,
+            batch_size,
+            geometry_encoding=geometry_encoding,
+            geometry=geometry,
+        ),
+    )
+
+
+def quadkeys(lon: np.ndarray, lat: np.ndarray, zoom: int) -> np.ndarray:
+    """Quadkeys of the web mercator (slippy map) tiles containing each coordinate.
+
+    Each quadkey is a string of `zoom` digits, where each digit selects a quadrant of the parent tile.
+    A quadkey is therefore a prefix of the quadkeys of all tiles it contains.
+
+    Args:
+        lon (np.ndarray): Longitudes (EPSG:4326).
+        lat (np.ndarray): Latitudes (EPSG:4326).
+        zoom (int): Tile zoom level (>= 1).
+
+    Returns:
+        np.ndarray: Quadkey strings.
+    """
+    n = 2**zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.clip(np.floor((np.asarray(lon) + 180) / 360 * n), 0, n - 1).astype(np.int64)
+    y = np.clip(
+        np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n), 0, n - 1
+    ).astype(np.int64)
+    bits = np.arange(zoom - 1, -1, -1)
+    digits = ((x[:, None] >> bits) & 1) + 2 * ((y[:, None] >> bits) & 1)
+    return (digits.astype(np.uint8) + ord("0")).view(f"S{zoom}").ravel().astype(str)
+
+
+def partitioned_record_batches(
+    handler: "build.ObjectHandler | ObjectTable",
+    schema: pa.Schema,
+    crs: str,
+    single_use: bool = False,
+    partition_by: list[str] = PARTITION_KEYS,
+    quadkey_zoom: int = 10,
+    batch_size: int = 100_000,
+    bbox_covering: bool = False,
+) -> Iterator[pa.RecordBatch]:
+    """Yield non-empty record batches of handler objects, with partition key columns.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be converted.
+        schema (pa.Schema): Output schema (see `output_schema`), including partition key columns.
+        crs (str): CRS of the output geometries.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        partition_by (list[str], optional): Partition keys, from `PARTITION_KEYS`. Defaults to all keys.
+        quadkey_zoom (int, optional): Tile zoom level of "quadkey" partitions. Defaults to 10.
+        batch_size (int, optional): Maximum number of objects per batch. Defaults to 100_000.
+        bbox_covering (bool, optional): If True, add a bounding box covering column. Defaults to False.
+
+    Yields:
+        pa.RecordBatch: Record batch with the given schema.
+    """
+    for columns in column_chunks(handler, batch_size):
+        if single_use or "activity" in partition_by:
+            columns = explode(columns)
+        geoms = columns["geometry"]
+        if "quadkey" in partition_by:
+            lonlat = reproject(geoms, handler.crs, "epsg:4326")
+            columns["quadkey"] = quadkeys(
+                shapely.get_x(lonlat), shapely.get_y(lonlat), quadkey_zoom
+            )
+        columns["geometry"] = reproject(geoms, handler.crs, crs)
+        batch = record_batch(columns, schema, single_use, bbox_covering)
+        if len(batch):
+            yield batch
+
+
+def write_partitioned_geoparquet(
+    handler: "build.ObjectHandler | ObjectTable",
+    path: str | Path,
+    crs: str | None = None,
+    single_use: bool = False,
+    partition_by: list[str] = PARTITION_KEYS,
+    quadkey_zoom: int = 10,
+    row_group_size: int = 100_000,
+    compression: Literal["zstd", "snappy", "gzip", "none"] = "snappy",
+    bbox_covering: bool = False,
+    features: pa.Schema | None = None,
+) -> None:
+    """Stream handler objects to a hive-partitioned GeoParquet dataset.
+
+    Objects are written to one directory per partition, e.g. `<path>/activity=work/quadkey=0313131/`,
+    so that readers can load only the activities and tiles they need.
+    When partitioning by activity, objects with more than one activity are written to each of their activity partitions.
+    Partition key columns are not stored in the files, but are read back by dataset-aware readers,
+    e.g. `geopandas.read_parquet(path, filters=[("activity", "=", "work")])`.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be written.
+        path (str | Path): Output directory path. Any existing directory at this path will be replaced.
+        crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        partition_by (list[str], optional):
+            Partition keys, from `PARTITION_KEYS`:
+            "activity" partitions by object activity,
+            "quadkey" by the web mercator tile containing the object at zoom level `quadkey_zoom`.
+            Defaults to all keys.
+        quadkey_zoom (int, optional): Tile zoom level of "quadkey" partitions. Defaults to 10 (~40km tiles at the equator).
+        row_group_size (int, optional):
+            Maximum number of objects written at a time, i.e. per partition row group. Defaults to 100_000.
+        compression (Literal["zstd", "snappy", "gzip", "none"], optional): Parquet compression codec. Defaults to "snappy".
+        bbox_covering (bool, optional): If True, add a bounding box column and GeoParquet covering metadata. Defaults to False.
+        features (pa.Schema | None, optional):
+            Feature types (see `feature_schema`), if already inferred. Defaults to None, i.e. inferred from the objects.
+
+    Raises:
+        ValueError: If a partition key is not in `PARTITION_KEYS`.
+        FileExistsError: If there is a file at the output path.
+    """
+    unknown = set(partition_by) - set(PARTITION_KEYS)
+    if unknown:
+        raise ValueError(
+            f"Unknown partition keys {unknown}; expected one of {PARTITION_KEYS}"
+        )
+    crs = crs or handler.crs
+    if features is None:
+        features = feature_schema(handler, row_group_size)
+    schema = output_schema(features, crs, single_use, bbox_covering)
+    partitioning = pa.schema([pa.field(key, pa.string()) for key in partition_by])
+    for field in partitioning:
+        if field.name not in schema.names:
+            schema = schema.append(field)
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        raise FileExistsError(
+            f"Cannot write a partitioned dataset to {path}, which is a file"
+        )
+    batches = partitioned_record_batches(
+        handler,
+        schema,
+        crs,
+        single_use,
+        partition_by,
+        quadkey_zoom,
+        row_group_size,
+        bbox_covering,
+    )
+    file_schema = pa.schema(
+        [field for field in schema if field.name not in partition_by],
+        metadata=schema.metadata,
+    )
+    # batches are split into partitions and written from this thread, rather than by `ds.write_dataset`,
+    # since it would pull batches from its own threads, where pyproj is not safe to use
+    files = OrderedDict()  # open writers, by partition directory
+    counts = {}  # number of files opened in each partition directory
+    try:
+        for batch in batches:
+            for directory, table in partitions(batch, partition_by):
+                if directory not in files:
+                    if len(files) >= MAX_OPEN_PARTITION_FILES:
+                        files.popitem(last=False)[1].close()
+                    n = counts.get(directory, 0)
+                    counts[directory] = n + 1
+                    (path / directory).mkdir(parents=True, exist_ok=True)
+                    files[directory] = pq.ParquetWriter(
+                        path / directory / f"part-{n}.parquet",
+                        file_schema,
+                        compression=compression,
+                    )
+                files.move_to_end(directory)
+                files[directory].write_table(
+                    table.drop_columns(partition_by), row_group_size=row_group_size
+                )
+    finally:
+        for writer in files.values():
+            writer.close()
+
+
+def partitions(
+    batch: pa.RecordBatch, partition_by: list[str]
+) -> Iterator[tuple[Path, pa.Table]]:
+    """Split a record batch by its partition key columns.
+
+    Yields:
+        tuple[Path, pa.Table]:
+            Hive partition directory (e.g. `activity=work/quadkey=0313131`) and rows of each partition,
+            in their order in the batch.
+    """
+    table = pa.Table.from_batches([batch])
+    keys = [pc.fill_null(table.column(key), HIVE_NULL) for key in partition_by]
+    order = pc.sort_indices(
+        pa.table(keys, names=partition_by),
+        [(key, "ascending") for key in partition_by],
+    )
+    table, keys = table.take(order), [values.take(order) for values in keys]
+    # rows where any key differs from that of the previous row start a partition
+    starts = np.zeros(len(table), dtype=bool)
+    starts[0] = True
+    for values in keys:
+        starts[1:] |= pc.not_equal(values[1:], values[:-1]).to_numpy()
+    starts = np.flatnonzero(starts)
+    for start, end in zip(starts, [*starts[1:], len(table)], strict=True):
+        directory = Path(
+            *(
+                f"{key}={quote(values[start].as_py(), safe='')}"
+                for key, values in zip(partition_by, keys, strict=True)
+            )
+        )
+        yield directory, table.slice(start, end - start)
+
+
+def pyogrio_available() -> bool:
+    """Whether pyogrio is installed with support for writing arrow data."""
+    return (
+        pyogrio is not None
+        and hasattr(pyogrio.raw, "write_arrow")
+        and pyogrio.__gdal_version__ >= (3, 8, 0)
+    )
+
+
+def write_ogr(
+    handler: "build.ObjectHandler | ObjectTable",
+    path: str | Path,
+    format: Literal["geojson", "geopackage", "flatgeobuf"] = "geopackage",
+    crs: str | None = None,
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    spatial_index: bool = True,
+    features: pa.Schema | None = None,
+) -> None:
+    """Stream handler objects to a GDAL/OGR vector file with pyogrio, one arrow record batch at a time.
+
+    GDAL writes all batches within a single transaction, for drivers that support them.
+    For GeoPackage output, GDAL only builds the spatial index once all features have been written.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be written.
+        path (str | Path): Output file path.
+        format (Literal["geojson", "geopackage", "flatgeobuf"], optional): Output file format. Defaults to "geopackage".
+        crs (str | None, optional): CRS of the output, if different from the handler CRS. Defaults to None.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects per record batch. Defaults to 100_000.
+        spatial_index (bool, optional):
+            If False, do not build a spatial index in formats that support one (geopackage, flatgeobuf).
+            Defaults to True.
+        features (pa.Schema | None, optional):
+            Feature types (see `feature_schema`), if already inferred. Defaults to None, i.e. inferred from the objects.
+    """
+    crs = crs or handler.crs
+    if features is None:
+        features = feature_schema(handler, batch_size)
+    # OGR has no null field type; all-null features are written as strings, as GeoPandas would.
+    features = pa.schema(
+        [
+            pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+            for field in features
+        ]
+    )
+    schema = output_schema(features, crs, single_use)
+    layer_options = None
+    if format in SPATIAL_INDEX_FORMATS:
+        layer_options = {"SPATIAL_INDEX": "YES" if spatial_index else "NO"}
+    reader = pa.RecordBatchReader.from_batches(
+        schema, record_batches(handler, schema, crs, single_use, batch_size)
+    )
+    pyogrio.raw.write_arrow(
+        reader,
+        path,
+        driver=DRIVERS[format],
+        geometry_name="geometry",
+        geometry_type="Point",
+        crs=CRS(crs).to_wkt(),
+        layer_options=layer_options,
+    )
+
+
+def output_crs(crs: str | list[str]) -> list[str]:
+    """List of unique output CRSs, always including EPSG:4326 (lat lon)."""
+    if isinstance(crs, str):
+        crs = [crs]
+    unique = []
+    for c in [*crs, "epsg:4326"]:
+        if not any(CRS(c) == CRS(u) for u in unique):
+            unique.append(c)
+    return unique
+
+
+def output_path(output_name: str, crs: str, format: str) -> str:
+    """Output file path, e.g. `<output_name>_epsg_27700.gpkg`."""
+    return f"{output_name}_{crs.replace(':', '_')}.{EXTENSIONS[format]}"
+
+
+def reproject_geodataframe(gdf: gp.GeoDataFrame, crs: str) -> gp.GeoDataFrame:
+    """Reproject a GeoDataFrame of points, sharing all non-geometry columns with the input.
+
+    Only the geometry column is transformed, using a single vectorised coordinate transform.
+    """
+    if CRS(gdf.crs) == CRS(crs):
+        return gdf
+    reprojected = gdf.copy(deep=False)
+    reprojected["geometry"] = gp.GeoSeries(
+        reproject(np.asarray(gdf.geometry.values), gdf.crs, crs),
+        index=gdf.index,
+        crs=crs,
+    )
+    return reprojected
+
+
+def write_outputs(
+    handler: "build.ObjectHandler | ObjectTable",
+    output_name: str,
+    format: Literal["geojson", "geopackage", "flatgeobuf", "geoparquet"] = "geopackage",
+    crs: str | list[str] | None = None,
+    single_use: bool = False,
+    batch_size: int = 100_000,
+    compression: Literal["zstd", "snappy", "gzip", "none"] = "snappy",
+    bbox_covering: bool = False,
+    spatial_index: bool = True,
+    engine: Literal["auto", "pyogrio", "fiona"] = "auto",
+    partition_by: list[str] | None = None,
+    quadkey_zoom: int = 10,
+    facility_index: bool = False,
+) -> list[str]:
+    """Write handler objects to one file per output CRS, concurrently.
+
+    Each output is written in its own thread, since coordinate transforms and file writers release the GIL.
+
+    Args:
+        handler (build.ObjectHandler | ObjectTable): Handler whose objects will be written.
+        output_name (str): Output file path prefix, to which the CRS and file extension will be added.
+        format (Literal["geojson", "geopackage", "flatgeobuf", "geoparquet"], optional): Output file format. Defaults to "geopackage".
+        crs (str | list[str] | None, optional):
+            Output CRS(s). EPSG:4326 is always added to these. Defaults to None, i.e. the handler CRS.
+        single_use (bool, optional): If True, output one row per object activity. Defaults to False.
+        batch_size (int, optional): Maximum number of objects per geoparquet row group / pyogrio record batch. Defaults to 100_000.
+        compression (Literal["zstd", "snappy", "gzip", "none"], optional): Geoparquet compression codec. Defaults to "snappy".
+        bbox_covering (bool, optional): If True, add a bounding box covering column to geoparquet outputs. Defaults to False.
+        spatial_index (bool, optional):
+            If False, do not build a spatial index in formats that support one (geopackage, flatgeobuf).
+            Defaults to True.
+        engine (Literal["auto", "pyogrio", "fiona"], optional):
+            Engine to write non-geoparquet formats with.
+            "auto" uses pyogrio if it is available and falls back to GeoPandas, with its default engine, otherwise.
+            "fiona" writes with GeoPandas using fiona.
+            Defaults to "auto".
+        partition_by (list[str] | None, optional):
+            If given, write each geoparquet output as a hive-partitioned dataset directory,
+            partitioned by these keys (see `write_partitioned_geoparquet`).
+            Defaults to None.
+        quadkey_zoom (int, optional): Tile zoom level of "quadkey" partitions. Defaults to 10.
+        facility_index (bool, optional):
+            If True, also write a facility index directory next to each output (see `facilities.write_facility_index`).
+            Defaults to False.
+
+    Raises:
+        ImportError: If the pyogrio engine is requested but is not available.
+        ValueError: If partitioned output is requested for a format other than geoparquet.
+
+    Returns:
+        list[str]: Paths of written files.
+    """
+    crs_list = output_crs(crs or handler.crs)
+    paths = [output_path(output_name, c, format) for c in crs_list]
+
+    if engine == "pyogrio" and not pyogrio_available():
+        raise ImportError(
+            "Writing with the pyogrio engine requires pyogrio >= 0.8 built against GDAL >= 3.8"
+        )
+
+    if partition_by and format != "geoparquet":
+        raise ValueError(
+            f"Partitioned output is only supported for geoparquet, not {format}"
+        )
+
+    # feature types are inferred from all objects, so only once for all outputs
+    features = None
+    if partition_by or format == "geoparquet" or facility_index:
+        features = feature_schema(handler, batch_size)
+
+    if partition_by:
+
+        def _write(path, out_crs):
+            write_partitioned_geoparquet(
+                handler,
+                path,
+                crs=out_crs,
+                single_use=single_use,
+                partition_by=partition_by,
+                quadkey_zoom=quadkey_zoom,
+                row_group_size=batch_size,
+                compression=compression,
+                bbox_covering=bbox_covering,
+                features=features,
+            )
+
+    elif format == "geoparquet":
+
+        def _write(path, out_crs):
+            write_geoparquet(
+                handler,
+                path,
+                crs=out_crs,
+                single_use=single_use,
+                row_group_size=batch_size,
+                compression=compression,
+                bbox_covering=bbox_covering,
+                features=features,
+            )
+
+    elif engine != "fiona" and pyogrio_available():
+        if features is None:
+            features = feature_schema(handler, batch_size)
+
+        def _write(path, out_crs):
+            write_ogr(
+                handler,
+                path,
+                format=format,
+                crs=out_crs,
+                single_use=single_use,
+                batch_size=batch_size,
+                spatial_index=spatial_index,
+                features=features,
+            )
+
+    else:
+        gdf = handler.geodataframe(single_use=single_use)
+        # without pyogrio, "auto" leaves the choice of engine to GeoPandas
+        kwargs = {"engine": "fiona"} if engine == "fiona" else {}
+        if format in SPATIAL_INDEX_FORMATS:
+            kwargs["SPATIAL_INDEX"] = "YES" if spatial_index else "NO"
+
+        def _write(path, out_crs):
+            reproject_geodataframe(gdf, out_crs).to_file(
+                path, driver=DRIVERS[format], **kwargs
+            )
+
+    with ThreadPoolExecutor(
+        max_workers=len(paths) * (2 if facility_index else 1)
+    ) as pool:
+        futures = []
+        for path, out_crs in zip(paths, crs_list, strict=True):
+            logger.info(f" Writing objects to: {path}")
+            futures.append(pool.submit(_write, path, out_crs))
+            if facility_index:
+                index_path = facilities.index_path(output_name, out_crs)
+                logger.info(f" Writing facility index to: {index_path}")
+                futures.append(
+                    pool.submit(
+                        facilities.write_facility_index,
+                        handler,
+                        index_path,
+                        crs=out_crs,
+                        single_use=single_use,
+                        batch_size=batch_size,
+                        features=features,
+                    )
+                )
+        for future in futures:
+            future.result()
+    return paths
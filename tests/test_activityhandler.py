@@ -1,8 +1,16 @@
+import json
 import os
 
 import geopandas as gpd
+import numpy as np
+import osmium
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+import shapely
+from geopandas.testing import assert_geodataframe_equal
 from osmox import build, config, helpers
+from pyproj import CRS
 from shapely.geometry import Point, Polygon
 
 fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
@@ -22,6 +30,12 @@ def test_innit(test_config):
     assert build.ObjectHandler(test_config)
 
 
+def test_handler_compiles_config(test_config):
+    handler = build.ObjectHandler(test_config)
+    assert isinstance(handler.cnfg, config.CompiledConfig)
+    assert build.ObjectHandler(handler.cnfg).cnfg is handler.cnfg
+
+
 @pytest.fixture()
 def testHandler(test_config):
     return build.ObjectHandler(test_config, crs="epsg:4326")
@@ -115,6 +129,295 @@ def test_load_toy(testHandler):
     assert len(handler.areas) == 3
 
 
+class OSMExtractor(osmium.SimpleHandler):
+    """Extract tagged nodes and areas from an OSM file as GeoParquet rows."""
+
+    wkbfab = osmium.geom.WKBFactory()
+
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+
+    def _add(self, obj, create):
+        if len(obj.tags):
+            try:
+                geom = bytes.fromhex(create(obj))
+            except RuntimeError:
+                return
+            self.rows.append((obj.id, [(t.k, t.v) for t in obj.tags], geom))
+
+    def node(self, n):
+        self._add(n, self.wkbfab.create_point)
+
+    def area(self, a):
+        self._add(a, self.wkbfab.create_multipolygon)
+
+
+@pytest.fixture(params=[None, "epsg:3857"])
+def toy_geoparquet_path(request, tmp_path):
+    extractor = OSMExtractor()
+    extractor.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    ids, tags, geoms = zip(*extractor.rows, strict=True)
+    geoms = shapely.from_wkb(geoms)
+    column = {"encoding": "WKB", "geometry_types": []}
+    if request.param is not None:
+        geoms = gpd.GeoSeries(geoms, crs="epsg:4326").to_crs(request.param).values
+        column["crs"] = CRS(request.param).to_json_dict()
+    table = pa.table(
+        {
+            "osm_id": pa.array(ids, type=pa.int64()),
+            "osm_tags": pa.array(tags, type=pa.map_(pa.string(), pa.string())),
+            "geometry": shapely.to_wkb(geoms),
+        }
+    )
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": column},
+    }
+    table = table.replace_schema_metadata({b"geo": json.dumps(geo).encode()})
+    path = tmp_path / "toy.parquet"
+    pq.write_table(table, path, row_group_size=50)
+    return path
+
+
+def test_apply_geoparquet_matches_apply_file(test_config, toy_geoparquet_path):
+    handlers = [build.ObjectHandler(test_config, crs="epsg:27700") for _ in range(2)]
+    handlers[0].apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handlers[1].apply_geoparquet(
+        toy_geoparquet_path, id_column="osm_id", tags_column="osm_tags", batch_size=40
+    )
+    for handler in handlers:
+        assert len(handler.objects) == 5
+        assert len(handler.points) == 6
+        assert len(handler.areas) == 3
+        handler.assign_tags()
+        handler.assign_activities()
+    expected, result = (handler.geodataframe().set_index("id") for handler in handlers)
+    assert_geodataframe_equal(result, expected, check_less_precise=True)
+
+
+def test_apply_geoparquet_requires_map_tags(test_config, tmp_path):
+    path = tmp_path / "tags.parquet"
+    pq.write_table(
+        pa.table({"id": [1], "tags": ["building=yes"], "geometry": [Point(0, 0).wkb]}),
+        path,
+    )
+    handler = build.ObjectHandler(test_config)
+    with pytest.raises(ValueError, match="must be a map column"):
+        handler.apply_geoparquet(path)
+
+
+@pytest.mark.parametrize("curve", ["hilbert", "zorder"])
+def test_sort_toy(test_config, curve):
+    outputs = []
+    for sort in [False, True]:
+        handler = build.ObjectHandler(test_config, crs="epsg:27700")
+        handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+        if sort:
+            handler.sort(curve)
+        handler.assign_tags()
+        handler.assign_activities()
+        outputs.append(handler.geodataframe().set_index("id").sort_index())
+    assert len(handler.points) == 6
+    assert len(handler.areas) == 3
+    assert outputs[0].equals(outputs[1])
+
+
+def test_progress_callback(test_config):
+    events = []
+    handler = build.ObjectHandler(
+        test_config, crs="epsg:27700", progress_callback=events.append
+    )
+    handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handler.assign_tags()
+    handler.assign_activities()
+    handler.add_features()
+    stages = [event.stage for event in events]
+    assert list(dict.fromkeys(stages)) == [
+        "assign_tags",
+        "assign_activities",
+        "features",
+    ]
+    for stage in ["assign_tags", "assign_activities", "features"]:
+        stage_events = [event for event in events if event.stage == stage]
+        assert stage_events[0].done == 0
+        assert stage_events[-1].done == stage_events[-1].total == len(handler.objects)
+
+
+def test_retained_until(test_config):
+    handler = build.ObjectHandler(test_config)
+    assert handler.retained_until() == {
+        "points": "assign_tags",
+        "areas": "assign_tags",
+        "geometries": "assign_tags",
+    }
+    handler = build.ObjectHandler(
+        config.load(os.path.join(fixtures_root, "test_config_infill.json"))
+    )
+    assert handler.retained_until() == {
+        "points": "assign_tags",
+        "areas": "fill",
+        "geometries": "fill",
+    }
+
+
+def test_release_unused_keeps_outputs(test_config):
+    outputs = []
+    for release in [False, True]:
+        handler = build.ObjectHandler(test_config, crs="epsg:27700")
+        handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+        handler.assign_tags()
+        polygons = [o.geom for o in handler.objects]
+        if release:
+            assert handler.release_unused("assign_activities") == []
+            assert handler.release_unused("assign_tags") == [
+                "points",
+                "areas",
+                "geometries",
+            ]
+            assert len(handler.points) == len(handler.areas) == 0
+            assert all(o.geom.geom_type == "Point" for o in handler.objects)
+            assert [o.geom for o in handler.objects] == list(shapely.centroid(polygons))
+            assert len(
+                handler.objects.intersection(shapely.total_bounds(polygons))
+            ) == len(polygons)
+        handler.assign_activities()
+        handler.add_features()
+        handler.assign_nearest_distance("transit")
+        outputs.append(handler.geodataframe())
+    assert outputs[1]["area"].sum() > 0
+    assert_geodataframe_equal(outputs[0], outputs[1])
+
+
+@pytest.mark.parametrize(
+    "storage,precision,tolerance",
+    [
+        ("float64", None, 0),
+        ("float32", None, 0.1),
+        ("shapely", 1, 0.75),
+        ("float32", 1, 0.75),
+    ],
+)
+def test_geometry_storage(test_config, storage, precision, tolerance):
+    outputs = []
+    for options in [{}, {"geometry_storage": storage, "geometry_precision": precision}]:
+        handler = build.ObjectHandler(test_config, crs="epsg:27700", **options)
+        handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+        handler.assign_tags()
+        handler.release_unused("assign_tags")
+        handler.assign_activities()
+        handler.add_features()
+        handler.assign_nearest_distance("transit")
+        outputs.append(handler.geodataframe())
+    if storage != "shapely":
+        assert handler.centroids.xy.dtype == storage
+        assert all(o.centroids is handler.centroids for o in handler.objects)
+        assert (
+            len(handler.objects.intersection(handler.centroids.xy[0].tolist() * 2)) >= 1
+        )
+    if precision:
+        coords = shapely.get_coordinates(outputs[1].geometry)
+        assert (coords % precision == 0).all()
+    assert outputs[1]["area"].equals(outputs[0]["area"])
+    assert (outputs[1].geometry.distance(outputs[0].geometry) <= tolerance).all()
+    for column in ["geometry", "distance_to_nearest_transit"]:
+        outputs[1].pop(column), outputs[0].pop(column)
+    assert outputs[1].equals(outputs[0])
+
+
+def test_geometry_storage_unknown(test_config):
+    with pytest.raises(ValueError, match="Unknown geometry storage: float16"):
+        build.ObjectHandler(test_config, geometry_storage="float16")
+
+
+def test_bbox_filters_parse(test_config, toy_geoparquet_path):
+    full = build.ObjectHandler(test_config, crs="epsg:4326")
+    full.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    minx, miny, maxx, maxy = shapely.total_bounds([o.geom for o in full.objects])
+    bbox = (minx, miny, (minx + maxx) / 2, maxy)
+    expected = sorted(
+        o.idx for o in full.objects if o.geom.intersects(shapely.box(*bbox))
+    )
+    assert 0 < len(expected) < len(full.objects)
+
+    handlers = [
+        build.ObjectHandler(test_config, crs="epsg:27700", bbox=bbox) for _ in range(2)
+    ]
+    handlers[0].apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handlers[1].apply_geoparquet(
+        toy_geoparquet_path, id_column="osm_id", tags_column="osm_tags"
+    )
+    for handler in handlers:
+        assert sorted(o.idx for o in handler.objects) == expected
+        assert len(handler.points) < len(full.points)
+
+
+@pytest.fixture()
+def narrow_and_wide_configs(test_config):
+    narrow = json.loads(json.dumps(test_config))
+    narrow["activity_mapping"].pop("office")
+    wide = json.loads(json.dumps(test_config))
+    wide["filter"]["amenity"] = list(wide["activity_mapping"]["amenity"])
+    wide["filter"]["landuse"] = ["*"]
+    return narrow, wide
+
+
+def assert_apply_parsed_matches(configs, parse):
+    shared = build.ObjectHandler(
+        config.union_config(configs), crs="epsg:27700", share_parse=True
+    )
+    parse(shared)
+    handlers = []
+    for cnfg in configs:
+        expected = build.ObjectHandler(cnfg, crs="epsg:27700")
+        parse(expected)
+        handler = build.ObjectHandler(cnfg, crs="epsg:27700")
+        handler.apply_parsed(shared)
+        for tree in ["objects", "points", "areas"]:
+            assert [
+                (o.idx, o.activity_tags, o.geom.wkb) for o in getattr(handler, tree)
+            ] == [(o.idx, o.activity_tags, o.geom.wkb) for o in getattr(expected, tree)]
+        handlers.append(handler)
+    return handlers
+
+
+def test_apply_parsed_matches_apply_file(narrow_and_wide_configs):
+    narrow, wide = assert_apply_parsed_matches(
+        narrow_and_wide_configs,
+        lambda handler: handler.apply_file(
+            toy_osm_path, locations=True, idx="flex_mem"
+        ),
+    )
+    # some objects of the wide config are points or areas of the narrow config
+    wide_ids = {o.idx for o in wide.objects}
+    narrow_others = [o.idx for tree in [narrow.points, narrow.areas] for o in tree]
+    assert wide_ids.intersection(narrow_others)
+
+
+def test_apply_parsed_matches_apply_geoparquet(
+    narrow_and_wide_configs, toy_geoparquet_path
+):
+    assert_apply_parsed_matches(
+        narrow_and_wide_configs,
+        lambda handler: handler.apply_geoparquet(
+            toy_geoparquet_path, id_column="osm_id", tags_column="osm_tags"
+        ),
+    )
+
+
+def test_apply_parsed_requires_shared_parse(test_config):
+    parsed = build.ObjectHandler(test_config, crs="epsg:27700")
+    with pytest.raises(ValueError, match="share_parse=True"):
+        build.ObjectHandler(test_config, crs="epsg:27700").apply_parsed(parsed)
+
+
+def test_apply_parsed_requires_same_crs(test_config):
+    parsed = build.ObjectHandler(test_config, crs="epsg:27700", share_parse=True)
+    with pytest.raises(ValueError, match="Cannot take objects parsed in crs"):
+        build.ObjectHandler(test_config, crs="epsg:4326").apply_parsed(parsed)
+
+
 @pytest.fixture()
 def test_leisure_config():
     return config.load(leisure_config_path)
@@ -161,21 +464,30 @@ class TestAreaActIntersection:
 
     @pytest.fixture
     def get_required_activities_in_target(self, updated_handler):
+        updated_handler.add_area(
+            idx=0,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)]),
+        )
+
         def _get_required_activities_in_target(required_activities):
-            return updated_handler._required_activities_in_target(
-                required_activities,
-                Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)]),
-                (10, 10),
+            coverage = updated_handler._required_activities_coverage(
+                required_activities, (10, 10)
             )
+            return coverage.get(0, 0)
 
         return _get_required_activities_in_target
 
-    def test_activities_from_area_intersection(self, updated_handler):
-
-        acts = updated_handler._activities_from_area_intersection(
-            Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)]), (10, 10)
+    def test_activity_coverage(self, updated_handler):
+        coverage = updated_handler._activity_coverage(
+            [Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)])],
+            updated_handler.objects.objects,
         )
-        assert acts == {"a": 150, "b": 100, "c": 100}
+        assert coverage.to_dict("records") == [
+            {"target": 0, "activity": "a", "area": 150, "points": 0},
+            {"target": 0, "activity": "b", "area": 0, "points": 1},
+            {"target": 0, "activity": "c", "area": 0, "points": 1},
+        ]
 
     def test_required_activities_one_in_target(self, get_required_activities_in_target):
         geom_area = get_required_activities_in_target(["a"])
@@ -197,6 +509,41 @@ class TestAreaActIntersection:
         geom_area = get_required_activities_in_target(["d"])
         assert geom_area == 0
 
+    def test_required_activities_coverage(self, updated_handler):
+        updated_handler.add_area(
+            idx=0,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)]),
+        )
+        updated_handler.add_area(
+            idx=1,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(90, 90), (90, 110), (110, 110), (110, 90), (90, 90)]),
+        )
+        coverage = updated_handler._required_activities_coverage(
+            ["a", "b", "d"], (10, 10)
+        )
+        assert coverage.to_dict() == {0: 250, 1: 100}
+
+    def test_required_activities_coverage_updated_with_new_objects(
+        self, updated_handler
+    ):
+        updated_handler.add_area(
+            idx=0,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(0, 0), (0, 50), (50, 50), (50, 0), (0, 0)]),
+        )
+        assert updated_handler._required_activities_coverage(["e"], (10, 10)).empty
+        updated_handler.add_object(
+            idx=1,
+            activity_tags=[],
+            osm_tags=[],
+            geom=Polygon([(20, 20), (20, 40), (40, 40), (40, 20), (20, 20)]),
+        )
+        updated_handler.objects.objects[-1].activities = ["e"]
+        coverage = updated_handler._required_activities_coverage(["e"], (10, 10))
+        assert coverage.to_dict() == {0: 400}
+
 
 class TestMissingActivity:
 
@@ -276,7 +623,7 @@ class TestMissingActivity:
 
         objects = [o for o in updated_handler.objects]
         house = objects[-1]
-        assert house.idx == "fill_0"
+        assert house.idx == "fill_0_0"
         assert house.geom.equals(Polygon([(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]))
 
     def test_fill_missing_activities_multiple_buildings(self, updated_handler):
@@ -291,10 +638,10 @@ class TestMissingActivity:
 
         objects = [o for o in updated_handler.objects]
         house = objects[-4]
-        assert house.idx == "fill_0"
+        assert house.idx == "fill_0_0"
         assert house.geom.equals(Polygon([(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]))
         house = objects[-1]
-        assert house.idx == "fill_3"
+        assert house.idx == "fill_0_3"
         assert house.geom.equals(
             Polygon(
                 [
@@ -307,6 +654,25 @@ class TestMissingActivity:
             )
         )
 
+    def test_fill_missing_activities_overlapping_areas(self, updated_handler):
+        updated_handler.add_area(
+            idx=1,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(0, 0), (0, 20), (20, 20), (20, 0), (0, 0)]),
+        )
+        kwargs = {
+            "area_tags": [("landuse", "residential")],
+            "required_acts": "d",
+            "new_tags": [("building", "house")],
+            "size": (10, 10),
+            "spacing": (101, 101),
+        }
+        # the fill of area 0 is inside area 1, but areas are checked before any are filled
+        assert updated_handler.fill_missing_activities(**kwargs) == (2, 2)
+        assert [o.idx for o in updated_handler.objects][-2:] == ["fill_0_0", "fill_1_0"]
+        # a later call counts the new objects
+        assert updated_handler.fill_missing_activities(**kwargs) == (0, 0)
+
     def test_fill_missing_activities_data_point_source(
         self, updated_handler, point_source_filepath
     ):
@@ -322,19 +688,44 @@ class TestMissingActivity:
         objects = [o for o in updated_handler.objects]
 
         house_1 = objects[-2]
-        assert house_1.idx == "fill_0"
+        assert house_1.idx == "fill_0_0"
         assert house_1.geom.equals(
             Polygon([(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)])
         )
 
         house_2 = objects[-1]
-        assert house_2.idx == "fill_1"
+        assert house_2.idx == "fill_0_1"
         assert house_2.geom.equals(
             Polygon(
                 [(10.0, 20.0), (20.0, 20.0), (20.0, 30.0), (10.0, 30.0), (10.0, 20.0)]
             )
         )
 
+    def test_fill_missing_activities_data_point_source_overlapping_areas(
+        self, updated_handler, point_source_filepath
+    ):
+        updated_handler.add_area(
+            idx=1,
+            activity_tags=[["landuse", "residential"]],
+            geom=Polygon([(5, 5), (5, 25), (25, 25), (25, 5), (5, 5)]),
+        )
+        zones, objects = updated_handler.fill_missing_activities(
+            area_tags=[("landuse", "residential")],
+            required_acts="d",
+            new_tags=[("building", "house")],
+            size=(10, 10),
+            fill_method="point_source",
+            point_source=point_source_filepath,
+        )
+        assert zones == 2
+        assert objects == 3
+        fill_geoms = [o.geom for o in updated_handler.objects][-3:]
+        assert [(g.bounds[0], g.bounds[1]) for g in fill_geoms] == [
+            (0, 0),
+            (10, 20),
+            (10, 20),
+        ]
+
     def test_fill_missing_activities_data_point_source_missing(self, updated_handler):
         with pytest.raises(
             ValueError,
@@ -348,6 +739,59 @@ class TestMissingActivity:
                 fill_method="point_source",
             )
 
+    def test_fill_missing_activities_groups_share_coverage(self, updated_handler):
+        fill_args = dict(
+            area_tags=[("landuse", "residential")],
+            required_acts="d",
+            new_tags=[("building", "house")],
+            size=(10, 10),
+            spacing=(100, 100),
+        )
+        assert updated_handler.fill_missing_activities(**fill_args) == (1, 4)
+        assert updated_handler.fill_missing_activities(**fill_args) == (0, 0)
+
+    def test_fill_missing_activities_ids_continue_across_groups(self, updated_handler):
+        fill_args = dict(
+            area_tags=[("landuse", "residential")],
+            new_tags=[("building", "house")],
+            size=(10, 10),
+            spacing=(100, 100),
+        )
+        updated_handler.fill_missing_activities(required_acts="d", **fill_args)
+        updated_handler.fill_missing_activities(required_acts="e", **fill_args)
+        fill_ids = [o.idx for o in updated_handler.objects][-8:]
+        assert fill_ids == [f"fill_0_{i}" for i in range(8)]
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_fill_missing_activities_parallel(self, test_config, workers):
+        handler = build.ObjectHandler(test_config, crs="epsg:4326", workers=workers)
+        for idx in range(5):
+            handler.add_area(
+                idx=idx,
+                activity_tags=[["landuse", "residential"]],
+                geom=Polygon(
+                    [
+                        (idx * 100, 0),
+                        (idx * 100, 50),
+                        (idx * 100 + 50, 50),
+                        (idx * 100 + 50, 0),
+                    ]
+                ),
+            )
+        zones, objects = handler.fill_missing_activities(
+            area_tags=[("landuse", "residential")],
+            required_acts="d",
+            new_tags=[("building", "house")],
+            size=(10, 10),
+            spacing=(25, 25),
+        )
+        assert (zones, objects) == (5, 45)
+        assert len(handler.objects) == 45
+        assert [o.idx for o in handler.objects][:10] == [
+            f"fill_0_{i}" for i in range(9)
+        ] + ["fill_1_0"]
+        assert handler.objects.intersection((400, 0, 400, 0))[0].idx == "fill_4_0"
+
     @pytest.mark.parametrize(
         ["max_fraction", "expected_fill"], [(0, False), (0.02, False), (0.04, True)]
     )
@@ -405,3 +849,169 @@ class TestExtract:
             assert obj["geometry"] == Point(0, 0)
             assert obj["id"] == "0"
             assert obj["feature"] == 0
+
+    def test_extract_single_use_skips_objects_without_activities(self, updated_handler):
+        updated_handler.add_object(
+            idx=1,
+            activity_tags=[],
+            osm_tags=[],
+            geom=Polygon([(5, 5), (5, 15), (15, 15), (15, 5), (5, 5)]),
+        )
+        updated_handler.objects.objects[1].activities = []
+        gdf = updated_handler.geodataframe(single_use=True)
+        assert gdf["id"].tolist() == ["0", "0"]
+        assert gdf["activity"].tolist() == ["a", "b"]
+        assert gdf.index.tolist() == [0, 1]
+
+    def test_extract_empty_geodataframe(self, testHandler):
+        gdf = testHandler.geodataframe()
+        assert gdf.empty
+        assert list(gdf.columns) == ["id", "activities", "geometry"]
+
+    def test_columns(self, updated_handler):
+        updated_handler.add_object(
+            idx=1,
+            activity_tags=[],
+            osm_tags=[],
+            geom=Polygon([(5, 5), (5, 15), (15, 15), (15, 5), (5, 5)]),
+        )
+        updated_handler.objects.objects[1].activities = ["c"]
+        columns = updated_handler.columns()
+        assert list(columns) == ["id", "activities", "geometry", "feature"]
+        assert columns["id"].tolist() == ["0", "1"]
+        assert columns["activities"] == [["a", "b"], ["c"]]
+        assert list(columns["geometry"]) == [Point(0, 0), Point(10, 10)]
+        assert columns["feature"] == [0, None]
+
+    @pytest.mark.parametrize("single_use", [True, False])
+    def test_to_arrow(self, updated_handler, single_use):
+        table = updated_handler.to_arrow(single_use=single_use)
+        expected = updated_handler.geodataframe(single_use=single_use)
+        assert table.column_names == list(expected.columns)
+        assert table["id"].to_pylist() == expected["id"].tolist()
+        assert table["geometry"].to_pylist() == expected.geometry.to_wkb().tolist()
+        assert (
+            table.schema.field("geometry").metadata[b"ARROW:extension:name"]
+            == b"geoarrow.wkb"
+        )
+
+    def test_to_arrow_geoarrow(self, updated_handler):
+        table = updated_handler.to_arrow(geometry_encoding="geoarrow", crs="epsg:3857")
+        assert (
+            table.schema.field("geometry").metadata[b"ARROW:extension:name"]
+            == b"geoarrow.point"
+        )
+        expected = updated_handler.geodataframe().to_crs("epsg:3857").geometry
+        point = table["geometry"].to_pylist()[0]
+        assert point["x"] == pytest.approx(expected.x[0])
+        assert point["y"] == pytest.approx(expected.y[0])
+
+    def test_to_arrow_batches(self, updated_handler):
+        for idx in range(1, 5):
+            updated_handler.add_object(
+                idx=idx,
+                activity_tags=[],
+                osm_tags=[],
+                geom=Point(idx, idx).buffer(1),
+            )
+            updated_handler.objects.objects[idx].activities = ["c"]
+        reader = updated_handler.to_arrow_batches(batch_size=2)
+        batches = list(reader)
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert batches[2]["id"].to_pylist() == ["4"]
+
+
+class TestQuery:
+    @pytest.fixture(params=["shapely", "float32"])
+    def grid_handler(self, request, testHandler):
+        """Handler with a grid of small and large objects, whose centroids are not at the centre of their bounds."""
+        testHandler.geometry_storage = request.param
+        for n in range(100):
+            x, y = n % 10 * 10, n // 10 * 10
+            size = 40 if n % 7 == 0 else 1
+            testHandler.add_object(
+                idx=n,
+                activity_tags=[],
+                osm_tags=[],
+                geom=Polygon([(x, y), (x + size, y), (x, y + size), (x, y)]),
+            )
+        for n, obj in enumerate(testHandler.objects):
+            obj.activities = [["home", "work", "shop"][n % 3]] + (
+                ["education"] if n % 5 == 0 else []
+            )
+        return testHandler
+
+    @pytest.fixture(params=[False, True])
+    def handler(self, request, grid_handler):
+        if request.param:
+            grid_handler.release_geometries()
+        return grid_handler
+
+    @staticmethod
+    def expected(handler, mask=None, order=None):
+        gdf = handler.geodataframe()
+        if mask is not None:
+            gdf = gdf[mask(gdf)]
+        if order is not None:
+            gdf = gdf.iloc[np.argsort(order(gdf).to_numpy(), kind="stable")]
+        return gdf["id"].tolist()
+
+    @staticmethod
+    def ids(objects):
+        return [str(o.idx) for o in objects]
+
+    def test_activity_index(self, handler):
+        index = handler.activity_index()
+        assert index["education"].tolist() == list(range(0, 100, 5))
+        assert sum(len(positions) for positions in index.values()) == 120
+        assert handler.activity_index() is index
+        handler.assign_activities()
+        assert handler.activity_index() is not index
+
+    def test_query_activities(self, handler):
+        result = handler.query(activities=["education", "shop"])
+        assert self.ids(result) == self.expected(
+            handler, lambda gdf: gdf.activities.str.contains("education|shop")
+        )
+        assert handler.query(activities="unknown") == []
+
+    def test_query_bbox(self, handler):
+        result = handler.query(bbox=(15, 5, 52, 42), activities="work")
+        centroids = handler.geodataframe().geometry
+        assert self.ids(result) == self.expected(
+            handler,
+            lambda gdf: centroids.within(shapely.box(15, 5, 52, 42))
+            & gdf.activities.str.contains("work"),
+        )
+        assert handler.query(bbox=(1000, 1000, 1001, 1001)) == []
+
+    def test_query_within(self, handler):
+        point = shapely.Point(33, 47)
+        result = handler.query(point=(33, 47), within=20)
+        assert self.ids(result) == self.expected(
+            handler, lambda gdf: gdf.geometry.distance(point) <= 20
+        )
+        assert 0 < len(result) < 100
+
+    @pytest.mark.parametrize("activities", [None, "education"])
+    def test_query_nearest(self, handler, activities):
+        point = shapely.Point(33, 47)
+        result = handler.query(point=(33, 47), activities=activities, nearest=7)
+        expected = self.expected(
+            handler,
+            mask=lambda gdf: gdf.activities.str.contains(activities or ""),
+            order=lambda gdf: gdf.geometry.distance(point),
+        )
+        assert self.ids(result) == expected[:7]
+
+    def test_query_as_arrow(self, handler):
+        table = handler.query(bbox=(0, 0, 30, 30), as_arrow=True)
+        expected = handler.geodataframe()
+        expected = expected[expected.geometry.within(shapely.box(0, 0, 30, 30))]
+        assert table.column_names == list(expected.columns)
+        assert table["id"].to_pylist() == expected["id"].tolist()
+        assert table["activities"].to_pylist() == expected["activities"].tolist()
+
+    def test_query_requires_point(self, handler):
+        with pytest.raises(ValueError, match="requires a point"):
+            handler.query(nearest=1)
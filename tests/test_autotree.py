@@ -82,3 +82,55 @@ def test_autotree_iter():
         )
     out = [o for o in tree]
     assert len(out) == 3
+
+
+def test_autotree_extend():
+    tree = helpers.AutoTree()
+    tree.auto_insert(
+        build.OSMObject(
+            idx=0, activity_tags=[build.OSMTag(key="b", value="b")], geom=Point((0, 0))
+        )
+    )
+    targets = [
+        build.OSMObject(
+            idx=i,
+            activity_tags=[build.OSMTag(key="b", value="b")],
+            geom=Polygon([(i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i)]),
+        )
+        for i in range(10, 13)
+    ]
+    tree.extend(targets)
+    assert len(tree) == 4
+    assert list(tree)[1:] == targets
+    assert tree.intersection((11.5, 11.5, 11.6, 11.6)) == [targets[1]]
+
+
+def test_autotree_bulk_load():
+    objects = [
+        build.OSMObject(
+            idx=i, activity_tags=[build.OSMTag(key="b", value="b")], geom=Point((i, i))
+        )
+        for i in range(5)
+    ]
+    tree = helpers.AutoTree(objects)
+    assert len(tree) == 5
+    assert list(tree) == objects
+    assert tree.intersection((2.5, 2.5, 4, 4)) == objects[3:]
+    tree.auto_insert(objects[0])
+    assert tree.intersection((0, 0, 0, 0)) == [objects[0], objects[0]]
+
+
+def test_autotree_sorted():
+    objects = [
+        build.OSMObject(
+            idx=i, activity_tags=[build.OSMTag(key="b", value="b")], geom=Point(xy)
+        )
+        for i, xy in enumerate([(0, 0), (3, 3), (0, 3), (3, 0), (1, 1)])
+    ]
+    tree = helpers.AutoTree(objects).sorted("hilbert")
+    assert [o.idx for o in tree] == [0, 4, 2, 1, 3]
+    assert tree.intersection((2.5, 2.5, 4, 4))[0].idx == 1
+
+
+def test_autotree_sorted_empty():
+    assert len(helpers.AutoTree().sorted()) == 0
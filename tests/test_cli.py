@@ -1,11 +1,17 @@
+import json
 import logging
 import os
+import subprocess
+import sys
 import traceback
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from click.testing import CliRunner
-from osmox import cli, helpers
+from osmox import cli, config, helpers, writers
+from shapely.geometry import Polygon
 
 logging.basicConfig(level=logging.INFO)
 
@@ -13,6 +19,7 @@ MAP_EXTENSIONS = {
     "geopackage": ".gpkg",
     "geojson": ".geojson",
     "geoparquet": ".parquet",
+    "flatgeobuf": ".fgb",
 }
 
 
@@ -68,7 +75,9 @@ def test_cli_with_default_args(
     assert default_output_file_path.exists()
 
 
-@pytest.mark.parametrize("output_format", ["geojson", "geopackage", "geoparquet"])
+@pytest.mark.parametrize(
+    "output_format", ["geojson", "geopackage", "geoparquet", "flatgeobuf"]
+)
 def test_cli_output_formats(
     runner,
     config_path,
@@ -113,3 +122,410 @@ def test_cli_output_crs(
 
     out_path = Path(path_output_dir + "_epsg_27700.gpkg")
     assert out_path.exists()
+
+
+def test_cli_parallel_infill(
+    runner, config_path, toy_osm_path, path_output_dir, tmp_path
+):
+    cnfg = config.load(config_path)
+    cnfg["fill_missing_activities"][0].update(
+        {
+            "area_tags": [["leisure", "pitch"]],
+            "required_acts": ["religous"],
+            "spacing": [2, 2],
+        }
+    )
+    infill_config_path = tmp_path / "config.json"
+    infill_config_path.write_text(json.dumps(cnfg))
+
+    result = runner.invoke(
+        cli.run,
+        [str(infill_config_path), toy_osm_path, path_output_dir, "-crs", "epsg:27700"],
+    )
+    check_exit_code(result)
+    gdf = helpers.read_geofile(path_output_dir + "_epsg_27700.gpkg")
+
+    result = runner.invoke(
+        cli.run,
+        [
+            str(infill_config_path),
+            toy_osm_path,
+            path_output_dir + "_parallel",
+            "-crs",
+            "epsg:27700",
+            "-w",
+            "2",
+        ],
+    )
+    check_exit_code(result)
+    gdf_parallel = helpers.read_geofile(path_output_dir + "_parallel_epsg_27700.gpkg")
+
+    assert gdf_parallel["id"].tolist() == gdf["id"].tolist()
+    assert gdf["id"].str.startswith("fill_").any()
+
+
+def test_cli_geoparquet_options(runner, config_path, toy_osm_path, path_output_dir):
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--row-group-size",
+            "2",
+            "--compression",
+            "zstd",
+            "--bbox-covering",
+        ],
+    )
+    check_exit_code(result)
+    for crs in ["epsg_27700", "epsg_4326"]:
+        new_file = Path(f"{path_output_dir}_{crs}.parquet")
+        gdf = helpers.read_geofile(new_file)
+        assert not gdf.empty
+        assert "bbox" in gdf.columns
+
+
+@pytest.mark.parametrize("output_format", ["geopackage", "geoparquet"])
+def test_cli_multiple_output_crs(
+    runner, config_path, toy_osm_path, path_output_dir, output_format
+):
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            output_format,
+            "-crs",
+            "epsg:27700",
+            "-crs",
+            "epsg:3857",
+        ],
+    )
+    check_exit_code(result)
+    extension = MAP_EXTENSIONS[output_format]
+    gdfs = {
+        crs: helpers.read_geofile(Path(f"{path_output_dir}_{crs}{extension}"))
+        for crs in ["epsg_27700", "epsg_3857", "epsg_4326"]
+    }
+    assert gdfs["epsg_3857"].crs == "epsg:3857"
+    for crs in ["epsg:3857", "epsg:4326"]:
+        reprojected = gdfs["epsg_27700"].to_crs(crs)
+        assert reprojected.geom_equals_exact(gdfs[crs.replace(":", "_")], 1e-6).all()
+
+
+def test_cli_partitioned_output(runner, config_path, toy_osm_path, path_output_dir):
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--partition-by",
+            "activity",
+            "--partition-by",
+            "quadkey",
+            "--quadkey-zoom",
+            "12",
+        ],
+    )
+    check_exit_code(result)
+
+    dataset = Path(path_output_dir + "_epsg_27700.parquet")
+    assert dataset.is_dir()
+    partitions = [path.relative_to(dataset) for path in dataset.glob("*/*/*.parquet")]
+    assert partitions
+    assert all(
+        path.parts[0].startswith("activity=") and path.parts[1].startswith("quadkey=")
+        for path in partitions
+    )
+
+
+def test_cli_partitioned_output_requires_geoparquet(
+    runner, config_path, toy_osm_path, path_output_dir
+):
+    result = runner.invoke(
+        cli.run,
+        [config_path, toy_osm_path, path_output_dir, "--partition-by", "activity"],
+    )
+    assert result.exit_code == 2
+    assert "partitioned output requires '-f geoparquet'" in result.output
+
+
+@pytest.mark.parametrize("curve", ["hilbert", "zorder"])
+def test_cli_sort(runner, config_path, toy_osm_path, path_output_dir, curve):
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--sort",
+            curve,
+        ],
+    )
+    check_exit_code(result)
+    gdf = helpers.read_geofile(Path(f"{path_output_dir}_epsg_27700.parquet"))
+    assert not gdf.empty
+
+
+def test_cli_geometry_storage(runner, config_path, toy_osm_path, path_output_dir):
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--geometry-storage",
+            "float32",
+            "--geometry-precision",
+            "10",
+        ],
+    )
+    check_exit_code(result)
+    gdf = helpers.read_geofile(Path(f"{path_output_dir}_epsg_27700.parquet"))
+    assert not gdf.empty
+    assert (gdf.geometry.x % 10 == 0).all() and (gdf.geometry.y % 10 == 0).all()
+
+
+def test_cli_facility_index(runner, config_path, toy_osm_path, path_output_dir):
+    from osmox.facilities import FacilityIndex
+
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--facility-index",
+        ],
+    )
+    check_exit_code(result)
+    for crs in ["epsg_27700", "epsg_4326"]:
+        gdf = helpers.read_geofile(Path(f"{path_output_dir}_{crs}.parquet"))
+        with FacilityIndex(f"{path_output_dir}_{crs}.index") as index:
+            assert index.bbox(*gdf.total_bounds)["id"].to_pylist() == gdf["id"].tolist()
+
+
+def test_cli_geoparquet_input(runner, config_path, path_output_dir, tmp_path):
+    building = Polygon(
+        [(-0.1, 51.5), (-0.1, 51.5001), (-0.0999, 51.5001), (-0.0999, 51.5)]
+    )
+    table = pa.table(
+        {
+            "osm_id": pa.array([1, 2], type=pa.int64()),
+            "osm_tags": pa.array(
+                [[("building", "yes")], [("amenity", "pub"), ("name", "The Pub")]],
+                type=pa.map_(pa.string(), pa.string()),
+            ),
+            "geometry": [building.wkb, building.centroid.wkb],
+        }
+    )
+    input_path = tmp_path / "input.parquet"
+    pq.write_table(table, input_path)
+
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            str(input_path),
+            path_output_dir,
+            "-f",
+            "geoparquet",
+            "--id-column",
+            "osm_id",
+            "--tags-column",
+            "osm_tags",
+        ],
+    )
+    check_exit_code(result)
+    gdf = helpers.read_geofile(Path(f"{path_output_dir}_epsg_4326.parquet"))
+    assert gdf["id"].tolist() == ["1"]
+    assert set(gdf["activities"][0].split(",")) == {"social", "work", "delivery"}
+
+
+def test_cli_profile(runner, config_path, toy_osm_path, path_output_dir, tmp_path):
+    report_path = tmp_path / "report.json"
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "--profile",
+            str(report_path),
+            "--profile-memory",
+            "--cprofile-dir",
+            str(tmp_path / "prof"),
+        ],
+    )
+    check_exit_code(result)
+    report = json.loads(report_path.read_text())
+    stages = {stage["name"]: stage for stage in report["stages"]}
+    assert list(stages) == [
+        "parse",
+        "assign_tags",
+        "assign_activities",
+        "fill",
+        "features",
+        "distances",
+        "write",
+    ]
+    assert stages["parse"]["objects"] == 5
+    assert stages["assign_tags"]["released"] == ["points"]
+    assert stages["fill"]["released"] == ["areas", "geometries"]
+    assert stages["fill"]["points"] == stages["fill"]["areas"] == 0
+    assert stages["write"]["paths"] == [
+        f"{path_output_dir}_epsg_27700.gpkg",
+        f"{path_output_dir}_epsg_4326.gpkg",
+    ]
+    assert all("top_allocations" in stage for stage in stages.values())
+    assert (tmp_path / "prof" / "assign_tags.prof").exists()
+
+
+def test_cli_memory_limit(runner, config_path, toy_osm_path, path_output_dir, tmp_path):
+    report_path = tmp_path / "report.json"
+    result = runner.invoke(
+        cli.run,
+        [
+            config_path,
+            toy_osm_path,
+            path_output_dir,
+            "--memory-limit",
+            "100000",
+            "--profile",
+            str(report_path),
+        ],
+    )
+    check_exit_code(result)
+    stages = json.loads(report_path.read_text())["stages"]
+    # allocations are only traced with --profile-memory
+    assert not any("top_allocations" in stage for stage in stages)
+    stages = [stage["name"] for stage in stages]
+    # the toy input fits in the memory limit, so it is run in memory without being spilled or chunked
+    assert stages[:2] == ["spill", "parse"]
+    assert stages[-1] == "write"
+    assert "chunks" not in stages
+    for crs in ["epsg_27700", "epsg_4326"]:
+        assert os.path.exists(f"{path_output_dir}_{crs}.gpkg")
+
+
+def test_cli_memory_limit_below_memory_use(
+    runner, config_path, toy_osm_path, path_output_dir
+):
+    result = runner.invoke(
+        cli.run, [config_path, toy_osm_path, path_output_dir, "--memory-limit", "1"]
+    )
+    assert result.exit_code == 2
+    assert "is below current memory use" in result.output
+
+
+def test_cli_import_does_not_import_heavy_dependencies():
+    heavy = [
+        "geopandas",
+        "jsonschema",
+        "osmium",
+        "pandas",
+        "pyarrow",
+        "pyproj",
+        "rtree",
+        "shapely",
+    ]
+    code = f"import sys, osmox.cli; print([m for m in {heavy!r} if m in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_cli_partition_keys_match_writers():
+    option = next(param for param in cli.run.params if param.name == "partition_by")
+    assert list(option.type.choices) == writers.PARTITION_KEYS
+
+
+def test_cli_batch(runner, config_path, toy_osm_path, tmp_path):
+    manifest = {
+        "defaults": {
+            "format": "geoparquet",
+            "input": toy_osm_path,
+            "config": config_path,
+        },
+        "jobs": [{"output": "a/out"}, {"output": "b/out", "single_use": True}],
+    }
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest))
+
+    result = runner.invoke(cli.batch, [str(manifest_path), "--processes", "2"])
+    check_exit_code(result)
+    for output in ["a", "b"]:
+        for crs in ["epsg_27700", "epsg_4326"]:
+            assert (tmp_path / output / f"out_{crs}.parquet").exists()
+
+
+def test_cli_batch_invalid_manifest(runner, tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps({"jobs": [{"config": "a.json"}]}))
+    result = runner.invoke(cli.batch, [str(manifest_path)])
+    assert result.exit_code == 2
+    assert "missing paths" in result.output
+
+
+def test_cli_batch_job_defaults_match_run(config_path, toy_osm_path):
+    from osmox.runner import JOB_DEFAULTS
+
+    params = cli.run.make_context("run", [config_path, toy_osm_path, "output"]).params
+    defaults = {key: params[key] for key in JOB_DEFAULTS}
+    defaults["crs"] = list(defaults["crs"])
+    defaults["partition_by"] = list(defaults["partition_by"])
+    assert defaults == JOB_DEFAULTS
+
+
+def test_cli_tiles(runner, config_path, toy_osm_path, tmp_path):
+    output_name = str(tmp_path / "tiled")
+    result = runner.invoke(
+        cli.tiles,
+        [
+            "plan",
+            config_path,
+            toy_osm_path,
+            output_name,
+            "--tile-size",
+            "0.001",
+            "--halo",
+            "100",
+            "-f",
+            "geoparquet",
+        ],
+    )
+    check_exit_code(result)
+    plan_path = tmp_path / "tiled_tiles" / "plan.json"
+    assert len(json.loads(plan_path.read_text())["tiles"]) == 6
+
+    result = runner.invoke(cli.tiles, ["merge", str(plan_path)])
+    assert result.exit_code == 1
+    assert "Tiles have not been run" in result.output
+
+    result = runner.invoke(
+        cli.tiles, ["run", str(plan_path), "--tile", "0_0", "--tile", "9_9"]
+    )
+    assert result.exit_code == 2
+    assert "unknown tiles: ['9_9']" in result.output
+
+    check_exit_code(
+        runner.invoke(cli.tiles, ["run", str(plan_path), "--processes", "2"])
+    )
+    check_exit_code(runner.invoke(cli.tiles, ["merge", str(plan_path)]))
+    for crs in ["epsg_27700", "epsg_4326"]:
+        assert pq.read_metadata(tmp_path / f"tiled_{crs}.parquet").num_rows == 5
@@ -3,7 +3,7 @@ import os
 
 import jsonschema
 import pytest
-from osmox import config
+from osmox import config, helpers
 
 root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
 test_config_path = os.path.join(root, "test_config.json")
@@ -153,3 +153,101 @@ def test_config_with_invalid_activity_for_fill_missing_activities_logging(valid_
         match="'Fill missing activities' group has non-configured activities: {'invalid_activity'}",
     ):
         config.validate_activity_config(valid_config)
+
+
+def test_compile_config_is_cached_by_content(valid_config):
+    compiled = config.compile_config(valid_config)
+    same_content = {key: valid_config[key] for key in reversed(list(valid_config))}
+    assert config.compile_config(same_content) is compiled
+    assert config.compile_config(compiled) is compiled
+
+    valid_config["object_features"] = ["area"]
+    other = config.compile_config(valid_config)
+    assert other is not compiled
+    assert other.digest != compiled.digest
+
+
+def test_compiled_config_is_a_mapping(valid_config):
+    compiled = config.compile_config(valid_config)
+    assert dict(compiled) == valid_config
+    assert compiled["filter"] == valid_config["filter"]
+    assert compiled.get("missing") is None
+
+
+def test_compiled_config_precomputed_sets(valid_config):
+    compiled = config.compile_config(valid_config)
+    assert (compiled.filter_keys, compiled.filter_tags) == config.get_tags(valid_config)
+    assert compiled.activities == config.get_acts(valid_config)
+
+
+@pytest.mark.parametrize(
+    "tags,selected,mapped",
+    [
+        ({"building": "house"}, True, [("building", "house")]),
+        ({"building": "shed"}, False, []),
+        ({"shop": "bakery", "highway": "bus_stop"}, True, [("highway", "bus_stop")]),
+        ({"amenity": "pub", "name": "The Pub"}, False, [("amenity", "pub")]),
+        ({}, False, []),
+    ],
+)
+def test_compiled_config_tag_lookups(valid_config, tags, selected, mapped):
+    compiled = config.compile_config(valid_config)
+    assert compiled.selects(tags) is selected
+    assert compiled.selects(tags) == helpers.dict_list_match(
+        tags, valid_config["filter"]
+    )
+    assert compiled.mapped_tags(tags) == mapped
+
+
+def test_compiled_config_validated_once(mocker, valid_config):
+    compiled = config.compile_config(valid_config)
+    validate = mocker.spy(config, "validate")
+    config.validate_activity_config(compiled)
+    config.validate_activity_config(compiled)
+    assert compiled.valid
+    assert validate.call_count == 1
+
+
+def test_invalid_compiled_config(valid_config):
+    valid_config["distance_to_nearest"].append("invalid_activity")
+    compiled = config.compile_config(valid_config)
+    for _ in range(2):
+        with pytest.raises(
+            ValueError, match="'Distance to nearest' has non-configured activities"
+        ):
+            config.validate_activity_config(compiled)
+    assert not compiled.valid
+
+
+def test_load_compiled():
+    assert config.load_compiled(test_config_path) is config.compile_config(
+        config.load(test_config_path)
+    )
+
+
+def test_validator_does_not_modify_metaschema():
+    validator = config.load_validator()
+    assert "unevaluatedProperties" not in type(validator).META_SCHEMA
+
+
+def test_union_config(valid_config):
+    other = {
+        "filter": {"building": ["yes", "shed"], "amenity": ["pub"]},
+        "activity_mapping": {"building": {"house": ["work"], "shed": ["work"]}},
+        "object_features": [],
+    }
+    union = config.union_config([valid_config, config.compile_config(other)])
+    assert union["filter"] == {
+        "building": ["house", "shed", "yes"],
+        "public_transport": ["*"],
+        "highway": ["bus_stop"],
+        "amenity": ["pub"],
+    }
+    assert union["activity_mapping"]["building"] == {
+        "house": ["home", "work"],
+        "shed": ["work"],
+    }
+    assert union["activity_mapping"]["shop"] == valid_config["activity_mapping"]["shop"]
+    assert config.compile_config(union).activities == config.get_acts(valid_config) | {
+        "work"
+    }
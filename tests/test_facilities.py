@@ -0,0 +1,209 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from osmox import build, config, facilities
+from pyproj import CRS
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+config_path = os.path.join(fixtures_root, "test_config.json")
+
+
+@pytest.fixture()
+def handler():
+    handler = build.ObjectHandler(config.load(config_path), crs="epsg:27700")
+    handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handler.assign_tags()
+    handler.assign_activities()
+    handler.add_features()
+    return handler
+
+
+@pytest.fixture()
+def index_path(handler, tmp_path):
+    path = facilities.index_path(str(tmp_path / "toy"), "epsg:27700")
+    facilities.write_facility_index(handler, path, batch_size=2)
+    return path
+
+
+def test_index_path():
+    assert (
+        facilities.index_path("outputs/toy", "epsg:27700")
+        == "outputs/toy_epsg_27700.index"
+    )
+
+
+def test_facility_index_bbox(handler, index_path):
+    expected = handler.geodataframe()
+    minx, miny, maxx, maxy = expected.total_bounds
+    bbox = (minx, miny, (minx + maxx) / 2, maxy)
+    with facilities.FacilityIndex(index_path) as index:
+        assert len(index) == len(expected)
+        assert index.crs == CRS("epsg:27700")
+        assert (
+            index.bbox(*expected.total_bounds)["id"].to_pylist()
+            == expected["id"].tolist()
+        )
+        result = index.bbox(*bbox)
+    within = expected[expected.geometry.intersects(shapely.box(*bbox))]
+    assert 0 < len(within) < len(expected)
+    assert result["id"].to_pylist() == within["id"].tolist()
+    assert result["activities"].to_pylist() == within["activities"].tolist()
+    assert result["floor_area"].to_pylist() == within["floor_area"].tolist()
+
+
+def test_facility_index_nearest(handler, index_path):
+    expected = handler.geodataframe()
+    x, y = expected.total_bounds[:2]
+    distances = expected.geometry.distance(shapely.Point(x, y))
+    with facilities.FacilityIndex(index_path) as index:
+        result = index.nearest(x, y, k=3)
+        assert len(index.nearest(x, y, k=10)) == len(expected)
+    assert (
+        result["id"].to_pylist() == expected["id"][np.argsort(distances)[:3]].tolist()
+    )
+    assert result["distance"].to_pylist() == pytest.approx(sorted(distances)[:3])
+
+
+def test_facility_index_of_no_objects(tmp_path):
+    handler = build.ObjectHandler(config.load(config_path))
+    facilities.write_facility_index(handler, tmp_path / "empty.index")
+    with facilities.FacilityIndex(tmp_path / "empty.index") as index:
+        assert len(index) == 0
+        assert len(index.bbox(-1e9, -1e9, 1e9, 1e9)) == 0
+        assert len(index.nearest(0, 0)) == 0
+
+
+def test_facility_index_missing(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No facility index found"):
+        facilities.FacilityIndex(tmp_path / "missing.index")
+
+
+def test_facility_index_activities(handler, index_path):
+    expected = handler.geodataframe()
+    x, y = expected.total_bounds[:2]
+    distances = expected.geometry.distance(shapely.Point(x, y))
+    work = expected.activities.str.contains("work").to_numpy()
+    assert 0 < work.sum() < len(expected)
+    with facilities.FacilityIndex(index_path) as index:
+        in_bbox = index.bbox(*expected.total_bounds, activities=["work"])
+        nearest = index.nearest(x, y, k=2, activities="work")
+        assert len(index.bbox(*expected.total_bounds, activities="unknown")) == 0
+    assert in_bbox["id"].to_pylist() == expected["id"][work].tolist()
+    assert (
+        nearest["id"].to_pylist()
+        == expected["id"][work][np.argsort(distances[work])[:2]].tolist()
+    )
+
+
+def test_facility_index_within(handler, index_path):
+    expected = handler.geodataframe()
+    x, y = expected.total_bounds[:2]
+    distances = expected.geometry.distance(shapely.Point(x, y))
+    radius = distances.median()
+    with facilities.FacilityIndex(index_path) as index:
+        result = index.within(x, y, radius)
+    assert result["id"].to_pylist() == expected["id"][distances <= radius].tolist()
+    assert result["distance"].to_pylist() == pytest.approx(
+        distances[distances <= radius].tolist()
+    )
+
+
+def test_facility_index_sample(handler, index_path):
+    expected = handler.geodataframe()
+    x, y = expected.total_bounds[:2]
+    weighted = expected[expected.floor_area > 0]
+    with facilities.FacilityIndex(index_path) as index:
+        sample = index.sample(x, y, 1e6, n=200, weight="floor_area", seed=1)
+        assert sample.equals(
+            index.sample(x, y, 1e6, n=200, weight="floor_area", seed=1)
+        )
+        unique = index.sample(x, y, 1e6, n=1000, replace=False, seed=1)
+        assert len(index.sample(x, y, 1e6, n=5, activities="unknown")) == 0
+        with pytest.raises(KeyError, match="Unknown weight feature"):
+            index.sample(x, y, 1e6, weight="unknown")
+    assert len(sample) == 200
+    assert set(sample["id"].to_pylist()) <= set(weighted["id"])
+    assert sorted(unique["id"].to_pylist()) == sorted(expected["id"])
+
+
+@pytest.mark.parametrize("single_use", [False, True])
+def test_facility_index_from_output(handler, tmp_path, single_use):
+    expected = handler.geodataframe(single_use=single_use)
+    path = tmp_path / "toy.gpkg"
+    expected.to_file(path)
+    x, y = expected.total_bounds[:2]
+    activity = expected.iloc[0]["activity" if single_use else "activities"].split(",")[
+        0
+    ]
+    with facilities.FacilityIndex.from_output(path) as index:
+        assert len(index) == len(expected)
+        assert index.crs == CRS("epsg:27700")
+        assert (
+            index.bbox(*expected.total_bounds)["id"].to_pylist()
+            == expected["id"].tolist()
+        )
+        assert index.nearest(x, y)["distance"].to_pylist() == pytest.approx(
+            [expected.geometry.distance(shapely.Point(x, y)).min()]
+        )
+        assert len(index.within(x, y, 1e6, activities=activity)) > 0
+
+
+def test_facility_index_persists_grid(mocker, handler, index_path):
+    expected = handler.geodataframe()
+    build_grid = mocker.spy(facilities, "_grid")
+    with facilities.FacilityIndex(index_path) as index:
+        rows = index.bbox_rows(*expected.total_bounds)
+    build_grid.assert_not_called()
+    assert rows.tolist() == list(range(len(expected)))
+
+    # indexes written without a grid build it on first use
+    os.remove(os.path.join(index_path, facilities.GRID_FILE))
+    with facilities.FacilityIndex(index_path) as index:
+        assert index.bbox_rows(*expected.total_bounds).tolist() == rows.tolist()
+    build_grid.assert_called_once()
+
+
+def test_facility_index_activities_and_features_with_nulls(tmp_path):
+    gdf = gpd.GeoDataFrame(
+        {
+            "id": ["a", "b", "c", "d"],
+            "activities": ["work,shop", None, "shop", "home,work"],
+            "floor_area": [10.0, np.nan, 30.0, np.nan],
+        },
+        geometry=gpd.points_from_xy([0, 1, 2, 3], [0, 1, 2, 3]),
+        crs="epsg:27700",
+    )
+    gdf.to_parquet(tmp_path / "points.parquet")
+    with facilities.FacilityIndex.from_output(tmp_path / "points.parquet") as index:
+        rows = np.arange(4)
+        assert index.activity_rows("work", rows).tolist() == [0, 3]
+        assert index.activity_rows(["shop", "home"], rows[::-1]).tolist() == [3, 2, 0]
+        assert len(index.activity_rows("unknown", rows)) == 0
+        np.testing.assert_array_equal(
+            index.feature_values("floor_area", rows), gdf.floor_area.to_numpy()
+        )
+
+
+def test_facility_index_grid(tmp_path):
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(0, 1000, 500), rng.uniform(0, 300, 500)
+    gdf = gpd.GeoDataFrame(
+        {"id": [str(n) for n in range(500)], "activities": "work"},
+        geometry=gpd.points_from_xy(x, y),
+        crs="epsg:27700",
+    )
+    gdf.to_parquet(tmp_path / "points.parquet")
+    with facilities.FacilityIndex.from_output(tmp_path / "points.parquet") as index:
+        for minx, miny in rng.uniform(-100, 1000, (50, 2)):
+            maxx, maxy = minx + rng.uniform(0, 500), miny + rng.uniform(0, 500)
+            inside = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+            assert (
+                index.bbox_rows(minx, miny, maxx, maxy).tolist()
+                == np.flatnonzero(inside).tolist()
+            )
+        assert index.bbox_rows(*gdf.total_bounds).tolist() == list(range(500))
+        assert len(index.bbox_rows(-10, -10, -1, -1)) == 0
@@ -1,8 +1,11 @@
+import io
+
 import geopandas as gpd
+import numpy as np
 import pytest
 from geopandas.testing import assert_geodataframe_equal
 from osmox import helpers
-from shapely.geometry import Polygon
+from shapely.geometry import Point, Polygon
 
 
 @pytest.mark.parametrize(
@@ -74,6 +77,31 @@ def test_fill_objects():
     assert obj.activities == ["act"]
 
 
+def test_fill_objects_vectorised():
+    objs = helpers.fill_objects(
+        7, [0, 20], [0, 5], [10, 10], [["osm_tag", 1]], [["new_tags", 2]], ["act"], 2
+    )
+    assert [obj.idx for obj in objs] == ["fill_7_2", "fill_7_3"]
+    assert objs[0].geom.equals(Polygon([(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]))
+    assert objs[1].geom.equals(Polygon([(20, 5), (20, 15), (30, 15), (30, 5), (20, 5)]))
+    assert all(obj.activities == ["act"] for obj in objs)
+
+
+def test_fill_objects_vectorised_empty():
+    objs = helpers.fill_objects(
+        0, [], [], [10, 10], [["osm_tag", 1]], [["new_tags", 2]], ["act"]
+    )
+    assert objs == []
+
+
+def test_area_grid_xy_matches_area_grid():
+    area = Polygon([(0, 0), (0, 50), (50, 50), (0, 0)])
+    xs, ys = helpers.area_grid_xy(area=area, spacing=[25, 25])
+    assert set(zip(xs, ys, strict=True)) == set(
+        helpers.area_grid(area=area, spacing=[25, 25])
+    )
+
+
 def test_point_to_poly():
     p = (0, 0)
     poly = helpers.point_to_poly(p, [10, 10])
@@ -113,3 +141,113 @@ def test_read_geofile(file_format_data):
     filepath, gdf = file_format_data
     new_gdf = helpers.read_geofile(filepath)
     assert_geodataframe_equal(gdf, new_gdf)
+
+
+def test_read_geofile_bbox(file_format_data):
+    filepath, gdf = file_format_data
+    new_gdf = helpers.read_geofile(filepath, bbox=(-0.5, -0.5, 0.5, 1.5))
+    assert_geodataframe_equal(
+        gdf.iloc[[0, 2]].reset_index(drop=True), new_gdf.reset_index(drop=True)
+    )
+
+
+def test_read_geofile_mask(file_format_data):
+    filepath, gdf = file_format_data
+    mask = gpd.GeoSeries(
+        [Polygon([(0.5, -0.5), (1.5, -0.5), (1.5, 0.5), (0.5, 0.5)])], crs="epsg:27700"
+    )
+    new_gdf = helpers.read_geofile(filepath, mask=mask)
+    assert_geodataframe_equal(
+        gdf.iloc[[1]].reset_index(drop=True), new_gdf.reset_index(drop=True)
+    )
+
+
+def test_read_geofile_bbox_and_mask(file_format_data):
+    filepath, _ = file_format_data
+    with pytest.raises(ValueError, match="Only one of `bbox` and `mask`"):
+        helpers.read_geofile(
+            filepath, bbox=(0, 0, 1, 1), mask=Polygon([(0, 0), (1, 0), (1, 1)])
+        )
+
+
+@pytest.mark.parametrize(
+    ["curve", "expected"], [("hilbert", [0, 4, 2, 1, 3]), ("zorder", [0, 4, 3, 2, 1])]
+)
+def test_spatial_order(curve, expected):
+    geoms = [
+        Point(0, 0),
+        Polygon([(2, 2), (2, 4), (4, 4), (4, 2)]),
+        Point(0, 3),
+        Point(3, 0),
+        Point(1, 1),
+    ]
+    assert helpers.spatial_order(geoms, curve=curve).tolist() == expected
+
+
+def test_spatial_order_unknown_curve():
+    with pytest.raises(ValueError, match="Unknown space-filling curve"):
+        helpers.spatial_order([Point(0, 0)], curve="peano")
+
+
+def test_z_order_distance():
+    x = np.array([0.0, 1.0, 0.0, 1.0])
+    y = np.array([0.0, 0.0, 1.0, 1.0])
+    assert helpers.z_order_distance(x, y, level=1).tolist() == [0, 1, 2, 3]
+    assert helpers.z_order_distance(x[:1], y[:1]).tolist() == [0]
+
+
+class TTY(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def test_progress_bar_yields_all_items():
+    assert list(helpers.progressBar(range(5), stream=TTY())) == list(range(5))
+
+
+def test_progress_bar_disabled_on_non_tty():
+    stream = io.StringIO()
+    assert list(helpers.progressBar(range(5), stream=stream)) == list(range(5))
+    assert stream.getvalue() == ""
+
+
+def test_progress_bar_throttled():
+    stream = TTY()
+    list(helpers.progressBar(range(1000), stream=stream, interval=60, step=10))
+    # start, every 10%, end
+    assert stream.getvalue().count("%") == 11
+    assert stream.getvalue().endswith("100.0% \r\n")
+
+
+def test_progress_bar_callback_events():
+    events = []
+    items = list(
+        helpers.progressBar(
+            range(10),
+            stage="test",
+            callback=events.append,
+            stream=io.StringIO(),
+            step=50,
+        )
+    )
+    assert items == list(range(10))
+    assert [(e.stage, e.done, e.total) for e in events] == [
+        ("test", 0, 10),
+        ("test", 5, 10),
+        ("test", 10, 10),
+    ]
+    assert events[-1].rate > 0
+
+
+def test_progress_bar_empty_iterable():
+    events = []
+    assert list(helpers.progressBar([], callback=events.append, enabled=False)) == []
+    assert [(e.done, e.total) for e in events] == [(0, 0), (0, 0)]
+
+
+def test_path_path_import(tmp_path):
+    from osmox.cli import PathPath
+    from osmox.helpers import PathPath as HelpersPathPath
+
+    assert HelpersPathPath is PathPath
+    assert HelpersPathPath(exists=True).convert(str(tmp_path), None, None) == tmp_path
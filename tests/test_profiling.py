@@ -0,0 +1,78 @@
+import json
+import pstats
+
+import pytest
+from osmox import profiling
+
+
+class Counts:
+    def __init__(self, objects):
+        self.objects = list(range(objects))
+        self.points = []
+        self.areas = [0]
+
+
+def test_stage_records_timings_and_counts():
+    profiler = profiling.Profiler(trace_memory=False)
+    handler = Counts(10)
+    with profiler.stage("parse", handler) as record:
+        record["extra"] = 1
+    (stage,) = profiler.stages
+    assert stage["name"] == "parse"
+    assert stage["wall_time_s"] >= 0
+    assert stage["cpu_time_s"] >= 0
+    assert (stage["objects"], stage["points"], stage["areas"]) == (10, 0, 1)
+    assert stage["extra"] == 1
+    assert "top_allocations" not in stage
+
+
+def test_stage_traces_memory():
+    profiler = profiling.Profiler(trace_memory=True, top_allocations=3)
+    with profiler.stage("allocate"):
+        data = [bytearray(1024) for _ in range(1000)]
+    (stage,) = profiler.stages
+    assert stage["traced_peak_mb"] >= 1
+    assert isinstance(stage["rss_change_mb"], float)
+    assert 0 <= stage["peak_rss_increase_mb"] <= stage["process_peak_rss_mb"]
+    assert "peak_rss_mb" not in stage
+    assert len(stage["top_allocations"]) <= 3
+    assert stage["top_allocations"][0]["location"].startswith(__file__)
+    assert stage["top_allocations"][0]["size_diff_mb"] >= 1
+    del data
+
+
+def test_stage_recorded_on_error():
+    profiler = profiling.Profiler(trace_memory=False)
+    with pytest.raises(ValueError), profiler.stage("fail"):
+        raise ValueError()
+    assert profiler.stages[0]["name"] == "fail"
+
+
+def test_disabled_profiler_records_nothing(tmp_path):
+    profiler = profiling.Profiler(enabled=False, cprofile_dir=tmp_path)
+    with profiler.stage("parse") as record:
+        record["extra"] = 1
+    assert profiler.stages == []
+    assert not list(tmp_path.iterdir())
+
+
+def test_cprofile_dump(tmp_path):
+    profiler = profiling.Profiler(trace_memory=False, cprofile_dir=tmp_path / "prof")
+    with profiler.stage("sum"):
+        sum(range(1000))
+    stats = pstats.Stats(str(tmp_path / "prof" / "sum.prof"))
+    assert stats.total_calls > 0
+    assert profiler.stages[0]["cprofile"] == str(tmp_path / "prof" / "sum.prof")
+
+
+def test_write_report(tmp_path):
+    profiler = profiling.Profiler()
+    profiler.metadata["workers"] = 2
+    with profiler.stage("parse", Counts(5)):
+        pass
+    path = tmp_path / "report.json"
+    profiler.write(path)
+    report = json.loads(path.read_text())
+    assert report["workers"] == 2
+    assert report["total"]["wall_time_s"] >= report["stages"][0]["wall_time_s"]
+    assert [stage["name"] for stage in report["stages"]] == ["parse"]
@@ -0,0 +1,124 @@
+import json
+import os
+
+import pyarrow.parquet as pq
+import pytest
+from osmox import build, config, runner
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+config_path = os.path.join(fixtures_root, "test_config_infill.json")
+
+
+@pytest.fixture
+def config_paths(tmp_path):
+    """Paths to the infill config, and a variant which also selects amenities and maps fewer activities."""
+    cnfg = config.load(config_path)
+    cnfg["filter"]["amenity"] = list(cnfg["activity_mapping"]["amenity"])
+    cnfg["activity_mapping"].pop("leisure")
+    variant_path = tmp_path / "variant.json"
+    variant_path.write_text(json.dumps(cnfg))
+    return [config_path, str(variant_path)]
+
+
+@pytest.fixture
+def manifest_path(tmp_path, config_paths):
+    manifest = {
+        "defaults": {"format": "geoparquet", "crs": "epsg:27700"},
+        "jobs": [
+            {"config": config_paths[0], "input": toy_osm_path, "output": "outputs/a"},
+            {
+                "config": config_paths[1],
+                "input": toy_osm_path,
+                "output": "outputs/b",
+                "single_use": True,
+            },
+        ],
+    }
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(manifest))
+    return path
+
+
+def read_output(path):
+    table = pq.read_table(path).to_pandas()
+    # activities of multi-use objects are in no particular order
+    for column in ["activity", "activities"]:
+        if column in table:
+            table[column] = table[column].map(lambda acts: sorted(acts.split(",")))
+    return table
+
+
+def test_load_manifest(manifest_path, config_paths):
+    jobs = runner.load_manifest(manifest_path)
+    assert len(jobs) == 2
+    assert jobs[0]["config"] == manifest_path.parent / config_paths[0]
+    assert jobs[0]["output"] == manifest_path.parent / "outputs" / "a"
+    assert [job["format"] for job in jobs] == ["geoparquet", "geoparquet"]
+    assert [job["crs"] for job in jobs] == [["epsg:27700"], ["epsg:27700"]]
+    assert [job["single_use"] for job in jobs] == [False, True]
+    assert jobs[0]["batch_size"] == runner.JOB_DEFAULTS["batch_size"]
+
+
+@pytest.mark.parametrize(
+    "job,error",
+    [
+        ({"config": "a.json", "input": "a.osm"}, "missing paths: \\['output'\\]"),
+        (
+            {"config": "a.json", "input": "a.osm", "output": "a", "colour": "red"},
+            "unknown options: \\['colour'\\]",
+        ),
+        (
+            {
+                "config": "a.json",
+                "input": "a.osm",
+                "output": "a",
+                "partition_by": ["activity"],
+            },
+            "requires 'geoparquet' format",
+        ),
+    ],
+)
+def test_load_manifest_invalid_job(tmp_path, job, error):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps({"jobs": [job]}))
+    with pytest.raises(ValueError, match=error):
+        runner.load_manifest(path)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_run_batch_matches_standalone_runs(manifest_path, processes):
+    jobs = runner.load_manifest(manifest_path)
+    paths = runner.run_batch(jobs, processes=processes)
+
+    for job, job_paths in zip(jobs, paths, strict=True):
+        handler = build.ObjectHandler(config.load(job["config"]), crs="epsg:27700")
+        runner.parse_input(handler, job["input"])
+        expected_paths = runner.process(
+            handler,
+            str(job["output"]) + "_standalone",
+            format="geoparquet",
+            single_use=job["single_use"],
+        )
+        assert len(job_paths) == len(expected_paths) == 2
+        for path, expected_path in zip(job_paths, expected_paths, strict=True):
+            assert read_output(path).equals(read_output(expected_path))
+
+
+def test_run_batch_parses_shared_input_once(mocker, manifest_path):
+    jobs = runner.load_manifest(manifest_path)
+    parse_input = mocker.spy(runner, "parse_input")
+    runner.run_batch(jobs)
+    assert parse_input.call_count == 1
+
+
+def test_run_batch_parses_input_per_batch_size(mocker, manifest_path):
+    jobs = runner.load_manifest(manifest_path)
+    jobs[1]["batch_size"] = 2
+    parse_input = mocker.spy(runner, "parse_input")
+    runner.run_batch(jobs)
+    # the input is parsed with each job's own batch size, as in standalone runs
+    assert [call.kwargs["batch_size"] for call in parse_input.call_args_list] == [
+        jobs[0]["batch_size"],
+        2,
+    ]
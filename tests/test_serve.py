@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+import urllib.request
+
+import numpy as np
+import pytest
+import shapely
+from osmox import build, config, facilities, serve
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+config_path = os.path.join(fixtures_root, "test_config.json")
+
+
+@pytest.fixture(scope="module")
+def handler():
+    handler = build.ObjectHandler(config.load(config_path), crs="epsg:27700")
+    handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handler.assign_tags()
+    handler.assign_activities()
+    handler.add_features()
+    return handler
+
+
+@pytest.fixture()
+def index(handler, tmp_path):
+    facilities.write_facility_index(handler, tmp_path / "toy.index")
+    with serve.open_facilities(tmp_path / "toy.index") as index:
+        yield index
+
+
+def run_server(index, client, **kwargs):
+    """Start a server on a free local port, and run an async client function with its URL."""
+
+    async def _run():
+        server = serve.FacilityServer(index, **kwargs)
+        started = await server.start(port=0)
+        try:
+            return await client(
+                server, f"http://127.0.0.1:{started.sockets[0].getsockname()[1]}"
+            )
+        finally:
+            await server.stop(started)
+
+    return asyncio.run(_run())
+
+
+async def request(reader, writer, method, path, payload=None):
+    """Send an HTTP/1.1 request on a kept-alive connection, and read the status and JSON payload of the response."""
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+        + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()).strip():
+        name, _, value = line.decode().partition(":")
+        headers[name.lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+def test_open_facilities(handler, tmp_path):
+    path = tmp_path / "toy.gpkg"
+    handler.geodataframe().to_file(path)
+    with serve.open_facilities(path) as index:
+        assert index.path == path
+        assert len(index) == len(handler.objects)
+
+
+def test_run_batch(handler, index):
+    expected = handler.geodataframe()
+    x, y = expected.total_bounds[:2]
+    distances = expected.geometry.distance(shapely.Point(x, y))
+    server = serve.FacilityServer(index)
+    results = server.run_batch(
+        [
+            {
+                "type": "bbox",
+                "bbox": list(expected.total_bounds),
+                "columns": ["id", "x", "y"],
+            },
+            {"type": "nearest", "point": [x, y], "k": 2, "activities": ["work"]},
+            {"type": "within", "point": [x, y], "distance": 1e6, "columns": ["id"]},
+            {
+                "type": "sample",
+                "point": [x, y],
+                "distance": 1e6,
+                "n": 3,
+                "weight": "floor_area",
+            },
+            {"type": "unknown"},
+            {"type": "within", "point": [x, y]},
+        ]
+    )
+    assert results[0] == [
+        {"id": i, "x": p.x, "y": p.y}
+        for i, p in zip(expected["id"], expected.geometry, strict=True)
+    ]
+    work = expected.activities.str.contains("work").to_numpy()
+    assert [r["id"] for r in results[1]] == expected["id"][work][
+        np.argsort(distances[work])[:2]
+    ].tolist()
+    assert [r["distance"] for r in results[1]] == pytest.approx(
+        sorted(distances[work])[:2]
+    )
+    assert results[2] == [{"id": i} for i in expected["id"]]
+    assert len(results[3]) == 3
+    assert all(r["floor_area"] > 0 for r in results[3])
+    assert "Unknown query type" in results[4]["error"]
+    assert results[5] == {"error": "Missing query argument: 'distance'"}
+
+
+def test_serve_queries(index):
+    x, y = index.nearest(0, 0)["geometry"].to_pylist()[0].values()
+    queries = [
+        {"type": "nearest", "point": [x, y], "k": 3},
+        {"type": "sample", "point": [x, y], "distance": 1e6, "n": 2, "seed": 1},
+        {"type": "sample", "point": [x, y], "distance": 1e6, "n": 2},
+    ]
+
+    async def client(server, url):
+        # queries of concurrent connections are run together, and identical queries only once
+        connections = [
+            await asyncio.open_connection(*url[7:].split(":")) for _ in range(5)
+        ]
+        responses = await asyncio.gather(
+            *(
+                request(r, w, "POST", "/query", {"queries": queries})
+                for r, w in connections
+            )
+        )
+        # connections are kept alive, and repeated queries are cached
+        again = await request(*connections[0], "POST", "/query", {"queries": queries})
+        health = await request(*connections[0], "GET", "/health")
+        for _, writer in connections:
+            writer.close()
+        return responses, again, health, server.stats
+
+    responses, again, health, stats = run_server(index, client)
+    for status, payload in [*responses, again]:
+        assert status == 200
+        assert payload["results"][:2] == responses[0][1]["results"][:2]
+        assert len(payload["results"][2]) == 2
+    assert responses[0][1]["results"][0][0]["distance"] == 0
+    assert health == (
+        200,
+        {
+            "facilities": len(index),
+            "crs": "EPSG:27700",
+            "requests": 7,
+            "queries": 18,
+            "cache_hits": 10,
+            "batches": stats["batches"],
+        },
+    )
+    assert stats["batches"] < 6
+
+
+def test_serve_errors(index):
+    async def client(server, url):
+        reader, writer = await asyncio.open_connection(*url[7:].split(":"))
+        responses = [
+            await request(reader, writer, "GET", "/query"),
+            await request(reader, writer, "POST", "/unknown"),
+            await request(reader, writer, "POST", "/query", {"type": "bbox"}),
+            await request(
+                reader, writer, "POST", "/query", {"queries": [{"type": "bbox"}]}
+            ),
+        ]
+        writer.write(b"nonsense\r\n\r\n")
+        responses.append(await request(reader, writer, "GET", "/health"))
+        writer.close()
+        return responses
+
+    statuses, payloads = zip(*run_server(index, client), strict=True)
+    assert statuses == (405, 404, 400, 200, 400)
+    assert payloads[3] == {"results": [{"error": "Missing query argument: 'bbox'"}]}
+    assert "Malformed request" in payloads[4]["error"]
+
+
+def test_serve_http_client(index):
+    query = {
+        "queries": [{"type": "nearest", "point": [0, 0], "k": 1, "columns": ["id"]}]
+    }
+
+    def post(url):
+        request = urllib.request.Request(
+            url + "/query",
+            data=json.dumps(query).encode(),
+            headers={"Connection": "close"},
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+
+    async def client(server, url):
+        return await asyncio.to_thread(post, url)
+
+    expected = index.nearest(0, 0)["id"].to_pylist()
+    assert run_server(index, client) == {"results": [[{"id": expected[0]}]]}
+
+
+def test_serve_unix_socket(index, tmp_path):
+    async def _run():
+        server = serve.FacilityServer(index, cache_size=0)
+        started = await server.start(unix_socket=tmp_path / "osmox.sock")
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                str(tmp_path / "osmox.sock")
+            )
+            response = await request(reader, writer, "GET", "/health")
+            writer.close()
+            return response
+        finally:
+            await server.stop(started)
+
+    status, payload = asyncio.run(_run())
+    assert status == 200
+    assert payload["facilities"] == len(index)
@@ -0,0 +1,197 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+from osmox import build, config, runner, spill, tiling
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+config_path = os.path.join(fixtures_root, "test_config_infill.json")
+
+
+def read_output(path):
+    table = pq.read_table(path).to_pandas()
+    table["activities"] = table["activities"].map(lambda acts: sorted(acts.split(",")))
+    # chunked outputs are in chunk order, not parse order
+    return table.sort_values(["id", "geometry"]).reset_index(drop=True)
+
+
+def parsed(path):
+    handler = build.ObjectHandler(config.load(config_path), crs="epsg:27700")
+    runner.parse_input(handler, path)
+    return handler
+
+
+def test_spilled_input_parses_as_original(tmp_path):
+    count, bounds, elements = spill.spill_input(
+        config.load(config_path), toy_osm_path, tmp_path / "spill.parquet"
+    )
+    # spilled geoparquet can itself be spilled again
+    count_again, bounds_again, elements_again = spill.spill_input(
+        config.load(config_path), tmp_path / "spill.parquet", tmp_path / "again.parquet"
+    )
+    assert count == count_again == pq.read_metadata(tmp_path / "spill.parquet").num_rows
+    assert elements is elements_again is None
+    assert bounds == pytest.approx(bounds_again)
+
+    expected = parsed(toy_osm_path)
+    for path in ["spill.parquet", "again.parquet"]:
+        handler = parsed(tmp_path / path)
+        for name in ["objects", "points", "areas"]:
+            assert [o.idx for o in getattr(handler, name)] == [
+                o.idx for o in getattr(expected, name)
+            ]
+    assert count == len(expected.objects) + len(expected.points) + len(expected.areas)
+    minx, miny, maxx, maxy = bounds
+    assert not (tmp_path / "spill.locations").exists()
+    assert minx < maxx and miny < maxy
+
+
+def test_chunk_size():
+    counts = np.zeros((spill.GRID_CELLS, spill.GRID_CELLS), dtype=int)
+    counts[:, :] = 1
+    bounds = (0, 0, 1, 1)
+    assert spill.chunk_size(counts, bounds, halo=0, max_entities=counts.sum()) == 1
+    assert (
+        spill.chunk_size(counts, bounds, halo=0, max_entities=counts.sum() // 4) == 0.5
+    )
+    assert (
+        spill.chunk_size(counts, bounds, halo=0, max_entities=counts.sum() // 5) == 0.25
+    )
+
+
+def test_chunk_size_stops_when_halos_dominate():
+    counts = np.zeros((spill.GRID_CELLS, spill.GRID_CELLS), dtype=int)
+    counts[0, 0] = 10
+    # every tile's halo covers the whole grid, so smaller tiles would not be any smaller
+    assert (
+        spill.chunk_size(counts, (0, 0, 0.001, 0.001), halo=1000, max_entities=5)
+        == 0.001
+    )
+
+
+def test_run_out_of_core_matches_standalone_run(mocker, tmp_path):
+    # as if each element used a lot of memory, to split the toy input into chunks
+    mocker.patch.object(spill, "BYTES_PER_ENTITY", 2**30)
+    run_tiles = mocker.spy(tiling, "run_tiles")
+    paths = spill.run_out_of_core(
+        config_path,
+        toy_osm_path,
+        str(tmp_path / "chunked"),
+        memory_limit=1e4,
+        halo=1,
+        format="geoparquet",
+    )
+    assert len(run_tiles.call_args.args[0]["tiles"]) > 1
+    assert sorted(os.listdir(tmp_path)) == [
+        "chunked_epsg_27700.parquet",
+        "chunked_epsg_4326.parquet",
+    ]
+
+    handler = parsed(toy_osm_path)
+    expected_paths = runner.process(
+        handler, str(tmp_path / "standalone"), format="geoparquet"
+    )
+    for path, expected_path in zip(paths, expected_paths, strict=True):
+        assert (
+            read_output(path)
+            .drop(columns="geometry")
+            .equals(read_output(expected_path).drop(columns="geometry"))
+        )
+
+
+def test_run_out_of_core_runs_in_memory_if_input_fits(mocker, tmp_path):
+    run_tiles = mocker.spy(tiling, "run_tiles")
+    paths = spill.run_out_of_core(
+        config_path,
+        toy_osm_path,
+        str(tmp_path / "limited"),
+        memory_limit=1e5,
+        format="geoparquet",
+    )
+    run_tiles.assert_not_called()
+    # nothing was spilled to the temporary directory either
+    assert sorted(os.listdir(tmp_path)) == [
+        "limited_epsg_27700.parquet",
+        "limited_epsg_4326.parquet",
+    ]
+
+    expected_paths = runner.process(
+        parsed(toy_osm_path), str(tmp_path / "standalone"), format="geoparquet"
+    )
+    for path, expected_path in zip(paths, expected_paths, strict=True):
+        assert read_output(path).equals(read_output(expected_path))
+
+
+def test_run_out_of_core_runs_in_memory_if_input_cannot_be_chunked(mocker, tmp_path):
+    mocker.patch.object(spill, "BYTES_PER_ENTITY", 2**30)
+    run_tiles = mocker.spy(tiling, "run_tiles")
+    spill_input = mocker.spy(spill, "spill_input")
+    # the toy input is much smaller than the default halo
+    paths = spill.run_out_of_core(
+        config_path,
+        toy_osm_path,
+        str(tmp_path / "limited"),
+        memory_limit=1e4,
+        format="geoparquet",
+    )
+    assert spill_input.spy_return[2] is None
+    run_tiles.assert_not_called()
+
+    expected_paths = runner.process(
+        parsed(toy_osm_path), str(tmp_path / "standalone"), format="geoparquet"
+    )
+    for path, expected_path in zip(paths, expected_paths, strict=True):
+        assert read_output(path).equals(read_output(expected_path))
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="peak memory use is only measured on Linux",
+)
+@pytest.mark.parametrize("chunked", [True, False])
+def test_run_out_of_core_stays_within_memory_limit(tmp_path, chunked):
+    # run in a new process, so that its peak memory use is only that of the run
+    code = f"""
+        import json
+        from osmox import profiling, spill, tiling
+
+        chunks = []
+        run_tiles = tiling.run_tiles
+        def count_chunks(plan):
+            chunks.append(len(plan["tiles"]))
+            return run_tiles(plan)
+        tiling.run_tiles = count_chunks
+        if {chunked}:
+            # as if each element used a lot of memory, to split the toy input into chunks
+            spill.BYTES_PER_ENTITY = 2**21
+        memory_limit = profiling.rss_mb() + spill.OSM_READ_MB + 8
+        spill.run_out_of_core(
+            {config_path!r}, {toy_osm_path!r}, {str(tmp_path / "limited")!r}, memory_limit, halo=1, format="geoparquet"
+        )
+        # unlike the peak RSS from getrusage, this does not count the memory of the forked parent before exec
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmHWM:"))
+        print(json.dumps({{"memory_limit": memory_limit, "peak": peak, "chunks": chunks}}))
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", textwrap.dedent(code)],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    result = json.loads(result.stdout)
+    assert (result["chunks"][0] > 1) if chunked else (result["chunks"] == [])
+    assert result["peak"] < result["memory_limit"]
+
+
+def test_run_out_of_core_requires_memory_left(tmp_path):
+    with pytest.raises(ValueError, match="is below current memory use"):
+        spill.run_out_of_core(
+            config_path, toy_osm_path, str(tmp_path / "out"), memory_limit=1
+        )
@@ -0,0 +1,222 @@
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from osmox import build, config, runner, tiling
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+config_path = os.path.join(fixtures_root, "test_config_infill.json")
+
+
+def read_output(path):
+    table = pq.read_table(path).to_pandas()
+    table["activities"] = table["activities"].map(lambda acts: sorted(acts.split(",")))
+    # tiled outputs are in tile order, not parse order
+    return table.sort_values("id").reset_index(drop=True)
+
+
+def test_input_bounds_of_osm_file_from_header():
+    assert tiling.input_bounds(toy_osm_path) == (-0.1402, 51.52326, -0.13728, 51.5245)
+
+
+def test_input_bounds_of_osm_file_from_nodes(tmp_path):
+    path = tmp_path / "toy.osm"
+    with open(toy_osm_path) as f:
+        path.write_text("".join(line for line in f if "<bounds" not in line))
+    handler = build.ObjectHandler(config.load(config_path), crs="epsg:4326")
+    handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    minx, miny, maxx, maxy = tiling.input_bounds(path)
+    for obj in handler.objects:
+        x0, y0, x1, y1 = obj.geom.bounds
+        assert minx <= x0 and miny <= y0 and x1 <= maxx and y1 <= maxy
+
+
+def test_tile_grid():
+    tiles = tiling.tile_grid((0, 50, 2.5, 51), tile_size=1, halo=1000)
+    assert [tile.name for tile in tiles] == ["0_0", "1_0", "2_0"]
+    assert tiles[2].core == (2, 50, 3, 51)
+    for tile in tiles:
+        assert tile.halo[1] == pytest.approx(50 - 1000 / tiling.METRES_PER_DEGREE)
+        # a degree of longitude is shorter than a degree of latitude, so the halo is wider in degrees
+        assert tile.core[0] - tile.halo[0] > tile.core[1] - tile.halo[1]
+
+
+def test_parse_bbox_of_edge_tiles_extends_beyond_grid(tmp_path):
+    plan = tiling.plan_tiles(
+        config_path, toy_osm_path, tmp_path / "out", bounds=(0, 50, 2.5, 53), halo=0
+    )
+    tiles = tiling.tiles(plan)
+    assert tiling.parse_bbox(plan, tiles["0_0"]) == (-180, -90, 1, 51)
+    assert tiling.parse_bbox(plan, tiles["1_1"]) == (1, 51, 2, 52)
+    assert tiling.parse_bbox(plan, tiles["2_2"]) == (2, 52, 180, 90)
+
+
+def test_plan_tiles_rejects_unknown_options(tmp_path):
+    with pytest.raises(ValueError, match="Unknown options: \\['colour'\\]"):
+        tiling.plan_tiles(config_path, toy_osm_path, tmp_path / "out", colour="red")
+
+
+@pytest.fixture(params=[1, 2])
+def tiled_outputs(request, tmp_path):
+    """Outputs of a tiled run over a grid of 3 x 2 tiles, with a halo narrower than the distances between objects."""
+    minx, _, maxx, _ = tiling.input_bounds(toy_osm_path)
+    plan = tiling.plan_tiles(
+        config_path,
+        toy_osm_path,
+        tmp_path / "tiled",
+        tile_size=(maxx - minx) / 2.5,
+        halo=1,
+        format="geoparquet",
+    )
+    assert len(plan["tiles"]) == 6
+    tiling.write_plan(plan)
+    tile_paths = tiling.run_tiles(plan, processes=request.param)
+    assert sum(pq.read_metadata(path).num_rows for path in tile_paths) > 0
+    return tiling.merge_tiles(plan)
+
+
+def test_tiled_run_matches_standalone_run(tiled_outputs, tmp_path):
+    handler = build.ObjectHandler(config.load(config_path), crs="epsg:27700")
+    runner.parse_input(handler, toy_osm_path)
+    expected_paths = runner.process(
+        handler, str(tmp_path / "standalone"), format="geoparquet"
+    )
+    assert len(tiled_outputs) == len(expected_paths) == 2
+    for path, expected_path in zip(tiled_outputs, expected_paths, strict=True):
+        result, expected = read_output(path), read_output(expected_path)
+        assert result.drop(columns="geometry").equals(expected.drop(columns="geometry"))
+
+
+def test_merge_tiles_requires_all_tiles(tmp_path):
+    plan = tiling.plan_tiles(
+        config_path, toy_osm_path, tmp_path / "tiled", tile_size=0.001
+    )
+    tiling.run_tiles(plan, names=[plan["tiles"][0]["name"]])
+    with pytest.raises(FileNotFoundError, match="Tiles have not been run"):
+        tiling.merge_tiles(plan)
+
+
+@pytest.fixture
+def fill_area_input(tmp_path):
+    """A residential area across the edge of two tiles, with one building in the southern tile,
+    and a config which fills areas missing homes and then areas missing shops, on a different grid.
+    """
+    nodes = [
+        (0.0, 51.0),
+        (0.002, 51.0),
+        (0.002, 51.004),
+        (0.0, 51.004),
+        (0.0003, 51.0003),
+        (0.0005, 51.0003),
+        (0.0005, 51.0005),
+        (0.0003, 51.0005),
+    ]
+    ways = [
+        (1, [1, 2, 3, 4, 1], ("landuse", "residential")),
+        (2, [5, 6, 7, 8, 5], ("building", "residential")),
+    ]
+    lines = [
+        "<?xml version='1.0' encoding='UTF-8'?>",
+        "<osm version='0.6'>",
+        "<bounds minlat='51.0' minlon='0.0' maxlat='51.004' maxlon='0.002' />",
+        *(
+            f"<node id='{n}' version='1' lat='{lat}' lon='{lon}' />"
+            for n, (lon, lat) in enumerate(nodes, start=1)
+        ),
+    ]
+    for way, refs, (key, value) in ways:
+        lines.append(f"<way id='{way}' version='1'>")
+        lines.extend(f"<nd ref='{ref}' />" for ref in refs)
+        lines.extend([f"<tag k='{key}' v='{value}' />", "</way>"])
+    lines.append("</osm>")
+    osm_path = tmp_path / "fill.osm"
+    osm_path.write_text("\n".join(lines))
+
+    cnfg = config.load(config_path)
+    homes = cnfg["fill_missing_activities"][0]
+    shops = {
+        **homes,
+        "required_acts": ["shop"],
+        "new_tags": [["building", "retail"]],
+        "spacing": [30, 30],
+    }
+    cnfg["fill_missing_activities"] = [homes, shops]
+    fill_config_path = tmp_path / "fill_config.json"
+    fill_config_path.write_text(json.dumps(cnfg))
+    return fill_config_path, osm_path
+
+
+def run_fill_area_tiles(fill_area_input, tmp_path, halo):
+    fill_config_path, osm_path = fill_area_input
+    plan = tiling.plan_tiles(
+        fill_config_path,
+        osm_path,
+        tmp_path / "tiled",
+        tile_size=0.0025,
+        halo=halo,
+        format="geoparquet",
+    )
+    assert [tile["name"] for tile in plan["tiles"]] == ["0_0", "0_1"]
+    tiling.run_tiles(plan)
+    return tiling.merge_tiles(plan)
+
+
+def test_merge_tiles_fill_area_across_tile_edge(fill_area_input, tmp_path):
+    tiled_outputs = run_fill_area_tiles(fill_area_input, tmp_path, halo=1000)
+    fill_config_path, osm_path = fill_area_input
+    handler = build.ObjectHandler(config.load(fill_config_path), crs="epsg:27700")
+    runner.parse_input(handler, osm_path)
+    expected_paths = runner.process(
+        handler, str(tmp_path / "standalone"), format="geoparquet"
+    )
+    for path, expected_path in zip(tiled_outputs, expected_paths, strict=True):
+        result, expected = read_output(path), read_output(expected_path)
+        assert result["id"].str.startswith("fill_2_").sum() > 1
+        assert result.drop(columns="geometry").equals(expected.drop(columns="geometry"))
+
+
+def test_merge_tiles_renumbers_colliding_fill_ids(fill_area_input, tmp_path):
+    # with a narrow halo, only the southern tile sees the building and so does not fill the area with homes,
+    # so the tiles create different fill objects with the same IDs
+    tiled_outputs = run_fill_area_tiles(fill_area_input, tmp_path, halo=1)
+    tile_fill_numbers = [
+        int(idx.split("_")[-1])
+        for name in ["0_0", "0_1"]
+        for idx in pq.read_table(tmp_path / "tiled_tiles" / f"{name}.parquet")
+        .column("id")
+        .to_pylist()
+        if idx.startswith("fill_")
+    ]
+    for path in tiled_outputs:
+        result = read_output(path)
+        assert result["id"].is_unique
+        assert (result["id"] == "4").sum() == 1
+        assert set(result["activities"].str[0]) == {"home", "shop"}
+        numbers = result["id"].str.extract(r"^fill_2_(\d+)$")[0].dropna().astype(int)
+        renumbered = sorted(numbers[numbers > max(tile_fill_numbers)])
+        assert renumbered == list(
+            range(
+                max(tile_fill_numbers) + 1, max(tile_fill_numbers) + 1 + len(renumbered)
+            )
+        )
+        assert renumbered
+
+
+def test_unique_ids():
+    tile_ids = [
+        pa.chunked_array([["1", "1", "fill_2_0"]]),
+        pa.chunked_array([["1", "fill_2_0", "fill_2_3"], ["5"]]),
+    ]
+    keep, renamed = tiling._unique_ids(tile_ids)
+    # OSM objects which share an ID in one tile are kept, and dropped from later tiles
+    assert keep.tolist() == [True, True, True, False, True, True, True]
+    assert renamed == {4: "fill_2_4"}
+
+
+def test_unique_ids_without_objects():
+    keep, renamed = tiling._unique_ids([pa.chunked_array([], pa.string())])
+    assert keep.tolist() == []
+    assert renamed == {}
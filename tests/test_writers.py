@@ -0,0 +1,421 @@
+import json
+import os
+import sqlite3
+
+import geopandas as gpd
+import numpy as np
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from geopandas.testing import assert_geodataframe_equal
+from osmox import build, config, writers
+from shapely.geometry import Polygon
+
+fixtures_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "fixtures"))
+toy_osm_path = os.path.join(fixtures_root, "toy.osm")
+test_config_path = os.path.join(fixtures_root, "test_config.json")
+
+
+@pytest.fixture(scope="module")
+def handler():
+    cnfg = config.load(test_config_path)
+    handler = build.ObjectHandler(cnfg, crs="epsg:27700")
+    handler.apply_file(toy_osm_path, locations=True, idx="flex_mem")
+    handler.assign_tags()
+    handler.assign_activities()
+    handler.add_features()
+    handler.assign_nearest_distance("transit")
+    return handler
+
+
+@pytest.mark.parametrize("single_use", [True, False])
+@pytest.mark.parametrize("row_group_size", [1, 2, 100])
+def test_write_geoparquet_matches_geodataframe(
+    handler, tmp_path, single_use, row_group_size
+):
+    path = tmp_path / "out.parquet"
+    writers.write_geoparquet(
+        handler, path, single_use=single_use, row_group_size=row_group_size
+    )
+    expected = handler.geodataframe(single_use=single_use)
+    assert_geodataframe_equal(gpd.read_parquet(path), expected, check_dtype=False)
+
+
+def test_write_geoparquet_row_groups(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    writers.write_geoparquet(handler, path, row_group_size=2, compression="zstd")
+    metadata = pq.ParquetFile(path).metadata
+    assert metadata.num_row_groups == 3
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+
+
+def test_write_geoparquet_reprojected(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    writers.write_geoparquet(handler, path, crs="epsg:4326")
+    expected = handler.geodataframe().to_crs("epsg:4326")
+    assert_geodataframe_equal(
+        gpd.read_parquet(path), expected, check_dtype=False, check_less_precise=True
+    )
+
+
+def test_write_geoparquet_bbox_covering(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    writers.write_geoparquet(handler, path, bbox_covering=True)
+    schema = pq.read_schema(path)
+    geo = json.loads(schema.metadata[b"geo"])
+    assert geo["version"] == "1.1.0"
+    assert geo["columns"]["geometry"]["covering"]["bbox"]["xmin"] == ["bbox", "xmin"]
+
+    gdf = gpd.read_parquet(path)
+    assert (gdf["bbox"].str["xmin"] == gdf.geometry.x).all()
+    assert (gdf["bbox"].str["ymax"] == gdf.geometry.y).all()
+
+
+def test_feature_schema_promotes_types(tmp_path):
+    handler = build.ObjectHandler(config.load(test_config_path), crs="epsg:27700")
+    for i, value in enumerate([1, None, 2.5]):
+        handler.add_object(
+            idx=i,
+            activity_tags=[],
+            osm_tags=[],
+            geom=Polygon([(0, 0), (0, 1), (1, 1), (1, 0)]),
+        )
+        handler.objects.objects[-1].activities = ["a"]
+        handler.objects.objects[-1].features = {"feature": value}
+    schema = writers.feature_schema(handler, 1)
+    assert str(schema.field("feature").type) == "double"
+
+
+@pytest.mark.parametrize("n_points", [0, 1, 3])
+def test_reproject(n_points):
+    geoms = gpd.points_from_xy(range(n_points), range(n_points), crs="epsg:27700")
+    reprojected = writers.reproject(
+        geoms.to_numpy(), from_crs="epsg:27700", to_crs="epsg:4326"
+    )
+    expected = gpd.GeoSeries(geoms).to_crs("epsg:4326")
+    assert len(reprojected) == n_points
+    assert (
+        gpd.GeoSeries(reprojected, crs="epsg:4326")
+        .geom_equals_exact(expected, 1e-9)
+        .all()
+    )
+
+
+def test_reproject_geodataframe_shares_attributes(handler):
+    gdf = handler.geodataframe()
+    original_geometry = gdf.geometry.copy()
+    reprojected = writers.reproject_geodataframe(gdf, "epsg:4326")
+    assert reprojected.crs == "epsg:4326"
+    assert gdf.crs == "epsg:27700"
+    assert gdf.geometry.geom_equals(original_geometry).all()
+    assert reprojected.geom_equals_exact(gdf.to_crs("epsg:4326"), 1e-9).all()
+    assert (reprojected["id"] == gdf["id"]).all()
+
+
+@pytest.mark.parametrize(
+    ["crs", "expected"],
+    [
+        ("epsg:27700", ["epsg:27700", "epsg:4326"]),
+        ("epsg:4326", ["epsg:4326"]),
+        (["EPSG:4326", "epsg:3857"], ["EPSG:4326", "epsg:3857"]),
+        (
+            ["epsg:27700", "epsg:3857", "epsg:27700"],
+            ["epsg:27700", "epsg:3857", "epsg:4326"],
+        ),
+    ],
+)
+def test_output_crs(crs, expected):
+    assert writers.output_crs(crs) == expected
+
+
+def test_write_outputs(handler, tmp_path):
+    paths = writers.write_outputs(
+        handler,
+        str(tmp_path / "out"),
+        format="geojson",
+        crs=["epsg:27700", "epsg:3857"],
+    )
+    assert paths == [
+        str(tmp_path / f"out_{crs}.geojson")
+        for crs in ["epsg_27700", "epsg_3857", "epsg_4326"]
+    ]
+    for path in paths:
+        assert len(gpd.read_file(path)) == len(handler.objects)
+
+
+@pytest.mark.parametrize(
+    ["format", "engine"],
+    [("geoparquet", "auto"), ("geopackage", "auto"), ("geopackage", "fiona")],
+)
+@pytest.mark.parametrize("single_use", [True, False])
+@pytest.mark.parametrize("dataset", [True, False])
+def test_write_outputs_object_table(
+    handler, tmp_path, format, engine, single_use, dataset
+):
+    data = handler.to_arrow()
+    if dataset:
+        pq.write_table(data, tmp_path / "objects.parquet")
+        data = ds.dataset(tmp_path / "objects.parquet")
+    objects = writers.ObjectTable(data, crs=handler.crs)
+    assert len(objects) == len(handler.objects)
+    kwargs = {
+        "format": format,
+        "engine": engine,
+        "single_use": single_use,
+        "batch_size": 2,
+    }
+    paths = writers.write_outputs(objects, str(tmp_path / "table"), **kwargs)
+    expected_paths = writers.write_outputs(handler, str(tmp_path / "handler"), **kwargs)
+    read = gpd.read_parquet if format == "geoparquet" else gpd.read_file
+    for path, expected_path in zip(paths, expected_paths, strict=True):
+        assert_geodataframe_equal(read(path), read(expected_path))
+
+
+@pytest.mark.parametrize(
+    ["format", "extension"],
+    [("geojson", "geojson"), ("geopackage", "gpkg"), ("flatgeobuf", "fgb")],
+)
+@pytest.mark.parametrize("single_use", [True, False])
+def test_write_ogr_matches_geodataframe(
+    handler, tmp_path, format, extension, single_use
+):
+    path = tmp_path / f"out.{extension}"
+    writers.write_ogr(handler, path, format=format, single_use=single_use, batch_size=2)
+    expected = handler.geodataframe(single_use=single_use)
+    # all-null features are written as strings, as GeoPandas would
+    expected["distance_to_nearest_transit"] = expected[
+        "distance_to_nearest_transit"
+    ].astype(object)
+    # flatgeobuf spatial index reorders features
+    sort_by = ["id", "activity" if single_use else "activities"]
+    assert_geodataframe_equal(
+        gpd.read_file(path).sort_values(sort_by).reset_index(drop=True),
+        expected.sort_values(sort_by).reset_index(drop=True),
+        check_dtype=False,
+        check_like=True,
+    )
+
+
+@pytest.mark.parametrize("spatial_index", [True, False])
+def test_write_ogr_spatial_index(handler, tmp_path, spatial_index):
+    path = tmp_path / "out.gpkg"
+    writers.write_ogr(handler, path, format="geopackage", spatial_index=spatial_index)
+    with sqlite3.connect(path) as con:
+        tables = {
+            row[0]
+            for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        }
+    assert any(table.startswith("rtree_") for table in tables) is spatial_index
+
+
+@pytest.mark.parametrize("engine", ["auto", "pyogrio", "fiona"])
+def test_write_outputs_engines(handler, tmp_path, engine):
+    paths = writers.write_outputs(
+        handler, str(tmp_path / "out"), format="flatgeobuf", engine=engine
+    )
+    for path in paths:
+        assert len(gpd.read_file(path)) == len(handler.objects)
+
+
+@pytest.mark.parametrize(
+    ["format", "partition_by"],
+    [("geoparquet", None), ("geoparquet", ["activity"]), ("geopackage", None)],
+)
+def test_write_outputs_infers_feature_schema_once(
+    handler, tmp_path, mocker, format, partition_by
+):
+    feature_schema = mocker.spy(writers, "feature_schema")
+    paths = writers.write_outputs(
+        handler,
+        str(tmp_path / "out"),
+        format=format,
+        crs=["epsg:27700", "epsg:3857"],
+        partition_by=partition_by,
+        facility_index=True,
+    )
+    assert len(paths) == 3
+    assert len(list(tmp_path.glob("*.index"))) == 3
+    feature_schema.assert_called_once()
+
+
+@pytest.mark.parametrize("engine", ["auto", "fiona"])
+def test_write_outputs_falls_back_without_pyogrio(handler, tmp_path, mocker, engine):
+    mocker.patch.object(writers, "pyogrio", None)
+    write_ogr = mocker.spy(writers, "write_ogr")
+    to_file = mocker.spy(gpd.GeoDataFrame, "to_file")
+    paths = writers.write_outputs(
+        handler, str(tmp_path / "out"), format="geopackage", engine=engine
+    )
+    write_ogr.assert_not_called()
+    # fiona is only asked for explicitly, otherwise GeoPandas picks its default engine
+    assert [call.kwargs.get("engine") for call in to_file.call_args_list] == [
+        None if engine == "auto" else "fiona"
+    ] * len(paths)
+    for path in paths:
+        assert len(gpd.read_file(path)) == len(handler.objects)
+
+
+def test_write_outputs_pyogrio_not_available(handler, tmp_path, mocker):
+    mocker.patch.object(writers, "pyogrio", None)
+    with pytest.raises(ImportError, match="pyogrio engine requires"):
+        writers.write_outputs(handler, str(tmp_path / "out"), engine="pyogrio")
+
+
+@pytest.mark.parametrize(
+    ["lon", "lat", "zoom", "expected"],
+    [
+        (-0.1278, 51.5074, 3, "031"),
+        (0.1, 0.1, 1, "1"),
+        (-0.1, -0.1, 1, "2"),
+        (-180, 90, 2, "00"),
+        (180, -90, 2, "33"),
+    ],
+)
+def test_quadkeys(lon, lat, zoom, expected):
+    assert writers.quadkeys(np.array([lon]), np.array([lat]), zoom).tolist() == [
+        expected
+    ]
+
+
+def test_quadkeys_empty():
+    assert len(writers.quadkeys(np.array([]), np.array([]), 10)) == 0
+
+
+@pytest.mark.parametrize("single_use", [True, False])
+@pytest.mark.parametrize(
+    "partition_by",
+    [["activity"], ["quadkey"], ["activity", "quadkey"], ["quadkey", "activity"]],
+)
+def test_write_partitioned_geoparquet(handler, tmp_path, single_use, partition_by):
+    path = tmp_path / "out.parquet"
+    writers.write_partitioned_geoparquet(
+        handler, path, single_use=single_use, partition_by=partition_by, quadkey_zoom=16
+    )
+    partitions = [p.relative_to(path).parts[:-1] for p in path.rglob("*.parquet")]
+    assert all(
+        [part.split("=")[0] for part in parts] == partition_by for parts in partitions
+    )
+
+    gdf = gpd.read_parquet(path)
+    for key in partition_by:
+        gdf[key] = gdf[key].astype(str)
+    sort_by = ["id", "activity" if single_use else "activities"]
+    if "activity" in partition_by and not single_use:
+        # multi-use objects are written to each of their activity partitions
+        assert (
+            gdf.groupby("id").size()
+            == gdf.groupby("id").activities.first().str.count(",") + 1
+        ).all()
+        assert all(
+            act in acts.split(",")
+            for act, acts in zip(gdf.activity, gdf.activities, strict=True)
+        )
+        gdf = gdf.drop_duplicates("id").drop(columns="activity")
+    expected = handler.geodataframe(single_use=single_use)
+    if "quadkey" in partition_by:
+        lonlat = expected.geometry.to_crs("epsg:4326")
+        assert (
+            gdf.sort_values(sort_by).quadkey.values
+            == writers.quadkeys(lonlat.x.values, lonlat.y.values, 16)[
+                expected.sort_values(sort_by).index
+            ]
+        ).all()
+        gdf = gdf.drop(columns="quadkey")
+    assert_geodataframe_equal(
+        gdf.sort_values(sort_by).reset_index(drop=True),
+        expected.sort_values(sort_by).reset_index(drop=True),
+        check_dtype=False,
+        check_like=True,
+    )
+
+
+def test_write_partitioned_geoparquet_filters(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    writers.write_partitioned_geoparquet(
+        handler, path, single_use=True, partition_by=["activity"]
+    )
+    gdf = gpd.read_parquet(path, filters=[("activity", "=", "transit")])
+    expected = handler.geodataframe(single_use=True)
+    assert sorted(gdf.id) == sorted(expected.loc[expected.activity == "transit", "id"])
+    assert gdf.crs == "epsg:27700"
+
+
+@pytest.mark.parametrize("max_open_files", [256, 1])
+def test_write_partitioned_geoparquet_files(handler, tmp_path, mocker, max_open_files):
+    mocker.patch.object(writers, "MAX_OPEN_PARTITION_FILES", max_open_files)
+    path = tmp_path / "out.parquet"
+    path.mkdir()
+    (path / "stale.parquet").touch()
+    writers.write_partitioned_geoparquet(
+        handler, path, single_use=True, partition_by=["activity"], row_group_size=1
+    )
+    files = sorted(path.rglob("*.parquet"))
+    expected = handler.geodataframe(single_use=True)
+    directories = {f.parent for f in files}
+    assert directories == {path / f"activity={act}" for act in expected.activity}
+    if max_open_files > 1:
+        # each partition is written to one file, however many batches it is split across
+        assert len(files) == len(directories)
+        assert all(f.name == "part-0.parquet" for f in files)
+    else:
+        assert len(files) > len(directories)
+    assert sum(pq.read_metadata(f).num_rows for f in files) == len(expected)
+    assert sorted(gpd.read_parquet(path).id) == sorted(expected.id)
+
+
+def test_write_partitioned_geoparquet_to_file(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    path.touch()
+    with pytest.raises(FileExistsError, match="which is a file"):
+        writers.write_partitioned_geoparquet(handler, path, partition_by=["activity"])
+
+
+def test_write_partitioned_geoparquet_unknown_key(handler, tmp_path):
+    with pytest.raises(ValueError, match="Unknown partition keys"):
+        writers.write_partitioned_geoparquet(handler, tmp_path, partition_by=["tile"])
+
+
+def test_write_outputs_partitioned_requires_geoparquet(handler, tmp_path):
+    with pytest.raises(ValueError, match="only supported for geoparquet"):
+        writers.write_outputs(
+            handler,
+            str(tmp_path / "out"),
+            format="geopackage",
+            partition_by=["activity"],
+        )
+
+
+def test_write_geoparquet_geometry_extension_metadata(handler, tmp_path):
+    path = tmp_path / "out.parquet"
+    writers.write_geoparquet(handler, path)
+    field = pq.read_schema(path).field("geometry")
+    assert field.metadata[b"ARROW:extension:name"] == b"geoarrow.wkb"
+
+
+@pytest.mark.parametrize("geometry_encoding", ["WKB", "geoarrow"])
+def test_record_batch_reader_matches_geodataframe(handler, geometry_encoding):
+    reader = writers.record_batch_reader(
+        handler, crs="epsg:4326", batch_size=2, geometry_encoding=geometry_encoding
+    )
+    table = reader.read_all()
+    geo = json.loads(table.schema.metadata[b"geo"])
+    assert geo["columns"]["geometry"]["encoding"] == (
+        "point" if geometry_encoding == "geoarrow" else "WKB"
+    )
+    expected = handler.geodataframe().to_crs("epsg:4326")
+    if geometry_encoding == "geoarrow":
+        geoms = gpd.points_from_xy(
+            table["geometry"].combine_chunks().field("x"),
+            table["geometry"].combine_chunks().field("y"),
+        )
+    else:
+        geoms = gpd.GeoSeries.from_wkb(table["geometry"].to_pylist())
+    assert gpd.GeoSeries(geoms).geom_equals_exact(expected.geometry, 1e-9).all()
+    assert table["activities"].to_pylist() == expected["activities"].tolist()
+
+
+def test_record_batch_reader_consumed_by_arrow_threads(handler, tmp_path):
+    # reprojection would crash if run in arrow's threads
+    reader = writers.record_batch_reader(handler, crs="epsg:4326", batch_size=2)
+    ds.write_dataset(reader, tmp_path / "dataset", format="parquet")
+    assert ds.dataset(tmp_path / "dataset").count_rows() == len(handler.objects)